@@ -0,0 +1,76 @@
+import argparse
+import random
+import string
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from renderer import compile_replacements
+
+def loop_replacements(text: str, replacements: dict) -> str:
+    # the per-key str.replace loop renderer.apply_replacements used before the compiled matcher
+    for key, value in replacements.items():
+        text = text.replace(f"{{{{{key}}}}}", value)
+    return text
+
+def make_replacements(custom: int) -> dict:
+    names = [
+        "timestamp", "date", "year", "month", "day", "weekday", "time", "user",
+        "hostname", "os", "template_name", "project_name", "project_title", "uuid",
+    ]
+    names += [f"custom_{i}" for i in range(custom)]
+    return {name: f"value-of-{name}" for name in names}
+
+def make_text(size: int, density: float, names: list, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        if rng.random() < density:
+            word = "{{" + rng.choice(names) + "}}"
+        else:
+            word = "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10)))
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the compiled placeholder matcher with the str.replace loop")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="Bytes of text per file")
+    parser.add_argument("--files", type=int, default=200, help="Number of files to render per run")
+    parser.add_argument("--density", type=float, default=0.01, help="Fraction of words that are placeholders")
+    parser.add_argument("--custom", type=int, default=5, help="Number of custom placeholders on top of the defaults")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    replacements = make_replacements(args.custom)
+    names = list(replacements) + ["unknown_placeholder"]
+    texts = [make_text(args.size, args.density, names, seed=i) for i in range(args.files)]
+
+    replacer = compile_replacements(replacements)
+    for text in texts:
+        assert replacer.apply(text) == loop_replacements(text, replacements)
+
+    def run_loop():
+        for text in texts:
+            loop_replacements(text, replacements)
+
+    def run_compiled():
+        # compiled once per run, as render_template does
+        matcher = compile_replacements(replacements)
+        for text in texts:
+            matcher.apply(text)
+
+    loop = min(timeit.repeat(run_loop, number=1, repeat=args.repeat))
+    compiled = min(timeit.repeat(run_compiled, number=1, repeat=args.repeat))
+
+    total = args.size * args.files / (1024 * 1024)
+    print(f"{args.files} files x {args.size} bytes, {len(replacements)} placeholders, density {args.density}")
+    print(f"str.replace loop: {loop * 1000:8.2f} ms ({total / loop:8.1f} MiB/s)")
+    print(f"compiled matcher: {compiled * 1000:8.2f} ms ({total / compiled:8.1f} MiB/s)")
+    print(f"speedup:          {loop / compiled:8.2f}x")
+
+if __name__ == "__main__":
+    main()
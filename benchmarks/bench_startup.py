@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+MAIN = Path(__file__).resolve().parent.parent / "main.py"
+COMMANDS = {
+    "help": ["--help"],
+    "list-local": ["list", "local"],
+    "cache-stats": ["cache", "stats"],
+    "create-missing": ["create", "missing/image:0", "bench-project"],
+}
+
+def run_once(args: list, env: dict) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, str(MAIN)] + args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - started) * 1000
+
+def top_imports(args: list, env: dict, limit: int) -> list:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", str(MAIN)] + args,
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # only top-level imports (one space of indent), nested ones are part of their parent's time
+        if not name[1:].startswith(" "):
+            imports.append((name.strip(), int(cumulative_us) / 1000))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:limit]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure `new` startup time per command")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=5, help="Show the slowest top-level imports per command")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--max-ms", type=float, help="Exit non-zero if any command's median exceeds this budget")
+    args = parser.parse_args()
+
+    # a throwaway home so the runs neither read nor write the real config and cache
+    home = tempfile.mkdtemp(prefix="new-bench-home-")
+    env = dict(os.environ, HOME=home)
+    run_once(["--help"], env)  # first run creates the config and warms the page cache
+
+    results = {}
+    for label, command in COMMANDS.items():
+        timings = [run_once(command, env) for _ in range(args.runs)]
+        results[label] = {
+            "command": command,
+            "median_ms": statistics.median(timings),
+            "min_ms": min(timings),
+            "max_ms": max(timings),
+            "top_imports": top_imports(command, env, args.top),
+        }
+        print(f"{label:16} median {results[label]['median_ms']:7.1f} ms  min {results[label]['min_ms']:7.1f} ms")
+        for name, ms in results[label]["top_imports"]:
+            print(f"{'':16}   {ms:7.1f} ms  {name}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version, "runs": args.runs, "results": results}, f, indent=2)
+
+    if args.max_ms is not None:
+        over = [label for label, result in results.items() if result["median_ms"] > args.max_ms]
+        if over:
+            print(f"Over the {args.max_ms:.0f} ms budget: {', '.join(over)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
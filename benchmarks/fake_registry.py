@@ -0,0 +1,178 @@
+import email.parser
+import email.utils
+import hashlib
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from zipfile import ZipFile
+
+class FakeRegistry:
+    # in-process, in-memory stand-in for the remote registry API that remote.py talks to
+    def __init__(self) -> None:
+        self.archives: Dict[Tuple[str, str, str], bytes] = {}
+        self.descriptions: Dict[Tuple[str, str, str], str] = {}
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # set to an error status to make /delta fail the way a broken registry would
+        self.delta_status = 200
+        # when the catalog last changed, sent as Last-Modified; uploads move it forward
+        self.modified = time.time()
+        # set to False to answer catalog requests with Last-Modified only
+        self.etags = True
+        # (method, path, status) of every response, in order
+        self.served: List[Tuple[str, str, int]] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, sent: int = 0, received: int = 0):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def _handler(self):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, content_type: str = "application/json", headers: Dict[str, str] = None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+                registry._count(sent=len(body))
+                with registry._lock:
+                    registry.served.append((self.command, self.path, status))
+
+            def _json(self, data, status: int = 200):
+                self._send(status, json.dumps(data).encode("utf-8"))
+
+            def _catalog(self, data):
+                # /list and /meta answer conditional requests like a caching registry would
+                body = json.dumps(data).encode("utf-8")
+                headers = {"Last-Modified": email.utils.formatdate(registry.modified, usegmt=True)}
+                if registry.etags:
+                    headers["ETag"] = f'"{hashlib.sha256(body).hexdigest()}"'
+                if "If-None-Match" in self.headers:
+                    fresh = self.headers["If-None-Match"] == headers.get("ETag")
+                else:
+                    since = self.headers.get("If-Modified-Since")
+                    fresh = since is not None and email.utils.parsedate_to_datetime(since).timestamp() >= int(registry.modified)
+                if fresh:
+                    return self._send(304, b"", headers=headers)
+                self._send(200, body, headers=headers)
+
+            def _read_body(self) -> bytes:
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    body = io.BytesIO()
+                    while True:
+                        size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            break
+                        body.write(self.rfile.read(size))
+                        self.rfile.readline()
+                    return body.getvalue()
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def _key(self, prefix: str):
+                parts = self.path[len(prefix):].strip("/").split("/")
+                return tuple(parts) if len(parts) == 3 else None
+
+            def do_GET(self):
+                if self.path == "/list":
+                    result = {
+                        f"{c}/{n}:{v}": {"category": c, "name": n, "version": v, "description": registry.descriptions.get((c, n, v))}
+                        for c, n, v in registry.archives
+                    }
+                    return self._catalog({"result": result})
+                if self.path.startswith("/meta/"):
+                    key = self._key("/meta/")
+                    if key not in registry.archives:
+                        return self._json({"detail": "not found"}, 404)
+                    with ZipFile(io.BytesIO(registry.archives[key])) as zipf:
+                        data = json.loads(zipf.read("template.json"))
+                    # keyword names of TemplateMetadata, like new serve sends them
+                    data["open_file"] = data.pop("open", None)
+                    data.pop("base", None)
+                    return self._catalog(data)
+                if self.path.startswith("/get/"):
+                    key = self._key("/get/")
+                    if key not in registry.archives:
+                        return self._json({"detail": "not found"}, 404)
+                    data = registry.archives[key]
+                    digest = hashlib.sha256(data).hexdigest()
+                    headers = {"ETag": f'"{digest}"', "X-Checksum-Sha256": digest, "Accept-Ranges": "bytes"}
+                    range_header = self.headers.get("Range")
+                    if range_header and self.headers.get("If-Range", headers["ETag"]) == headers["ETag"]:
+                        start = int(range_header.split("=", 1)[1].split("-", 1)[0])
+                        if start >= len(data):
+                            return self._send(416, b"", "application/zip", headers)
+                        headers["Content-Range"] = f"bytes {start}-{len(data) - 1}/{len(data)}"
+                        return self._send(206, data[start:], "application/zip", headers)
+                    return self._send(200, data, "application/zip", headers)
+                self._json({"detail": "not found"}, 404)
+
+            def do_POST(self):
+                body = self._read_body()
+                registry._count(received=len(body))
+                if self.path == "/upload":
+                    message = email.parser.BytesParser().parsebytes(
+                        b"Content-Type: " + self.headers["Content-Type"].encode("utf-8") + b"\r\n\r\n" + body
+                    )
+                    fields = {}
+                    for part in message.get_payload():
+                        fields[part.get_param("name", header="content-disposition")] = part.get_payload(decode=True)
+                    key = (fields["category"].decode(), fields["name"].decode(), fields["version"].decode())
+                    registry.archives[key] = fields["file"]
+                    registry.descriptions[key] = fields.get("description", b"").decode()
+                    registry.modified = time.time()
+                    return self._json({"status": "ok"})
+                if self.path.startswith("/delta/"):
+                    key = self._key("/delta/")
+                    if registry.delta_status != 200:
+                        return self._json({"detail": "delta failed"}, registry.delta_status)
+                    if key not in registry.archives:
+                        return self._json({"detail": "not found"}, 404)
+                    have = set(json.loads(body)["files"].values())
+                    return self._send(200, delta_archive(registry.archives[key], have), "application/zip")
+                self._json({"detail": "not found"}, 404)
+
+        return Handler
+
+def delta_archive(archive: bytes, have: set) -> bytes:
+    # the full archive minus every file whose hash the client already holds
+    out = io.BytesIO()
+    with ZipFile(io.BytesIO(archive)) as src, ZipFile(out, "w") as dst:
+        files = json.loads(src.read("image_manifest.json"))["files"] if "image_manifest.json" in src.namelist() else {}
+        for info in src.infolist():
+            entry = files.get(info.filename)
+            if entry is not None and entry["hash"] in have:
+                continue
+            dst.writestr(info, src.read(info))
+    return out.getvalue()
@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# everything new touches lives under $HOME, so point it at a scratch directory before importing the modules
+BENCH_HOME = Path(tempfile.mkdtemp(prefix="new-bench-"))
+os.environ["HOME"] = str(BENCH_HOME)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from builder import build_template
+from image import TemplateImage, get_local_image_path
+from render_plan import load_render_plan
+from renderer import render_template, get_default_placeholders
+import remote
+import store
+from fake_registry import FakeRegistry
+from synthetic import CUSTOM_PLACEHOLDERS, generate_template, mutate_template
+
+PRESETS = {
+    "small": {"files": 200, "depth": 2, "min_size": 64, "max_size": 16 * 1024},
+    "medium": {"files": 2000, "depth": 3, "min_size": 64, "max_size": 64 * 1024},
+    "large": {"files": 5000, "depth": 4, "min_size": 256, "max_size": 1024 * 1024},
+}
+
+def quiet(func, *args, **kwargs):
+    # build/upload print and pull draws progress bars, keep both out of the results
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def measure(func, repeat: int, setup=None) -> dict:
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return {"median_s": statistics.median(timings), "min_s": min(timings), "max_s": max(timings), "runs": timings}
+
+def with_rates(result: dict, files: int, size: int) -> dict:
+    result["files_per_s"] = files / result["median_s"] if result["median_s"] else None
+    result["mib_per_s"] = size / (1024 * 1024) / result["median_s"] if result["median_s"] else None
+    return result
+
+def clear_cache():
+    shutil.rmtree(store.CACHE_ROOT, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmarks for build, create, push and pull")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    parser.add_argument("--files", type=int, help="Number of files (overrides the preset)")
+    parser.add_argument("--depth", type=int, help="Directory depth (overrides the preset)")
+    parser.add_argument("--fanout", type=int, default=4, help="Subdirectories per directory")
+    parser.add_argument("--min-size", type=int, help="Smallest file size in bytes (overrides the preset)")
+    parser.add_argument("--max-size", type=int, help="Largest file size in bytes (overrides the preset)")
+    parser.add_argument("--binary-ratio", type=float, default=0.1)
+    parser.add_argument("--placeholder-density", type=float, default=0.01, help="Fraction of words that are placeholders")
+    parser.add_argument("--jobs", type=int, default=0, help="Render workers (0 = one per CPU)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Print the change against an earlier JSON result")
+    args = parser.parse_args()
+
+    shape = dict(PRESETS[args.preset])
+    for key in ("files", "depth", "min_size", "max_size"):
+        if getattr(args, key) is not None:
+            shape[key] = getattr(args, key)
+    shape.update(fanout=args.fanout, binary_ratio=args.binary_ratio, placeholder_density=args.placeholder_density, seed=args.seed)
+
+    source = BENCH_HOME / "source"
+    totals = generate_template(source, **shape)
+    files, size = totals["files"], totals["bytes"]
+    print(f"Template: {files} files, {size / (1024 * 1024):.1f} MiB, {totals['binary_files']} binary ({args.preset})")
+
+    image = TemplateImage("bench", "synthetic", "1.0")
+    next_image = TemplateImage("bench", "synthetic", "1.1")
+    replacements = get_default_placeholders("bench-project", image.id())
+    replacements.update({name: f"value-{name}" for name in CUSTOM_PLACEHOLDERS})
+    results = {}
+
+    with FakeRegistry() as registry:
+        results["build"] = with_rates(measure(
+            lambda: quiet(build_template, image, source),
+            args.repeat, setup=clear_cache
+        ), files, size)
+
+        image_path = get_local_image_path(image)
+        plan = load_render_plan(image_path)
+        project = BENCH_HOME / "project"
+        results["render"] = with_rates(measure(
+            lambda: render_template(image_path, project, replacements, plan, jobs=args.jobs),
+            args.repeat, setup=lambda: shutil.rmtree(project, ignore_errors=True)
+        ), files, size)
+        results["render_serial"] = with_rates(measure(
+            lambda: render_template(image_path, project, replacements, plan, jobs=1),
+            args.repeat, setup=lambda: shutil.rmtree(project, ignore_errors=True)
+        ), files, size)
+
+        results["upload"] = with_rates(measure(
+            lambda: quiet(remote.upload_template, registry.url, image, token="bench"),
+            args.repeat
+        ), files, size)
+
+        results["pull"] = with_rates(measure(
+            lambda: quiet(remote.pull_template, registry.url, image, delta=False),
+            args.repeat, setup=clear_cache
+        ), files, size)
+
+        # next version with a few changed files, pulled while the previous one is cached
+        changed = mutate_template(source, seed=args.seed + 1)
+        clear_cache()
+        quiet(build_template, next_image, source)
+        quiet(remote.upload_template, registry.url, next_image, token="bench")
+
+        def reset_for_delta():
+            clear_cache()
+            quiet(remote.pull_template, registry.url, image, delta=False)
+
+        results["pull_delta"] = with_rates(measure(
+            lambda: quiet(remote.pull_template, registry.url, next_image, delta=True),
+            args.repeat, setup=reset_for_delta
+        ), files, size)
+        results["pull_delta"]["changed_files"] = changed
+
+        results["registry"] = {"requests": registry.requests, "bytes_sent": registry.bytes_sent, "bytes_received": registry.bytes_received}
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "shape": dict(shape, preset=args.preset, **totals),
+        "repeat": args.repeat,
+        "jobs": args.jobs,
+        "results": results,
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+
+    for name, result in results.items():
+        if "median_s" not in result:
+            continue
+        line = f"{name:14} {result['median_s'] * 1000:9.1f} ms  {result['files_per_s']:9.0f} files/s  {result['mib_per_s']:8.1f} MiB/s"
+        if previous and name in previous:
+            line += f"  ({result['median_s'] / previous[name]['median_s']:.2f}x of baseline)"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    shutil.rmtree(BENCH_HOME, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import json
+import math
+import random
+import string
+from pathlib import Path
+from typing import Dict
+
+CUSTOM_PLACEHOLDERS = ["author", "license", "description"]
+DEFAULT_PLACEHOLDERS = ["project_name", "project_title", "year", "date", "user"]
+
+def _size(rng: random.Random, min_size: int, max_size: int) -> int:
+    # log-uniform, so most files are small and a few are big, like real templates
+    return int(math.exp(rng.uniform(math.log(max(min_size, 1)), math.log(max(max_size, 1)))))
+
+def _text(rng: random.Random, size: int, density: float) -> bytes:
+    names = CUSTOM_PLACEHOLDERS + DEFAULT_PLACEHOLDERS
+    words = []
+    length = 0
+    while length < size:
+        if rng.random() < density:
+            word = "{{" + rng.choice(names) + "}}"
+        else:
+            word = "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9)))
+        words.append(word)
+        length += len(word) + 1
+        if rng.random() < 0.1:
+            words.append("\n")
+    return " ".join(words).encode("utf-8")[:size]
+
+def _binary(rng: random.Random, size: int) -> bytes:
+    # a leading 0xff is never valid UTF-8, so the file is always detected as binary
+    return b"\xff" + rng.randbytes(max(size - 1, 0))
+
+def generate_template(
+    path: Path,
+    files: int = 500,
+    depth: int = 3,
+    fanout: int = 4,
+    min_size: int = 64,
+    max_size: int = 64 * 1024,
+    binary_ratio: float = 0.1,
+    placeholder_density: float = 0.01,
+    seed: int = 0
+) -> Dict[str, int]:
+    rng = random.Random(seed)
+    path.mkdir(parents=True, exist_ok=True)
+    with (path / "template.json").open("w") as f:
+        json.dump({"description": "Synthetic benchmark template", "placeholders": CUSTOM_PLACEHOLDERS, "open": None}, f)
+
+    directories = [Path(".")]
+    for level in range(depth):
+        for parent in [d for d in directories if len(d.parts) == level]:
+            for i in range(fanout):
+                name = "{{project_name}}" if i == 0 and level == 0 else f"dir_{level}_{i}"
+                directories.append(parent / name)
+
+    stats = {"files": 0, "bytes": 0, "binary_files": 0}
+    for i in range(files):
+        rel_dir = rng.choice(directories)
+        size = _size(rng, min_size, max_size)
+        if rng.random() < binary_ratio:
+            data = _binary(rng, size)
+            name = f"asset_{i}.bin"
+            stats["binary_files"] += 1
+        else:
+            data = _text(rng, size, placeholder_density)
+            name = f"file_{i}.txt" if i % 10 else f"{{{{project_name}}}}_{i}.txt"
+        (path / rel_dir).mkdir(parents=True, exist_ok=True)
+        (path / rel_dir / name).write_bytes(data)
+        stats["files"] += 1
+        stats["bytes"] += len(data)
+    return stats
+
+def mutate_template(path: Path, ratio: float = 0.05, seed: int = 1) -> int:
+    # rewrites a fraction of the text files, to produce a "next version" for delta pulls
+    rng = random.Random(seed)
+    candidates = sorted(p for p in path.rglob("*.txt"))
+    changed = rng.sample(candidates, max(1, int(len(candidates) * ratio))) if candidates else []
+    for file in changed:
+        file.write_bytes(file.read_bytes() + b"\nchanged {{project_name}}\n")
+    return len(changed)
@@ -1,10 +1,176 @@
 import shutil
 import os
+import json
+import posixpath
 from pathlib import Path
-from image import TemplateImage, get_local_image_path
+from typing import Dict, List, Optional, Set, Tuple
+from image import TemplateImage, get_local_image_path, get_packed_image_path, find_local_image
 from template_metadata import TemplateMetadata
+from render_plan import RenderPlan, RENDER_PLAN_FILE, load_render_plan
+import store
+import image_index
+import instrument
+from renderer import PlaceholderMatcher, default_placeholder_names, scan_file
+from pack import PackWriter
+from layers import layer_info, save_layer
+from ignore import IGNORE_FILE, IgnoreRules, walk_source
 
-def build_template(image: TemplateImage, source_path: Path, force: bool = False, dry_run: bool = False, verbose: bool = False):
+# written next to template.json by every build, so a source folder can't ship files with these names at its top
+GENERATED_FILES = (RENDER_PLAN_FILE, store.MANIFEST_FILE, store.LAYER_FILE)
+
+# what each image was last built from, kept outside the image so it never ends up in archives
+BUILDS_ROOT = store.CACHE_ROOT / "builds"
+
+def build_state_path(image: TemplateImage) -> Path:
+    return BUILDS_ROOT / image.category / image.name / f"{image.version}.json"
+
+def load_previous_build(image: TemplateImage, source_path: Path, target_path: Path) -> Optional[dict]:
+    # everything an incremental build reuses; None means the image has to be built from scratch
+    try:
+        with build_state_path(image).open("r") as f:
+            state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if state.get("source") != str(source_path) or (target_path / store.LAYER_FILE).exists():
+        return None
+    files = store.load_manifest(target_path)
+    plan = load_render_plan(target_path)
+    if files is None or plan is None:
+        return None
+    return {"sources": state.get("files", {}), "dirs": state.get("dirs"), "files": files, "plan": plan}
+
+def save_build_state(image: TemplateImage, source_path: Path, sources: Dict[str, list], dirs: Set[str]):
+    path = build_state_path(image)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with tmp.open("w") as f:
+        json.dump({"source": str(source_path), "files": sources, "dirs": sorted(dirs)}, f)
+    os.replace(tmp, path)
+
+def walk_changed(source_path: Path, rules: IgnoreRules, previous: dict, changed: Set[str]) -> Optional[List[Tuple[str, List[str], List[str]]]]:
+    # what walk_source would yield, put together from the last build's record and the changed paths alone;
+    # None when a directory or the ignore rules changed and only a real walk will do
+    dirs = previous["dirs"]
+    if dirs is None:
+        return None
+    dirs = set(dirs)
+    files = set(previous["sources"])
+    for rel_path in changed:
+        if rel_path in (".", IGNORE_FILE) or rel_path in dirs:
+            return None
+        path = source_path / rel_path
+        if os.path.isdir(path):
+            return None
+        if os.path.lexists(path) and not rules.ignored(rel_path):
+            if (posixpath.dirname(rel_path) or ".") not in dirs:
+                return None
+            files.add(rel_path)
+        else:
+            files.discard(rel_path)
+    by_dir = {rel_dir: [] for rel_dir in dirs}
+    for rel_file in files:
+        by_dir[posixpath.dirname(rel_file) or "."].append(posixpath.basename(rel_file))
+    return [(str(source_path / rel_dir), [], sorted(names)) for rel_dir, names in sorted(by_dir.items())]
+
+def resolve_base(image: TemplateImage, metadata: TemplateMetadata) -> Tuple[TemplateImage, Set[str], Dict[str, Tuple[str, bool]]]:
+    # the base named in template.json, pinned to the exact cached version it is built against
+    from layers import base_images, merged_contents
+    base = TemplateImage.parse(metadata.base, allow_missing_version=True)
+    if image.id() in {b.id() for b in [base] + base_images(base)}:
+        raise ValueError(f"Template image '{image}' can't be built on {base}, which is built on it")
+    base_path = find_local_image(base)
+    if base_path is None:
+        raise FileNotFoundError(f"Base image {base} is not in the local cache, pull or build it first")
+    base_dirs, base_files = merged_contents(base_path)
+    metadata.base = base.id()
+    return base, base_dirs, base_files
+
+def unchanged_from_base(src: Path, rel_file: str, base_files: Optional[Dict[str, Tuple[str, bool]]]) -> bool:
+    # files the base already holds byte for byte, with the same mode, stay out of the layer
+    if base_files is None or rel_file not in base_files:
+        return False
+    digest, executable = base_files[rel_file]
+    return executable == bool(os.stat(src).st_mode & 0o111) and store.hash_file(src) == digest
+
+def report_ignored(verbose: bool):
+    def on_ignore(rel_path: str, is_dir: bool):
+        instrument.count("build.ignored")
+        if verbose:
+            print(f"Ignore: {rel_path}/" if is_dir else f"Ignore: {rel_path}")
+    return on_ignore
+
+def build_packed_template(image: TemplateImage, source_path: Path, metadata: TemplateMetadata, force: bool = False, dry_run: bool = False, verbose: bool = False, base: Optional[tuple] = None, rules: Optional[IgnoreRules] = None):
+    target_path = get_packed_image_path(image)
+    loose_path = get_local_image_path(image)
+    if (target_path.exists() or loose_path.exists()) and not force:
+        raise FileExistsError(f"Template image '{image}' already exists. Use --force to overwrite.")
+
+    if verbose:
+        print(f"Building packed template {image}")
+        print(f"From: {source_path}")
+        print(f"To:   {target_path}")
+
+    base, base_dirs, base_files = base or (None, set(), None)
+
+    if dry_run:
+        print(f"Template image '{image}' built successfully")
+        return
+
+    names = set(metadata.placeholders) | set(default_placeholder_names())
+    matcher = PlaceholderMatcher(names)
+    plan = RenderPlan(placeholders=list(names))
+    source_dirs = set()
+    from_base = {}
+    writer = PackWriter(target_path)
+    try:
+        for root, dirs, files in walk_source(source_path, rules, on_ignore=report_ignored(verbose)):
+            rel_root = Path(root).relative_to(source_path)
+            if rel_root != Path("."):
+                writer.add_dir(rel_root.as_posix())
+                source_dirs.add(rel_root.as_posix())
+                plan.add_path(rel_root.as_posix(), matcher)
+
+            for file in files:
+                if file == 'template.json':
+                    continue
+                src = Path(root) / file
+                rel_file = (rel_root / file).as_posix()
+                with instrument.phase("build.scan"):
+                    entry = scan_file(src, matcher)
+                # the plan always covers the whole image, the pack only what differs from the base
+                plan.add_path(rel_file, matcher)
+                plan.add_file(rel_file, entry)
+                if unchanged_from_base(src, rel_file, base_files):
+                    from_base[rel_file] = base_files[rel_file][0]
+                    if verbose:
+                        print(f"From base: {src}")
+                    continue
+                with instrument.phase("build.store"):
+                    writer.add_file(rel_file, src, binary=entry["type"] == "binary")
+                instrument.count("build.files")
+                instrument.count("build.bytes_read", entry["size"])
+                if verbose:
+                    print(f"Pack: {src}")
+        layer = None
+        if base is not None:
+            layer = layer_info(base, (set(base_files) - set(plan.files)) | (base_dirs - source_dirs), from_base)
+        writer.close(metadata.dump(), plan, layer)
+    except BaseException:
+        writer.abort()
+        raise
+
+    # the pack replaces a loose version of the same image
+    if loose_path.exists():
+        old_manifest = store.load_manifest(loose_path) or {}
+        shutil.rmtree(loose_path)
+        store.release_blobs(old_manifest)
+    build_state_path(image).unlink(missing_ok=True)
+    image_index.add(image)
+    print(f"Template image '{image}' built successfully")
+
+def build_template(image: TemplateImage, source_path: Path, force: bool = False, dry_run: bool = False, verbose: bool = False, incremental: bool = False, packed: bool = False, changed: Optional[Set[str]] = None) -> Optional[Set[str]]:
+    # with changed (paths relative to the source folder), an incremental build only looks at those files.
+    # Returns the files an incremental build stored again or removed, None when any file or directory may have changed
     if not source_path.exists() or not source_path.is_dir():
         raise FileNotFoundError(f"Source path does not exist or is not a directory: {source_path}")
 
@@ -12,43 +178,189 @@ def build_template(image: TemplateImage, source_path: Path, force: bool = False,
     if not original_metadata_path.exists():
         raise FileNotFoundError(f"Missing 'template.json' in source template folder: {source_path}")
 
+    rules = IgnoreRules.load(source_path)
+    reserved = [name for name in GENERATED_FILES if os.path.lexists(source_path / name) and not rules.ignored(name)]
+    if reserved:
+        raise ValueError(f"{', '.join(reserved)} at the top of {source_path} would clash with the image's generated metadata, rename or .newignore it")
+
     metadata = TemplateMetadata.load(original_metadata_path)
     metadata.category = image.category
     metadata.name = image.name
     metadata.version = image.version
+    base = resolve_base(image, metadata) if metadata.base else None
+
+    if packed:
+        if incremental and verbose:
+            print("Packed images are always built in full")
+        build_packed_template(image, source_path, metadata, force, dry_run, verbose, base, rules)
+        return
 
     target_path = get_local_image_path(image)
+    old_manifest = {}
+    previous = None
 
-    if target_path.exists():
+    packed_path = get_packed_image_path(image)
+    if packed_path.exists():
         if not force:
             raise FileExistsError(f"Template image '{image}' already exists. Use --force to overwrite.")
-        if verbose:
-            print(f"Overwriting existing template at: {target_path}")
         if not dry_run:
-            shutil.rmtree(target_path)
+            packed_path.unlink()
+
+    if target_path.exists():
+        if incremental and base is None:
+            previous = load_previous_build(image, source_path, target_path)
+            if previous is None and force and verbose:
+                print("No usable state from an earlier build, rebuilding everything")
+        if previous is None:
+            # without a record of the earlier build this is a full overwrite, which still needs --force
+            if not force:
+                reason = " and has no usable state from an earlier build" if incremental else ""
+                raise FileExistsError(f"Template image '{image}' already exists{reason}. Use --force to overwrite.")
+            if verbose:
+                print(f"Overwriting existing template at: {target_path}")
+            if not dry_run:
+                old_manifest = store.load_manifest(target_path) or {}
+                shutil.rmtree(target_path)
+                image_index.remove(image)
 
     if verbose:
         print(f"Building template {image}")
         print(f"From: {source_path}")
         print(f"To:   {target_path}")
 
-    if not dry_run:
-        for root, dirs, files in os.walk(source_path):
-            rel_root = Path(root).relative_to(source_path)
-            target_dir = target_path / rel_root
-            target_dir.mkdir(parents=True, exist_ok=True)
+    if dry_run:
+        print(f"Template image '{image}' built successfully")
+        return
 
-            for file in files:
-                if file == 'template.json':
-                    continue  # will be saved manually later
-                src = Path(root) / file
-                dst = target_dir / file
+    names = set(metadata.placeholders) | set(default_placeholder_names())
+    matcher = PlaceholderMatcher(names)
+    plan = RenderPlan(placeholders=list(names))
+    manifest = {}
+    sources = {}
+    previous_sources = previous["sources"] if previous else {}
+    previous_files = previous["files"] if previous else {}
+    previous_plan = previous["plan"] if previous else RenderPlan()
+    # offsets depend on the placeholder names, so a changed list means every text file is scanned again
+    rescan = previous_plan.placeholders != plan.placeholders
+    base_image, base_dirs, base_files = base or (None, set(), None)
+    source_dirs = set()
+    from_base = {}
+    walk = walk_changed(source_path, rules, previous, changed) if previous is not None and changed is not None else None
+    # files that weren't reported as changed keep their recorded stat without being looked at
+    fresh = None if walk is None else changed
+    if walk is None:
+        walk = walk_source(source_path, rules, on_ignore=report_ignored(verbose))
+    walk = list(walk)
+    updated = set()
+
+    if previous is not None:
+        # a file that became a directory, or the other way round, is in the way of the new layout, so it goes first
+        walked_dirs = {Path(root).relative_to(source_path).as_posix() for root, _, _ in walk}
+        walked_files = {(Path(root).relative_to(source_path) / file).as_posix() for root, _, files in walk for file in files}
+        for rel_file in previous_files:
+            dst = target_path / rel_file
+            if rel_file not in walked_files and os.path.lexists(dst) and not os.path.isdir(dst):
+                os.unlink(dst)
+        if fresh is None:
+            for root, dirs, files in os.walk(target_path, topdown=False):
+                if Path(root).relative_to(target_path).as_posix() not in walked_dirs:
+                    shutil.rmtree(root)
+
+    for root, dirs, files in walk:
+        rel_root = Path(root).relative_to(source_path)
+        target_dir = target_path / rel_root
+        target_dir.mkdir(parents=True, exist_ok=True)
+        source_dirs.add(rel_root.as_posix())
+        if rel_root != Path("."):
+            plan.add_path(rel_root.as_posix(), matcher)
+
+        for file in files:
+            if file == 'template.json':
+                continue  # will be saved manually later
+            src = Path(root) / file
+            dst = target_dir / file
+            rel_file = (rel_root / file).as_posix()
+            if unchanged_from_base(src, rel_file, base_files):
+                # left to the base; the plan still covers it so create sees the whole image
+                with instrument.phase("build.scan"):
+                    entry = scan_file(src, matcher)
+                plan.add_path(rel_file, matcher)
+                plan.add_file(rel_file, entry)
+                from_base[rel_file] = base_files[rel_file][0]
                 if verbose:
-                    print(f"Copy: {src} -> {dst}")
-                shutil.copy2(src, dst)
+                    print(f"From base: {src}")
+                continue
+            old_source = previous_sources.get(rel_file)
+            if fresh is not None and old_source is not None and rel_file not in fresh:
+                key = old_source[:3]
+            else:
+                # size, mtime and permission bits decide whether a file is looked at again
+                st = os.stat(src)
+                key = [st.st_size, st.st_mtime_ns, st.st_mode & 0o777]
+            stored = previous_files.get(rel_file)
+            entry = previous_plan.files.get(rel_file)
 
-        # save the modified metadata
-        metadata.save(target_path / "template.json")
+            # the hash check catches an image that was pulled over since the last build
+            reuse = stored is not None and entry is not None and old_source is not None and old_source[3] == stored["hash"]
+            if reuse and old_source[:3] != key:
+                # touched but identical files keep their blob, only the recorded mtime moves
+                reuse = old_source[0] == key[0] and old_source[2] == key[2] and store.hash_file(src) == old_source[3]
+                if reuse:
+                    stored = dict(stored, mtime=key[1])
 
-    print(f"Template image '{image}' built successfully")
+            if not reuse:
+                with instrument.phase("build.scan"):
+                    entry = scan_file(src, matcher)
+                with instrument.phase("build.store"):
+                    stored = store.store_file(src)
+                    store.link_blob(stored, dst)
+                instrument.count("build.files")
+                instrument.count("build.bytes_read", entry["size"])
+                updated.add(rel_file)
+                if verbose:
+                    print(f"Store: {src} -> {stored['hash'][:12]} -> {dst}")
+            else:
+                if rescan:
+                    with instrument.phase("build.scan"):
+                        entry = scan_file(src, matcher)
+                if (fresh is None or rel_file in fresh) and not os.path.lexists(dst):
+                    store.link_blob(stored, dst)
 
+            plan.add_path(rel_file, matcher)
+            plan.add_file(rel_file, entry)
+            manifest[rel_file] = stored
+            sources[rel_file] = key + [stored["hash"]]
+
+    removed = [rel_file for rel_file in previous_files if rel_file not in manifest]
+    for rel_file in removed:
+        dst = target_path / rel_file
+        if os.path.lexists(dst) and not os.path.isdir(dst):
+            os.unlink(dst)
+        if verbose:
+            print(f"Remove: {dst}")
+
+    # save the modified metadata, the render plan and the blob manifest next to it, each only if it changed
+    with instrument.phase("build.metadata"):
+        metadata_path = target_path / "template.json"
+        if previous is None or not metadata_path.exists() or TemplateMetadata.load(metadata_path).dump() != metadata.dump():
+            metadata.save(metadata_path)
+        if previous is None or previous_plan.dump() != plan.dump():
+            plan.save(target_path / RENDER_PLAN_FILE)
+        if previous is None or previous_files != manifest:
+            store.save_manifest(target_path, manifest)
+        if base_image is not None:
+            # everything the base has that the source doesn't is hidden again when rendering
+            save_layer(target_path, base_image, (set(base_files) - set(plan.files)) | (base_dirs - source_dirs), from_base)
+        save_build_state(image, source_path, sources, source_dirs)
+        image_index.add(image)
+    # blobs only the overwritten or replaced files used; done last so unchanged files keep theirs
+    store.release_blobs(old_manifest)
+    store.release_blobs({rel_file: entry for rel_file, entry in previous_files.items() if manifest.get(rel_file) != entry})
+
+    if previous is not None:
+        print(f"Template image '{image}' updated ({len(updated)} changed, {len(removed)} removed, {len(manifest) - len(updated)} unchanged)")
+        if rescan or previous["dirs"] is None or set(previous["dirs"]) != source_dirs:
+            return None
+        return updated | set(removed)
+    print(f"Template image '{image}' built successfully")
+    return None
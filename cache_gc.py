@@ -0,0 +1,149 @@
+import os
+from pathlib import Path
+from typing import List
+from image import TemplateImage, find_local_image, list_local_images, remove_local_image, safe_version
+from store import ARCHIVES_ROOT, BLOBS_ROOT
+import store
+import image_index
+from layers import load_layer
+
+def matches_pin(pin: str, image: TemplateImage) -> bool:
+    # "category/name" pins every version, "category/name:version" a single one
+    return pin in (f"{image.category}/{image.name}", image.id())
+
+def _tree_size(path: Path) -> int:
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+def _archive_size(image: TemplateImage) -> int:
+    size = 0
+    for path in store.archive_files(image.category, image.name, image.version):
+        try:
+            size += path.stat().st_size
+        except FileNotFoundError:
+            pass
+    return size
+
+def scan_versions(keep_latest: int, pins: List[str]) -> List[dict]:
+    # every cached version, least recently used first
+    used = image_index.last_used()
+    versions = []
+    by_name = {}
+    for image in list_local_images():
+        path = find_local_image(image)
+        if path is None:
+            continue  # removed since the index was read
+        version = {"image": image, "path": path, "private_bytes": 0, "blobs": set(), "keep": None}
+        # images that were never served since tracking started count as used when they were built or pulled
+        version["last_used"] = used.get((image.category, image.name, image.version)) or os.stat(path).st_mtime
+        if path.is_file():
+            version["private_bytes"] = path.stat().st_size
+        else:
+            files = store.load_manifest(path)
+            if files is None:
+                version["private_bytes"] = _tree_size(path)
+            else:
+                version["blobs"] = {store.blob_path(entry["hash"], entry["mode"] & 0o111 != 0) for entry in files.values()}
+        # the archive new serve keeps of the version is removed along with it
+        version["private_bytes"] += _archive_size(image)
+        versions.append(version)
+        by_name.setdefault((image.category, image.name), []).append(version)
+
+    # a base layer goes only with the last image built on it, so it is kept while any is cached
+    bases = set()
+    for version in versions:
+        layer = load_layer(version["path"])
+        if layer is not None:
+            bases.add(layer["base"])
+
+    for group in by_name.values():
+        group.sort(key=lambda v: (safe_version(v["image"].version), v["image"].version), reverse=True)
+        for i, version in enumerate(group):
+            if any(matches_pin(pin, version["image"]) for pin in pins):
+                version["keep"] = "pinned"
+            elif version["image"].id() in bases:
+                version["keep"] = "base"
+            elif i < keep_latest:
+                version["keep"] = "latest"
+    versions.sort(key=lambda v: v["last_used"])
+    return versions
+
+def collect_garbage(max_size: int, keep_latest: int = 1, pins: List[str] = (), dry_run: bool = False) -> dict:
+    versions = scan_versions(keep_latest, list(pins))
+    refs = {}
+    for version in versions:
+        for blob in version["blobs"]:
+            refs[blob] = refs.get(blob, 0) + 1
+
+    disk = {}
+    orphans = []
+    if BLOBS_ROOT.exists():
+        for blob in BLOBS_ROOT.glob("*/*"):
+            if blob.name.endswith(".tmp"):
+                continue
+            st = blob.stat()
+            disk[blob] = st.st_size
+            # only the store's own link left; a build may have linked it into a version it hasn't recorded yet
+            if blob not in refs and st.st_nlink == 1:
+                orphans.append(blob)
+
+    # archives of versions that are no longer cached, e.g. deleted while new serve wasn't running
+    cached = {(v["image"].category, v["image"].name, v["image"].version) for v in versions}
+    stale_archives = {}
+    if ARCHIVES_ROOT.exists():
+        for path in ARCHIVES_ROOT.glob("*/*/*"):
+            if path.suffix in (".zip", ".json") and (path.parent.parent.name, path.parent.name, path.stem) not in cached:
+                stale_archives[path] = path.stat().st_size
+
+    usage = sum(disk.values()) + sum(version["private_bytes"] for version in versions) + sum(stale_archives.values())
+    orphan_bytes = sum(disk[blob] for blob in orphans)
+    stale_archive_bytes = sum(stale_archives.values())
+    for version in versions:
+        version["frees"] = version["private_bytes"] + sum(disk.get(blob, 0) for blob in version["blobs"] if refs[blob] == 1)
+
+    # shared blobs are only freed once the last version using them goes
+    remaining = usage - orphan_bytes - stale_archive_bytes
+    evicted = []
+    for version in versions:
+        if not max_size or remaining <= max_size:
+            break
+        if version["keep"] is not None:
+            continue
+        freed = version["private_bytes"]
+        for blob in version["blobs"]:
+            refs[blob] -= 1
+            if refs[blob] == 0:
+                freed += disk.get(blob, 0)
+        version["frees"] = freed
+        remaining -= freed
+        evicted.append(version)
+
+    if not dry_run:
+        for blob in orphans:
+            try:
+                if os.stat(blob).st_nlink == 1:  # a build may have linked it in the meantime
+                    os.unlink(blob)
+            except FileNotFoundError:
+                pass
+        for path in stale_archives:
+            path.unlink(missing_ok=True)
+        for version in evicted:
+            try:
+                remove_local_image(version["image"])
+            except FileNotFoundError:
+                pass
+
+    return {
+        "usage_bytes": usage,
+        "remaining_bytes": remaining,
+        "max_size": max_size,
+        "versions": versions,
+        "evicted": evicted,
+        "orphans": len(orphans),
+        "orphan_bytes": orphan_bytes,
+        "stale_archives": sum(path.suffix == ".zip" for path in stale_archives),
+        "stale_archive_bytes": stale_archive_bytes,
+    }
@@ -10,9 +10,32 @@ DEFAULT_CONFIG = {
     "open_main_file": False,
     "remote": "https://repo.new.kackhost.de",
     "allow_missing_version": True,
-    "upload_token": "no-token"
+    "upload_token": "no-token",
+    "jobs": 0,
+    "remote_cache_ttl": 300,
+    "offline": False,
+    "transfer_jobs": 4,
+    "upload_compression": "deflate",
+    "upload_compression_level": 6,
+    "packed_images": False,
+    "cache_max_size": 0,
+    "cache_keep_latest": 1,
+    "cache_pins": []
 }
 
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+def parse_size(value) -> int:
+    # 5368709120, "5G", "5GiB" and "5 GB" all mean the same, units are powers of 1024
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip().upper().replace(" ", "").removesuffix("B").removesuffix("I")
+    number, unit = text.rstrip("KMGT"), text[len(text.rstrip("KMGT")):]
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except (KeyError, ValueError):
+        raise ValueError(f"Invalid size: '{value}'")
+
 class Config:
     def __init__(self) -> None:
         self._config = {}
@@ -26,21 +49,29 @@ class Config:
         else:
             with CONFIG_PATH.open("r") as f:
                 self._config = json.load(f)
-            for k, v in DEFAULT_CONFIG.items():
-                if k not in self._config:
-                    self._config[k] = v
-            self._write()
+            missing = [k for k in DEFAULT_CONFIG if k not in self._config]
+            for k in missing:
+                self._config[k] = DEFAULT_CONFIG[k]
+            # only touch the file when a newer version added keys
+            if missing:
+                self._write()
 
     def _write(self):
         with CONFIG_PATH.open("w") as f:
             json.dump(self._config, f, indent=2)
 
+    def _set(self, key: str, value):
+        if key in self._config and self._config[key] == value:
+            return
+        self._config[key] = value
+        self._write()
+
     def get_template_paths(self) -> List[Path]:
         # create fallback folder if not existing
         fallback_template_folder = Path.home() / ".config" / "new" / "templates"
         fallback_template_folder.mkdir(parents=True, exist_ok=True)
 
-        full_paths = self._config.get("template_paths", [])
+        full_paths = list(self._config.get("template_paths", []))
         full_paths.append(fallback_template_folder.resolve())
 
         full_paths = [Path(p).expanduser().resolve() for p in full_paths]
@@ -56,22 +87,19 @@ class Config:
         return self._config.get("open_main_file", False)
 
     def set_open_main_file(self, value: bool):
-        self._config["open_main_file"] = value
-        self._write()
+        self._set("open_main_file", value)
 
     def get_remote_url(self) -> str:
         return self._config.get("remote", DEFAULT_CONFIG["remote"])
 
     def set_remote_url(self, url: str):
-        self._config["remote"] = url
-        self._write()
+        self._set("remote", url)
 
     def get_allow_missing_version(self) -> bool:
         return self._config.get("allow_missing_version", DEFAULT_CONFIG["allow_missing_version"])
 
     def set_allow_missing_version(self, allow: bool):
-        self._config["allow_missing_version"] = allow
-        self._write()
+        self._set("allow_missing_version", allow)
 
     def get_upload_token(self):
         token = self._config.get("upload_token", "no-token")
@@ -80,8 +108,77 @@ class Config:
         return True, token
 
     def set_upload_token(self, token: str):
-        self._config["upload_token"] = token
+        self._set("upload_token", token)
+
+    def get_jobs(self) -> int:
+        return int(self._config.get("jobs", DEFAULT_CONFIG["jobs"]))
+
+    def set_jobs(self, jobs: int):
+        self._set("jobs", jobs)
+
+    def get_remote_cache_ttl(self) -> float:
+        return float(self._config.get("remote_cache_ttl", DEFAULT_CONFIG["remote_cache_ttl"]))
+
+    def set_remote_cache_ttl(self, seconds: float):
+        self._set("remote_cache_ttl", seconds)
+
+    def get_offline(self) -> bool:
+        return self._config.get("offline", DEFAULT_CONFIG["offline"])
+
+    def set_offline(self, offline: bool):
+        self._set("offline", offline)
+
+    def get_transfer_jobs(self) -> int:
+        return int(self._config.get("transfer_jobs", DEFAULT_CONFIG["transfer_jobs"]))
+
+    def set_transfer_jobs(self, jobs: int):
+        self._set("transfer_jobs", jobs)
+
+    def get_upload_compression(self) -> str:
+        return self._config.get("upload_compression", DEFAULT_CONFIG["upload_compression"])
+
+    def set_upload_compression(self, compression: str):
+        self._set("upload_compression", compression)
+
+    def get_upload_compression_level(self) -> int:
+        return int(self._config.get("upload_compression_level", DEFAULT_CONFIG["upload_compression_level"]))
+
+    def set_upload_compression_level(self, level: int):
+        self._set("upload_compression_level", level)
+
+    def get_packed_images(self) -> bool:
+        return self._config.get("packed_images", DEFAULT_CONFIG["packed_images"])
+
+    def set_packed_images(self, value: bool):
+        self._set("packed_images", value)
+
+    def get_cache_max_size(self) -> int:
+        return parse_size(self._config.get("cache_max_size", DEFAULT_CONFIG["cache_max_size"]))
+
+    def set_cache_max_size(self, size):
+        self._set("cache_max_size", size)
+
+    def get_cache_keep_latest(self) -> int:
+        return int(self._config.get("cache_keep_latest", DEFAULT_CONFIG["cache_keep_latest"]))
+
+    def set_cache_keep_latest(self, count: int):
+        self._set("cache_keep_latest", count)
+
+    def get_cache_pins(self) -> List[str]:
+        return list(self._config.get("cache_pins", []))
+
+    def add_cache_pin(self, ref: str):
+        if ref not in self._config.setdefault("cache_pins", []):
+            self._config["cache_pins"].append(ref)
+            self._write()
+
+    def remove_cache_pin(self, ref: str) -> bool:
+        pins = self._config.get("cache_pins", [])
+        if ref not in pins:
+            return False
+        pins.remove(ref)
         self._write()
+        return True
 
     def reload(self):
         self._load_or_initialize()
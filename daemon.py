@@ -0,0 +1,250 @@
+import json
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+from store import CACHE_ROOT
+
+SOCKET_PATH = CACHE_ROOT / "daemon.sock"
+# the client's variables that placeholders depend on; the daemon's own may be from another login or zone
+CLIENT_ENV = ("LOGNAME", "USER", "LNAME", "USERNAME", "TZ")
+LOG_PATH = CACHE_ROOT / "daemon.log"
+START_TIMEOUT = 10.0
+
+# one JSON object per line in both directions:
+#   client -> daemon: {"command": "run", "argv": [...], "cwd": ..., "color": ..., "width": ..., "editor": ..., "env": {...}}
+#   daemon -> client: {"output": text}, {"prompt": true} (answered with {"answer": text}), finally {"done": true, "open": [...]}
+
+def _send(f, message: dict):
+    f.write(json.dumps(message).encode("utf-8") + b"\n")
+    f.flush()
+
+def _receive(f) -> Optional[dict]:
+    line = f.readline()
+    return json.loads(line) if line else None
+
+def _connect() -> Optional[socket.socket]:
+    if not SOCKET_PATH.exists():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(SOCKET_PATH))
+    except OSError:
+        sock.close()
+        return None  # left behind by a daemon that was killed
+    return sock
+
+def request(message: dict) -> Optional[dict]:
+    sock = _connect()
+    if sock is None:
+        return None
+    try:
+        with sock, sock.makefile("rwb") as f:
+            _send(f, message)
+            return _receive(f)
+    except OSError:
+        return None  # the daemon went away in between, e.g. right after a stop
+
+def forward(argv: List[str]) -> bool:
+    # False when no daemon took the command, so the caller runs it itself
+    sock = _connect()
+    if sock is None:
+        return False
+    import shutil
+    editor = os.environ.get("EDITOR")
+    with sock, sock.makefile("rwb") as f:
+        try:
+            _send(f, {
+                "command": "run",
+                "argv": argv,
+                "cwd": os.getcwd(),
+                "color": sys.stdout.isatty() and "NO_COLOR" not in os.environ,
+                "width": shutil.get_terminal_size().columns,
+                "editor": editor,
+                "env": {name: os.environ[name] for name in CLIENT_ENV if name in os.environ}
+            })
+            message = _receive(f)
+        except OSError:
+            return False
+        if message is None:
+            return False  # the daemon is shutting down and never started the command
+        while message is not None:
+            if "output" in message:
+                sys.stdout.write(message["output"])
+                sys.stdout.flush()
+            if message.get("prompt"):
+                try:
+                    answer = input()
+                except (EOFError, KeyboardInterrupt):
+                    return True
+                _send(f, {"answer": answer})
+            if message.get("done"):
+                for path in message.get("open", []):
+                    os.system(f"{editor} {path}")
+                return True
+            message = _receive(f)
+    sys.stderr.write("new daemon closed the connection\n")
+    return True
+
+def status() -> Optional[dict]:
+    return request({"command": "status"})
+
+def stop() -> bool:
+    return request({"command": "stop"}) is not None
+
+def start() -> dict:
+    # the status of the running daemon, spawning one first if there is none
+    current = status()
+    if current is not None:
+        return current
+    import subprocess
+    LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+    main_path = Path(__file__).resolve().with_name("main.py")
+    with open(LOG_PATH, "ab") as log:
+        process = subprocess.Popen(
+            [sys.executable, str(main_path), "daemon", "run"],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+            start_new_session=True, cwd="/"
+        )
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        current = status()
+        if current is not None:
+            return current
+        if process.poll() is not None:
+            raise RuntimeError(f"new daemon exited right away, see {LOG_PATH}")
+        time.sleep(0.05)
+    raise TimeoutError(f"new daemon did not come up within {START_TIMEOUT:.0f}s, see {LOG_PATH}")
+
+def run(run_command, parser):
+    # serves until `new daemon stop`, SIGTERM or Ctrl+C
+    import signal
+    import socketserver
+    import threading
+    from io import StringIO
+    from rich.console import Console
+    # imported up front so that no command pays for them
+    import rich.prompt
+    import rich.tree
+    import remote
+    import renderer
+    import image_index
+    import output
+    from config import config, CONFIG_PATH
+
+    if status() is not None:
+        raise RuntimeError("new daemon is already running")
+    # what a one-off process loads again on every call stays in memory, checked against mtimes on use
+    image_index.keep_in_memory()
+    renderer.enable_template_cache()
+
+    def config_mtime() -> Optional[int]:
+        try:
+            return os.stat(CONFIG_PATH).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            message = _receive(self.rfile)
+            if message is None:
+                return
+            if message.get("command") == "status":
+                _send(self.wfile, server.status())
+            elif message.get("command") == "stop":
+                _send(self.wfile, {"stopping": True})
+                threading.Thread(target=server.shutdown).start()
+            elif message.get("command") == "run":
+                self.run_command(message)
+
+        def run_command(self, message: dict):
+            buffer = StringIO()
+            color = message.get("color", False)
+            console = Console(file=buffer, force_terminal=color, color_system="standard" if color else None, width=message.get("width") or 80)
+            opened = []
+
+            def flush():
+                text = buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                if text:
+                    _send(self.wfile, {"output": text})
+
+            def ask(label: str) -> str:
+                console.print(f"[bold cyan]?[/bold cyan] {label}: ", end="")
+                flush()
+                _send(self.wfile, {"prompt": True})
+                reply = _receive(self.rfile)
+                if reply is None:
+                    raise ConnectionError("client went away while prompting")
+                return reply["answer"]
+
+            def open_file(path: Path):
+                if message.get("editor"):
+                    output.info(f"Opening {path} in $EDITOR...")
+                    opened.append(str(path))
+
+            server.refresh()
+            with output.redirect(console, ask, open_file), renderer.client_environment(message.get("env")):
+                try:
+                    args = parser.parse_args(message["argv"])
+                    if args.command == "create":
+                        # relative paths are the client's, not the daemon's
+                        args.output = os.path.join(message["cwd"], args.output or "")
+                    run_command(args)
+                except SystemExit:
+                    pass
+                except ConnectionError:
+                    return
+                except Exception as e:
+                    output.error(str(e))
+            try:
+                flush()
+                _send(self.wfile, {"done": True, "open": opened})
+            except OSError:
+                pass  # the client is gone, nothing left to tell it
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self) -> None:
+            self.started = time.time()
+            self.requests = 0
+            self._config_mtime = config_mtime()
+            self._lock = threading.Lock()
+            SOCKET_PATH.parent.mkdir(parents=True, exist_ok=True)
+            SOCKET_PATH.unlink(missing_ok=True)
+            umask = os.umask(0o077)  # only the owner may talk to the socket
+            try:
+                super().__init__(str(SOCKET_PATH), Handler)
+            finally:
+                os.umask(umask)
+
+        def refresh(self):
+            with self._lock:
+                self.requests += 1
+                mtime = config_mtime()
+                if mtime != self._config_mtime:
+                    config.reload()
+                    self._config_mtime = mtime
+
+        def status(self) -> dict:
+            return {
+                "pid": os.getpid(),
+                "started": self.started,
+                "requests": self.requests,
+                "templates": renderer.cached_template_count()
+            }
+
+    server = Server()
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"new daemon {os.getpid()} listening on {SOCKET_PATH}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        SOCKET_PATH.unlink(missing_ok=True)
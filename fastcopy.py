@@ -0,0 +1,55 @@
+import errno
+import os
+import shutil
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# ioctl request for cloning a whole file (btrfs, xfs, bcachefs, ...)
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# errors that only mean "this filesystem/kernel can't do that", never real I/O failures
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+def _reflink(fsrc, fdst) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+
+def _copy_file_range(fsrc, fdst) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+    copied = 0
+    while True:
+        try:
+            n = os.copy_file_range(src_fd, dst_fd, 1 << 30)
+        except OSError as e:
+            if copied == 0 and e.errno in _UNSUPPORTED:
+                return False
+            raise
+        if n == 0:
+            return True
+        copied += n
+
+def copy_file(src: Path, dst: Path) -> str:
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if _reflink(fsrc, fdst):
+            method = "reflink"
+        elif _copy_file_range(fsrc, fdst):
+            method = "copy_file_range"
+        else:
+            shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+            method = "copy"
+    shutil.copystat(src, dst)
+    return method
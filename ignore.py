@@ -0,0 +1,125 @@
+import os
+import re
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+IGNORE_FILE = ".newignore"
+
+def _translate(pattern: str) -> str:
+    # gitignore glob -> regex over a "/"-separated path relative to the source folder
+    parts = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i):
+                at_start = i == 0 or pattern[i - 1] == "/"
+                if at_start and pattern.startswith("**/", i):
+                    parts.append("(?:.*/)?")  # zero or more leading directories
+                    i += 3
+                    continue
+                if at_start and i + 2 == n:
+                    parts.append(".*")  # everything inside
+                    i += 2
+                    continue
+            parts.append("[^/]*")
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "[":
+            start = i + 2 if pattern[i + 1:i + 2] in ("!", "^") else i + 1
+            end = pattern.find("]", start + 1)  # a "]" right after the opening one is part of the class
+            if end == -1:
+                parts.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body[:1] in ("!", "^"):
+                    body = "^" + body[1:]
+                body = body.replace("\\", "\\\\").replace("[", "\\[")
+                parts.append(f"(?!/)[{body}]")
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return "".join(parts)
+
+class IgnoreRules:
+    # compiled once per build; the last matching pattern wins, "!" patterns re-include
+    def __init__(self, lines: List[str]) -> None:
+        self.patterns: List[Tuple[re.Pattern, bool, bool]] = []
+        for line in lines:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            # trailing spaces are dropped unless escaped with a backslash
+            stripped = line.rstrip(" ")
+            if stripped.endswith("\\") and len(stripped) < len(line):
+                stripped += " "
+            line = stripped
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith("\\!") or line.startswith("\\#"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            # a slash anywhere but at the end anchors the pattern to the source folder
+            anchored = "/" in line
+            line = line.lstrip("/")
+            regex = _translate(line)
+            if not anchored:
+                regex = "(?:.*/)?" + regex
+            self.patterns.append((re.compile(f"^{regex}$", re.DOTALL), negate, dir_only))
+        self.patterns.reverse()
+
+    @classmethod
+    def load(cls, source_path: Path) -> "IgnoreRules":
+        try:
+            with (source_path / IGNORE_FILE).open("r", encoding="utf-8") as f:
+                return cls(f.readlines())
+        except FileNotFoundError:
+            return cls([])
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+    def ignored(self, rel_path: str, is_dir: bool = False) -> bool:
+        for regex, negate, dir_only in self.patterns:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                return not negate
+        return False
+
+def walk_source(source_path: Path, rules: Optional[IgnoreRules] = None, on_ignore: Optional[Callable[[str, bool], None]] = None) -> Iterator[Tuple[str, List[str], List[str]]]:
+    # os.walk that never enters ignored directories and drops ignored files, like git does
+    if rules is None:
+        rules = IgnoreRules.load(source_path)
+    for root, dirs, files in os.walk(source_path):
+        rel_root = Path(root).relative_to(source_path).as_posix()
+        prefix = "" if rel_root == "." else f"{rel_root}/"
+        if prefix == "":
+            files = [name for name in files if name != IGNORE_FILE]
+        if rules:
+            kept = []
+            for name in dirs:
+                if rules.ignored(prefix + name, True):
+                    if on_ignore is not None:
+                        on_ignore(prefix + name, True)
+                else:
+                    kept.append(name)
+            dirs[:] = kept
+            kept = []
+            for name in files:
+                if rules.ignored(prefix + name):
+                    if on_ignore is not None:
+                        on_ignore(prefix + name, False)
+                else:
+                    kept.append(name)
+            files = kept
+        yield root, dirs, files
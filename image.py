@@ -1,14 +1,38 @@
+import shutil
 from pathlib import Path
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 from template_metadata import TemplateMetadata
-from packaging.version import Version, InvalidVersion
+from store import TEMPLATES_ROOT, PACK_SUFFIX
+import store
 
 def safe_version(v: str):
+    from packaging.version import Version, InvalidVersion
     try:
         return Version(v)
     except InvalidVersion:
         return Version("0.0.0")
 
+def is_version_range(version: str) -> bool:
+    return version[:1] in ("<", ">", "=", "!", "~") or "," in version
+
+def resolve_version(category: str, name: str, version_range: str = "") -> str:
+    from packaging.specifiers import SpecifierSet, InvalidSpecifier
+    ref = f"{category}/{name}" + (f":{version_range}" if version_range else "")
+    try:
+        specifier = SpecifierSet(version_range)
+    except InvalidSpecifier:
+        raise ValueError(f"Invalid version range in image reference: '{ref}'")
+
+    import image_index
+    versions = image_index.list_versions(category, name)
+    if not versions:
+        raise FileNotFoundError(f"No template found for: {ref}")
+
+    matching = [v for v in versions if specifier.contains(safe_version(v), prereleases=True)]
+    if not matching:
+        raise FileNotFoundError(f"No versions found for: {ref}")
+    return max(matching, key=safe_version)
+
 class TemplateImage:
     def __init__(self, category: str, name: str, version: str) -> None:
         self.category = category
@@ -23,6 +47,9 @@ class TemplateImage:
             if len(parts) != 2:
                 raise ValueError(f"Invalid image reference: '{ref}' (expected category/name)")
             category, name = parts
+            if is_version_range(version):
+                # e.g. project/python:>=3.10,<3.12 picks the newest cached match
+                return cls(category, name, resolve_version(category, name, version))
             return cls(category, name, version)
         
         if not allow_missing_version:
@@ -34,17 +61,7 @@ class TemplateImage:
             raise ValueError(f"Invalid image reference: '{ref}' (expected category/name)")
         category, name = parts
 
-        root = Path.home() / ".cache" / "new" / "templates" / category / name
-        if not root.exists():
-            raise FileNotFoundError(f"No template found for: {ref}")
-
-        versions = sorted([p.name for p in root.iterdir() if p.is_dir()], key=safe_version)
-        if not versions:
-            raise FileNotFoundError(f"No versions found for: {ref}")
-
-        print(versions)
-        latest_version = versions[-1]
-        return cls(category, name, latest_version)
+        return cls(category, name, resolve_version(category, name))
 
     def id(self) -> str:
         return f"{self.category}/{self.name}:{self.version}"
@@ -53,30 +70,52 @@ class TemplateImage:
         return self.id()
 
 def get_local_image_path(image: TemplateImage) -> Path:
-    return Path.home() / ".cache" / "new" / "templates" / image.category / image.name / image.version
+    return TEMPLATES_ROOT / image.category / image.name / image.version
 
-def load_local_template_image(image: TemplateImage) -> Tuple[TemplateMetadata, Path]:
+def get_packed_image_path(image: TemplateImage) -> Path:
+    return TEMPLATES_ROOT / image.category / image.name / f"{image.version}{PACK_SUFFIX}"
+
+def find_local_image(image: TemplateImage) -> Optional[Path]:
+    # the pack file of a packed version, the directory of a loose one
+    packed = get_packed_image_path(image)
+    if packed.is_file():
+        return packed
     path = get_local_image_path(image)
-    metadata_path = path / "template.json"
-    if not metadata_path.exists():
-        raise FileNotFoundError(f"No local template image found at {path}")
-    metadata = TemplateMetadata.load(metadata_path)
+    if (path / "template.json").exists():
+        return path
+    return None
+
+def load_local_template_image(image: TemplateImage, record_use: bool = True) -> Tuple[TemplateMetadata, Path]:
+    path = find_local_image(image)
+    if path is None:
+        raise FileNotFoundError(f"No local template image found at {get_local_image_path(image)}")
+    if record_use:
+        # last-used times decide what `new cache gc` evicts first
+        import image_index
+        image_index.touch(image)
+    if path.is_file():
+        from pack import load_pack_metadata
+        return load_pack_metadata(path), path
+    metadata = TemplateMetadata.load(path / "template.json")
     return metadata, path
 
 def list_local_images() -> List[TemplateImage]:
-    root = Path.home() / ".cache" / "new" / "templates"
-    found = []
-    if not root.exists():
-        return found
-    for category_dir in root.iterdir():
-        for name_dir in category_dir.iterdir():
-            for version_dir in name_dir.iterdir():
-                metadata_path = version_dir / "template.json"
-                if metadata_path.exists():
-                    found.append(TemplateImage(
-                        category=category_dir.name,
-                        name=name_dir.name,
-                        version=version_dir.name
-                    ))
-    return found
+    import image_index
+    return [
+        TemplateImage(category=category, name=name, version=version)
+        for category, name, version in image_index.list_images()
+    ]
 
+def remove_local_image(image: TemplateImage):
+    path = find_local_image(image)
+    if path is None:
+        raise FileNotFoundError(f"No local template image found at {get_local_image_path(image)}")
+    import image_index
+    if path.is_file():
+        path.unlink()
+    else:
+        files = store.load_manifest(path) or {}
+        shutil.rmtree(path)
+        store.release_blobs(files)
+    store.remove_archive(image.category, image.name, image.version)
+    image_index.remove(image)
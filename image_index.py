@@ -0,0 +1,186 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+from store import CACHE_ROOT, TEMPLATES_ROOT, PACK_SUFFIX
+
+INDEX_PATH = CACHE_ROOT / "index.db"
+# set by `new daemon`: (category, name) -> (folder mtime, versions), so lookups skip SQLite while nothing changed
+_memory: Optional[Dict[Tuple[str, str], Tuple[int, List[str]]]] = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    category TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    PRIMARY KEY (category, name, version)
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    category TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (category, name)
+);
+CREATE TABLE IF NOT EXISTS usage (
+    category TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (category, name, version)
+);
+"""
+
+@contextmanager
+def connect():
+    INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(INDEX_PATH, timeout=30)
+    try:
+        with conn:
+            conn.executescript(SCHEMA)
+            yield conn
+    finally:
+        conn.close()
+
+def _dir_path(category: str = "", name: str = ""):
+    path = TEMPLATES_ROOT
+    if category:
+        path = path / category
+    if name:
+        path = path / name
+    return path
+
+def _mtime(category: str = "", name: str = "") -> Optional[int]:
+    try:
+        return os.stat(_dir_path(category, name)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _stored_mtime(conn: sqlite3.Connection, category: str = "", name: str = "") -> Optional[int]:
+    row = conn.execute("SELECT mtime_ns FROM dirs WHERE category = ? AND name = ?", (category, name)).fetchone()
+    return row[0] if row else None
+
+def _record(conn: sqlite3.Connection, mtime: int, category: str = "", name: str = ""):
+    conn.execute("INSERT OR REPLACE INTO dirs (category, name, mtime_ns) VALUES (?, ?, ?)", (category, name, mtime))
+
+def _subdirs(category: str = "", name: str = "") -> List[str]:
+    with os.scandir(_dir_path(category, name)) as entries:
+        return [e.name for e in entries if e.is_dir() and not e.name.startswith(".")]
+
+def _versions(category: str, name: str) -> List[str]:
+    # loose versions are directories with a template.json, packed ones a single .pack file
+    path = _dir_path(category, name)
+    versions = []
+    with os.scandir(path) as entries:
+        for e in entries:
+            if e.name.startswith("."):
+                continue
+            if e.is_dir():
+                if (path / e.name / "template.json").exists():
+                    versions.append(e.name)
+            elif e.name.endswith(PACK_SUFFIX):
+                versions.append(e.name[:-len(PACK_SUFFIX)])
+    return versions
+
+def _forget(conn: sqlite3.Connection, category: str, name: Optional[str] = None):
+    if name is None:
+        conn.execute("DELETE FROM images WHERE category = ?", (category,))
+        conn.execute("DELETE FROM dirs WHERE category = ?", (category,))
+    else:
+        conn.execute("DELETE FROM images WHERE category = ? AND name = ?", (category, name))
+        conn.execute("DELETE FROM dirs WHERE category = ? AND name = ?", (category, name))
+
+def _scan_name(conn: sqlite3.Connection, category: str, name: str):
+    # stat before listing so a change during the scan invalidates the entry again
+    mtime = _mtime(category, name)
+    _forget(conn, category, name)
+    if mtime is None:
+        return
+    for version in _versions(category, name):
+        conn.execute("INSERT OR REPLACE INTO images (category, name, version) VALUES (?, ?, ?)", (category, name, version))
+    _record(conn, mtime, category, name)
+
+def _refresh_name(conn: sqlite3.Connection, category: str, name: str):
+    if _mtime(category, name) != _stored_mtime(conn, category, name):
+        _scan_name(conn, category, name)
+
+def _refresh(conn: sqlite3.Connection):
+    known = {row[0] for row in conn.execute("SELECT category FROM dirs WHERE category != '' AND name = ''")}
+    mtime = _mtime()
+    if mtime != _stored_mtime(conn):
+        categories = set(_subdirs()) if mtime is not None else set()
+        for category in known - categories:
+            _forget(conn, category)
+        if mtime is not None:
+            _record(conn, mtime)
+        else:
+            conn.execute("DELETE FROM dirs WHERE category = '' AND name = ''")
+    else:
+        categories = known
+
+    for category in categories:
+        known_names = {row[0] for row in conn.execute("SELECT name FROM dirs WHERE category = ? AND name != ''", (category,))}
+        mtime = _mtime(category)
+        if mtime != _stored_mtime(conn, category):
+            names = set(_subdirs(category)) if mtime is not None else set()
+            for name in known_names - names:
+                _forget(conn, category, name)
+            if mtime is not None:
+                _record(conn, mtime, category)
+        else:
+            names = known_names
+        for name in names:
+            _refresh_name(conn, category, name)
+
+def list_images() -> List[Tuple[str, str, str]]:
+    with connect() as conn:
+        _refresh(conn)
+        return conn.execute("SELECT category, name, version FROM images ORDER BY category, name, version").fetchall()
+
+def keep_in_memory():
+    global _memory
+    _memory = {}
+
+def list_versions(category: str, name: str) -> List[str]:
+    mtime = _mtime(category, name) if _memory is not None else None
+    if mtime is not None and _memory.get((category, name), (None,))[0] == mtime:
+        return list(_memory[(category, name)][1])
+    with connect() as conn:
+        _refresh_name(conn, category, name)
+        rows = conn.execute("SELECT version FROM images WHERE category = ? AND name = ?", (category, name)).fetchall()
+    versions = [row[0] for row in rows]
+    if mtime is not None:
+        _memory[(category, name)] = (mtime, versions)
+    return list(versions)
+
+def add(image):
+    with connect() as conn:
+        _scan_name(conn, image.category, image.name)
+
+def remove(image):
+    with connect() as conn:
+        conn.execute(
+            "DELETE FROM images WHERE category = ? AND name = ? AND version = ?",
+            (image.category, image.name, image.version)
+        )
+        conn.execute(
+            "DELETE FROM usage WHERE category = ? AND name = ? AND version = ?",
+            (image.category, image.name, image.version)
+        )
+        _scan_name(conn, image.category, image.name)
+
+def touch(image):
+    # usage rows live apart from images, so rescans of a template folder keep them
+    try:
+        with connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO usage (category, name, version, last_used) VALUES (?, ?, ?, ?)",
+                (image.category, image.name, image.version, time.time())
+            )
+    except sqlite3.OperationalError:
+        pass  # a read-only or busy cache still serves images, it just can't remember the use
+
+def last_used() -> Dict[Tuple[str, str, str], float]:
+    with connect() as conn:
+        rows = conn.execute("SELECT category, name, version, last_used FROM usage").fetchall()
+    return {(category, name, version): used for category, name, version, used in rows}
@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Dict, List
+
+# checked inline by hot paths; everything below is a no-op while this is False
+enabled = False
+
+_lock = threading.Lock()
+_phases: Dict[str, List[float]] = {}
+_counters: Dict[str, float] = {}
+_events: List[tuple] = []
+_NOOP = nullcontext()
+
+class _Phase:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.started, time.perf_counter())
+        return False
+
+def enable():
+    global enabled
+    enabled = True
+
+def phase(name: str):
+    if not enabled:
+        return _NOOP
+    return _Phase(name)
+
+def record(name: str, started: float, finished: float):
+    if not enabled:
+        return
+    with _lock:
+        totals = _phases.setdefault(name, [0.0, 0])
+        totals[0] += finished - started
+        totals[1] += 1
+        _events.append((name, started, finished, threading.get_ident()))
+
+def count(name: str, amount: float = 1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def phases() -> Dict[str, dict]:
+    with _lock:
+        return {name: {"total_ms": total * 1000, "calls": calls} for name, (total, calls) in _phases.items()}
+
+def counters() -> Dict[str, float]:
+    with _lock:
+        return dict(_counters)
+
+def write_trace(path: Path):
+    # Chrome trace event format, opens in chrome://tracing and Perfetto
+    with _lock:
+        origin = min((started for _, started, _, _ in _events), default=0.0)
+        events = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": (started - origin) * 1e6,
+                "dur": (finished - started) * 1e6,
+                "pid": os.getpid(),
+                "tid": tid,
+            }
+            for name, started, finished, tid in _events
+        ]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "phases": phases(), "counters": counters()}, f)
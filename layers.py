@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from image import TemplateImage, find_local_image, list_local_images
+from render_plan import RENDER_PLAN_FILE
+from store import LAYER_FILE, MANIFEST_FILE
+import store
+
+# bases of bases are followed this far before the chain is considered broken
+MAX_LAYERS = 32
+
+def load_layer(template_path: Path) -> Optional[dict]:
+    # {"base": "<category>/<name>:<version>", "removed": [...], "from_base": {path: sha256}}, or None for an image without a base
+    if template_path.is_file():
+        from pack import PackReader
+        with PackReader(template_path) as reader:
+            return reader.layer
+    layer_path = template_path / LAYER_FILE
+    if not layer_path.exists():
+        return None
+    with layer_path.open("r") as f:
+        return json.load(f)
+
+def save_layer(version_path: Path, base: TemplateImage, removed: List[str], from_base: Dict[str, str]):
+    with (version_path / LAYER_FILE).open("w") as f:
+        json.dump(layer_info(base, removed, from_base), f)
+
+def layer_info(base: TemplateImage, removed: List[str], from_base: Dict[str, str]) -> dict:
+    # from_base: the hash each file the image's render plan covers but leaves to the base had at build time
+    return {"base": base.id(), "removed": sorted(removed), "from_base": from_base}
+
+def layer_chain(template_path: Path) -> List[Tuple[Path, Optional[dict]]]:
+    # the image itself first, then its base, the base's base and so on
+    chain = []
+    seen = set()
+    path = template_path
+    while True:
+        if path in seen:
+            raise ValueError(f"Base images of {template_path} form a cycle")
+        seen.add(path)
+        layer = load_layer(path)
+        chain.append((path, layer))
+        if layer is None:
+            return chain
+        if len(chain) > MAX_LAYERS:
+            raise ValueError(f"More than {MAX_LAYERS} layers below {template_path}")
+        base = TemplateImage.parse(layer["base"])
+        path = find_local_image(base)
+        if path is None:
+            raise FileNotFoundError(f"Base image {base} is not in the local cache, pull or build it first")
+
+def base_images(image: TemplateImage) -> List[TemplateImage]:
+    # the images a local image is built on, nearest first; bases that are missing locally end the list
+    bases = []
+    path = find_local_image(image)
+    layer = load_layer(path) if path is not None else None
+    while layer is not None and len(bases) < MAX_LAYERS:
+        base = TemplateImage.parse(layer["base"])
+        bases.append(base)
+        path = find_local_image(base)
+        layer = load_layer(path) if path is not None else None
+    return bases
+
+def dependents(image: TemplateImage) -> List[TemplateImage]:
+    # cached images that use this one as their direct base
+    result = []
+    for other in list_local_images():
+        path = find_local_image(other)
+        layer = load_layer(path) if path is not None else None
+        if layer is not None and layer["base"] == image.id():
+            result.append(other)
+    return result
+
+def _layer_contents(template_path: Path) -> Tuple[Set[str], Dict[str, Tuple[str, bool]]]:
+    # directories and {relative path: (sha256, executable)} stored in a single layer
+    if template_path.is_file():
+        from pack import PackReader
+        files = {}
+        with PackReader(template_path) as reader:
+            for entry in reader.files:
+                with reader.data(entry) as data:
+                    files[entry[0]] = (hashlib.sha256(data).hexdigest(), bool(entry[3] & 0o111))
+            return set(reader.dirs), files
+
+    manifest = store.load_manifest(template_path) or {}
+    dirs = set()
+    files = {}
+    for root, _, names in os.walk(template_path):
+        rel_root = Path(root).relative_to(template_path)
+        if rel_root != Path("."):
+            dirs.add(rel_root.as_posix())
+        for name in names:
+            if name == "template.json":
+                continue
+            if name in (RENDER_PLAN_FILE, MANIFEST_FILE, LAYER_FILE) and rel_root == Path("."):
+                continue
+            rel_file = (rel_root / name).as_posix()
+            stored = manifest.get(rel_file)
+            if stored is not None:
+                files[rel_file] = (stored["hash"], bool(stored["mode"] & 0o111))
+            else:
+                path = Path(root) / name
+                files[rel_file] = (store.hash_file(path), bool(os.stat(path).st_mode & 0o111))
+    return dirs, files
+
+def merged_contents(template_path: Path) -> Tuple[Set[str], Dict[str, Tuple[str, bool]]]:
+    # what rendering the image sees: upper layers win, and removals hide everything below them
+    dirs = set()
+    files = {}
+    hidden = set()
+    for path, layer in layer_chain(template_path):
+        layer_dirs, layer_files = _layer_contents(path)
+        dirs.update(d for d in layer_dirs if d not in hidden)
+        for rel_file, value in layer_files.items():
+            if rel_file not in hidden:
+                files.setdefault(rel_file, value)
+        if layer is not None:
+            hidden.update(layer["removed"])
+    return dirs, files
@@ -1,44 +1,52 @@
+import time
+STARTED = time.perf_counter()
+
+# heavy modules (rich, requests, packaging, sqlite3) are imported by the commands that need them
 from config import config
-import remote
-from renderer import render_template
+CONFIG_LOADED = time.perf_counter()
 from image import TemplateImage, load_local_template_image
-from builder import build_template
 from pathlib import Path
 import os
+import shutil
+import sys
 import argparse
-import datetime
-import getpass
-import platform
-import socket
-import uuid
 from template_metadata import TemplateMetadata
+from output import info, success, warning, error, verbose, print_tree, prompt, format_size, print_table, open_in_editor
+import instrument
+
+HEAVY_MODULES = ("rich", "requests", "urllib3", "packaging", "sqlite3")
+# handed to a running `new daemon` instead of being run in this process
+FORWARDED_COMMANDS = ("create", "list")
+# left in every preview render so a later run knows it may replace the folder
+PREVIEW_MARKER = ".new-preview"
 
-from rich.tree import Tree
-from image import list_local_images
-from remote import list_remote_templates
-from output import info, success, warning, error, verbose, print_tree, prompt
+def build_template_tree(title: str, templates):
+    from rich.tree import Tree
+    tree = Tree(title)
+    grouped = {}
+    for t in templates:
+        grouped.setdefault(t.category, {}).setdefault(t.name, []).append(t.version)
+    for cat, names in sorted(grouped.items()):
+        cat_node = tree.add(f"[cyan]{cat}/[/cyan]")
+        for name, versions in sorted(names.items()):
+            name_node = cat_node.add(f"[white]{name}[/white]")
+            for version in sorted(versions, key=lambda v: v, reverse=True):
+                name_node.add(f"[dim]{version}[/dim]")
+    return tree
 
-def list_templates(origin: str):
+def list_templates(origin: str, refresh: bool = False, offline: bool = False):
     if origin in ("local", "all"):
+        from image import list_local_images
         templates = list_local_images()
         if not templates:
             warning("No local templates found")
         else:
-            tree = Tree("[bold green]Local Templates[/bold green]")
-            grouped = {}
-            for t in templates:
-                grouped.setdefault(t.category, {}).setdefault(t.name, []).append(t.version)
-            for cat, names in sorted(grouped.items()):
-                cat_node = tree.add(f"[cyan]{cat}/[/cyan]")
-                for name, versions in sorted(names.items()):
-                    name_node = cat_node.add(f"[white]{name}[/white]")
-                    for version in sorted(versions, key=lambda v: v, reverse=True):
-                        name_node.add(f"[dim]{version}[/dim]")
-            print_tree(tree)
+            print_tree(build_template_tree("[bold green]Local Templates[/bold green]", templates))
 
     if origin in ("remote", "all"):
+        from remote import list_remote_templates
         try:
-            templates = list_remote_templates(config.get_remote_url())
+            templates = list_remote_templates(config.get_remote_url(), refresh=refresh, offline=offline)
         except Exception as e:
             error(f"Failed to fetch remote templates: {e}")
             return
@@ -46,77 +54,286 @@ def list_templates(origin: str):
         if not templates:
             warning("No remote templates found")
         else:
-            tree = Tree("[bold blue]Remote Templates[/bold blue]")
-            grouped = {}
-            for t in templates:
-                grouped.setdefault(t.category, {}).setdefault(t.name, []).append(t.version)
-            for cat, names in sorted(grouped.items()):
-                cat_node = tree.add(f"[cyan]{cat}/[/cyan]")
-                for name, versions in sorted(names.items()):
-                    name_node = cat_node.add(f"[white]{name}[/white]")
-                    for version in sorted(versions, key=lambda v: v, reverse=True):
-                        name_node.add(f"[dim]{version}[/dim]")
-            print_tree(tree)
-
-def get_default_placeholders(project_name: str, template_name: str) -> dict:
-    now = datetime.datetime.now()
-    return {
-        "timestamp": now.strftime("%A, %d. %B %Y %I:%M%p"),
-        "date": now.strftime("%Y-%m-%d"),
-        "year": now.strftime("%Y"),
-        "month": now.strftime("%m"),
-        "day": now.strftime("%d"),
-        "weekday": now.strftime("%A"),
-        "time": now.strftime("%I:%M%p"),
-        "user": getpass.getuser(),
-        "hostname": socket.gethostname(),
-        "os": platform.system(),
-        "template_name": template_name,
-        "project_name": project_name,
-        "project_title": project_name.replace("-", " ").replace("_", " ").title(),
-        "uuid": str(uuid.uuid4()),
-    }
-
-def create_project(metadata: TemplateMetadata, template_path: Path, project_name: str, output_dir: Path):
-    target_path = output_dir / project_name
-    template = metadata.template()
-    default_placeholders = get_default_placeholders(project_name, template)
+            print_tree(build_template_tree("[bold blue]Remote Templates[/bold blue]", templates))
+
+def report_batch(results, requested: int, action: str, skip_reason: str):
+    failed = 0
+    for image, exc in results:
+        if exc is None:
+            success(f"{image}")
+        else:
+            failed += 1
+            error(f"Failed to {action} {image}: {exc}")
+    skipped = requested - len(results)
+    if skipped > 0:
+        info(f"Skipped {skipped} image(s) ({skip_reason})")
+    if failed:
+        error(f"{failed} of {len(results)} {action}(s) failed")
+    else:
+        success("Done.")
+
+def show_cache_stats():
+    from store import cache_stats
+    stats = cache_stats()
+    info(f"Versions: {stats['versions']} ({stats['unmanaged_versions']} stored as full copies)")
+    info(f"Files:    {stats['files']} referencing {stats['blobs']} unique blobs")
+    info(f"Logical:  {format_size(stats['logical_bytes'])}")
+    info(f"Stored:   {format_size(stats['blob_bytes'])}")
+    if stats['unmanaged_bytes']:
+        info(f"Full copies: {format_size(stats['unmanaged_bytes'])}")
+    if stats['archives']:
+        info(f"Served:   {stats['archives']} archive(s) in {format_size(stats['archive_bytes'])}")
+    if stats['packed_versions']:
+        info(f"Packed:   {stats['packed_versions']} version(s), {format_size(stats['packed_logical_bytes'])} in {format_size(stats['packed_bytes'])}")
+    max_size = config.get_cache_max_size()
+    if max_size:
+        info(f"Usage:    {format_size(stats['usage_bytes'])} of {format_size(max_size)} budget")
+    else:
+        info(f"Usage:    {format_size(stats['usage_bytes'])} (no cache_max_size set)")
+    deduplicated = stats['logical_bytes'] - stats['packed_logical_bytes']
+    if deduplicated:
+        ratio = stats['saved_bytes'] / deduplicated * 100
+        success(f"Deduplication saves {format_size(stats['saved_bytes'])} ({ratio:.1f}%)")
+
+def format_time(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+def run_cache_gc(max_size: int, keep_latest: int, dry_run: bool = False):
+    from cache_gc import collect_garbage
+    if not max_size:
+        info("No size budget (set 'cache_max_size' or pass --max-size), only removing unreferenced blobs")
+    report = collect_garbage(max_size, keep_latest, config.get_cache_pins(), dry_run=dry_run)
+    evicted = {version["image"].id() for version in report["evicted"]}
+
+    if dry_run:
+        rows = []
+        for version in report["versions"]:
+            image_id = version["image"].id()
+            if image_id in evicted:
+                action = "evict"
+            elif version["keep"] is not None:
+                action = f"keep ({version['keep']})"
+            else:
+                action = "keep"
+            rows.append((image_id, format_time(version["last_used"]), format_size(version["frees"]), action))
+        if rows:
+            print_table("Cached versions, least recently used first", ("Image", "Last used", "Frees", "Action"), rows)
+    else:
+        for version in report["evicted"]:
+            success(f"Evicted {version['image']} ({format_size(version['frees'])}, last used {format_time(version['last_used'])})")
+
+    prefix = "Would remove" if dry_run else "Removed"
+    if report["orphans"]:
+        info(f"{prefix} {report['orphans']} unreferenced blob(s) ({format_size(report['orphan_bytes'])})")
+    if report["stale_archive_bytes"]:
+        info(f"{prefix} {report['stale_archives']} served archive(s) of versions no longer cached ({format_size(report['stale_archive_bytes'])})")
+    if report["evicted"]:
+        info(f"{prefix} {len(report['evicted'])} version(s)")
+    budget = f" of {format_size(max_size)}" if max_size else ""
+    info(f"Usage: {format_size(report['usage_bytes'])} -> {format_size(report['remaining_bytes'])}{budget}")
+    if max_size and report["remaining_bytes"] > max_size:
+        warning("Still over budget: every remaining version is pinned, the base of another image or among the latest kept per template")
+
+def collect_replacements(metadata: TemplateMetadata, plan, project_name: str, answers: dict = None) -> dict:
+    # prompts for every custom placeholder, or takes the values from answers when given
+    from renderer import get_default_placeholders
+    default_placeholders = get_default_placeholders(project_name, metadata.template())
     placeholders = set(metadata.placeholders) | set(default_placeholders.keys())
+    if plan is not None and plan.covers(placeholders):
+        # only ask for placeholders that actually appear somewhere in the image
+        used = plan.used_placeholders()
+        placeholders = {p for p in placeholders if p in used or p in default_placeholders}
     replacements = {}
     for placeholder in placeholders:
-        if placeholder not in default_placeholders:
+        if answers is not None and placeholder in answers:
+            replacements[placeholder] = str(answers[placeholder])
+        elif placeholder in default_placeholders:
+            replacements[placeholder] = default_placeholders[placeholder]
+        elif answers is None:
             replacements[placeholder] = prompt(f"{placeholder}")
         else:
-            replacements[placeholder] = default_placeholders[placeholder]
+            raise ValueError(f"No value for placeholder '{placeholder}'")
+    return replacements
+
+def create_project(metadata: TemplateMetadata, template_path: Path, project_name: str, output_dir: Path, jobs: int = 1):
+    from renderer import render_template
+    from render_plan import load_render_plan
+    target_path = output_dir / project_name
+    plan = load_render_plan(template_path)
+    with instrument.phase("prompt"):
+        replacements = collect_replacements(metadata, plan, project_name)
 
-    render_template(template_path, target_path, replacements)
+    with instrument.phase("render"):
+        render_template(template_path, target_path, replacements, plan, jobs=jobs)
     success(f"Project created at: {target_path}")
 
     if config.get_open_main_file() and metadata.open:
-        editor = os.environ.get("EDITOR")
-        if editor:
-            file_to_open = target_path / metadata.open
-            info(f"Opening {file_to_open} in $EDITOR...")
-            os.system(f"{editor} {file_to_open}")
+        open_in_editor(target_path / metadata.open)
 
-def main():
+def sync_project(metadata: TemplateMetadata, template_path: Path, project_name: str, output_dir: Path, jobs: int = 1):
+    from renderer import sync_template
+    from render_plan import load_render_plan
+    target_path = output_dir / project_name
+    plan = load_render_plan(template_path)
+    with instrument.phase("prompt"):
+        replacements = collect_replacements(metadata, plan, project_name)
+
+    with instrument.phase("render"):
+        summary = sync_template(template_path, target_path, replacements, plan, jobs=jobs)
+    for status in ("created", "updated"):
+        for path in sorted(summary[status]):
+            info(f"{status.capitalize()}: {path.relative_to(target_path)}")
+    success(f"Project synced at: {target_path} ({len(summary['created'])} created, {len(summary['updated'])} updated, {len(summary['unchanged'])} unchanged)")
+
+def read_batch(batch_path: Path, metadata: TemplateMetadata, plan, output_dir: Path):
+    # one JSON object per line: "project_name" plus a value for every custom placeholder
+    import json
+    items = []
+    seen = set()
+    with batch_path.open("r") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            label = f"line {number}"
+            try:
+                answers = json.loads(line)
+                if not isinstance(answers, dict) or not isinstance(answers.get("project_name"), str):
+                    raise ValueError("expected an object with a 'project_name' string")
+                project_name = answers["project_name"]
+                label = project_name
+                if Path(project_name).name != project_name or project_name in (".", ".."):
+                    raise ValueError(f"Invalid project name '{project_name}'")
+                if project_name in seen:
+                    raise ValueError(f"Duplicate project name '{project_name}'")
+                seen.add(project_name)
+                replacements = collect_replacements(metadata, plan, project_name, answers)
+            except ValueError as e:
+                items.append((label, None, e))
+                continue
+            items.append((label, (output_dir / project_name, replacements), None))
+    return items
+
+def create_batch(metadata: TemplateMetadata, template_path: Path, batch_path: Path, output_dir: Path, jobs: int = 0):
+    from renderer import compile_template, render_batch
+    from render_plan import load_render_plan
+    plan = load_render_plan(template_path)
+    items = read_batch(batch_path, metadata, plan, output_dir)
+    # walked and planned once, every worker process renders from the same copy
+    with instrument.phase("render.walk"):
+        compiled = compile_template(template_path, plan)
+    work = [task for _, task, failure in items if failure is None]
+    info(f"Creating {len(work)} project(s) in {output_dir}...")
+    with instrument.phase("render"):
+        outcomes = iter(render_batch(compiled, work, jobs))
+    results = [(label, failure if failure is not None else next(outcomes)) for label, _, failure in items]
+    report_batch(results, len(results), "create", "")
+
+def render_preview(image: TemplateImage, preview_path: Path, jobs: int = 1, changed=None):
+    # changed: the image files a rebuild stored again or removed; only those are rendered again, None renders everything
+    from renderer import render_template, render_file, get_default_placeholders, compile_replacements
+    from render_plan import load_render_plan
+    metadata, template_path = load_local_template_image(image)
+    replacements = get_default_placeholders(preview_path.name, metadata.template())
+    for placeholder in metadata.placeholders:
+        replacements.setdefault(placeholder, placeholder)  # no prompts while watching
+    plan = load_render_plan(template_path)
+    if changed is not None and plan is not None and preview_path.exists() and template_path.is_dir():
+        replacer = compile_replacements(replacements)
+        use_plan = plan.covers(replacer.names)
+        for rel_file in sorted(changed):
+            dest_file_path = preview_path / replacer.apply(rel_file)
+            if rel_file not in plan.files:
+                dest_file_path.unlink(missing_ok=True)
+                continue
+            dest_file_path.parent.mkdir(parents=True, exist_ok=True)
+            render_file(template_path / rel_file, dest_file_path, replacer, plan.files[rel_file] if use_plan else None)
+        return
+    if preview_path.exists():
+        shutil.rmtree(preview_path)
+    render_template(template_path, preview_path, replacements, plan, jobs=jobs)
+    (preview_path / PREVIEW_MARKER).touch()
+
+def watch_template(image: TemplateImage, source_path: Path, preview: str = None, poll: bool = False, debounce: float = 0.2, verbose_output: bool = False, force: bool = False):
+    from builder import build_template
+    from watcher import open_watcher, watch_changes
+    from ignore import IGNORE_FILE, IgnoreRules
+    preview_path = Path(preview).resolve() if preview else None
+    if preview_path is not None:
+        if preview_path == source_path or source_path in preview_path.parents:
+            error("The preview folder must be outside the source folder")
+            return
+        if preview_path.exists() and any(preview_path.iterdir()) and not (preview_path / PREVIEW_MARKER).exists():
+            error(f"'{preview_path}' already exists and is not a preview folder")
+            return
+
+    built = False
+    # after a failed rebuild, the next one walks the whole source and renders the whole preview again
+    clean = False
+
+    def rebuild(changed=None):
+        nonlocal built, clean
+        started = time.perf_counter()
+        was_clean, clean = clean, False
+        try:
+            # once the first build went through, the image is the watcher's own to overwrite
+            updated = build_template(image=image, source_path=source_path, force=force or built, verbose=verbose_output, incremental=True, changed=changed if was_clean else None)
+            built = True
+            if preview_path is not None:
+                render_preview(image, preview_path, config.get_jobs(), updated if was_clean else None)
+        except Exception as e:
+            error(f"Rebuild failed: {e}")
+            return
+        clean = True
+        success(f"Rebuilt in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    rebuild()
+    try:
+        watcher = open_watcher(source_path, polling=poll, rules=IgnoreRules.load(source_path))
+    except OSError as e:
+        error(f"Failed to watch {source_path}: {e}")
+        return
+    info(f"Watching {source_path} ({watcher.method}), Ctrl+C to stop")
+    try:
+        for changed in watch_changes(watcher, debounce):
+            if verbose_output:
+                for path in sorted(changed):
+                    verbose(f"Changed: {path}")
+            if source_path / IGNORE_FILE in changed:
+                # the rebuild walks the whole source after this, so nothing missed in between is lost
+                watcher.reload(IgnoreRules.load(source_path))
+            rebuild({path.relative_to(source_path).as_posix() for path in changed})
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         prog='new',
         description='Create new projects or documents from template images',
         epilog='Example: new create project/python:3.10 my-app\\nMore information: https://github.com/m4sc0/new'
     )
+    parser.add_argument('--startup-profile', action='store_true', help='Print import and startup timings after the command')
+    parser.add_argument('--timings', action='store_true', help='Print time spent per phase and I/O counters after the command')
+    parser.add_argument('--trace-json', metavar='PATH', help='Write phase timings and counters to PATH (Chrome trace event format)')
+    parser.add_argument('--no-daemon', action='store_true', help='Run in this process even if `new daemon` is running')
     subparsers = parser.add_subparsers(dest='command', required=True)
 
     # create parser
     create_parser = subparsers.add_parser('create', help='Create a project from a template image')
     create_parser.add_argument('image', help="Template image (e.g. project/python:3.10)")
-    create_parser.add_argument('project_name', help="Target directory / project name")
+    create_parser.add_argument('project_name', nargs='?', help="Target directory / project name")
+    create_parser.add_argument('--batch', metavar='FILE', help="Create one project per line of a JSONL file with 'project_name' and placeholder values, without prompting")
     create_parser.add_argument('-o', '--output', required=False, help="Output directory (default: current)")
+    create_parser.add_argument('--sync', action='store_true', help="Re-apply the image to an existing project, writing only files whose output changed")
+    create_parser.add_argument('-j', '--jobs', type=int, required=False, help="Number of files rendered in parallel, or with --batch the number of worker processes rendering projects (default: 'jobs' from config, 0 = one per CPU)")
 
     # list parser
 
     list_parser = subparsers.add_parser('list', help='List local or remote templates')
     list_parser.add_argument('origin', choices=['local','remote','all'], default='local', const='local', nargs='?')
+    list_parser.add_argument('--refresh', action='store_true', help='Revalidate the cached remote catalog now instead of waiting for its TTL')
+    list_parser.add_argument('--offline', action='store_true', help='Only use the cached remote catalog, even if it is stale')
 
     # build parser
 
@@ -126,24 +343,123 @@ def main():
     build_parser.add_argument('-f', '--force', action='store_true', help='Overwrite if template exists already')
     build_parser.add_argument('-v', '--verbose', action='store_true', help='Show detailed output')
     build_parser.add_argument('--dry-run', action='store_true', help='Show what would happen without creating/modifying anything')
+    build_parser.add_argument('-i', '--incremental', action='store_true', help='Update an existing image in place, only storing files that changed since the last build')
+    build_parser.add_argument('--packed', action='store_true', default=None, help="Store the image as a single packed file (default: 'packed_images' from config)")
+    build_parser.add_argument('-w', '--watch', action='store_true', help='Keep running and rebuild incrementally whenever the source folder changes')
+    build_parser.add_argument('--preview', metavar='DIR', help='With --watch: render a preview project into DIR after every rebuild')
+    build_parser.add_argument('--poll', action='store_true', help='With --watch: poll for changes instead of using inotify')
+    build_parser.add_argument('--debounce', type=float, default=0.2, help='With --watch: seconds without events before rebuilding (default: 0.2)')
 
     # pull parser
 
-    pull_parser = subparsers.add_parser('pull', help='Pull a template image from remote')
-    pull_parser.add_argument('image', help='Template image (e.g. project/python:3.10)')
+    pull_parser = subparsers.add_parser('pull', help='Pull template images from remote')
+    pull_parser.add_argument('images', nargs='*', metavar='image', help='Template images (e.g. project/python:3.10)')
+    pull_parser.add_argument('--all', action='store_true', help='Mirror every image in the remote catalog')
+    pull_parser.add_argument('--category', action='append', help='Mirror every remote image in this category (repeatable)')
+    pull_parser.add_argument('-j', '--jobs', type=int, required=False, help="Parallel downloads (default: 'transfer_jobs' from config)")
+    pull_parser.add_argument('-f', '--force', action='store_true', help='Download again even if the version is cached')
     pull_parser.add_argument('-v', '--verbose', action='store_true', help='Verbose output')
+    pull_parser.add_argument('--no-delta', action='store_true', help='Always download the full archive, even if another version is cached')
+    pull_parser.add_argument('--packed', action='store_true', default=None, help="Store pulled images as single packed files (default: 'packed_images' from config)")
 
     # push parser
-    push_parser = subparsers.add_parser('push')
-    push_parser.add_argument('image')
+    push_parser = subparsers.add_parser('push', help='Push local template images to remote')
+    push_parser.add_argument('images', nargs='*', metavar='image', help='Template images (e.g. project/python:3.10)')
+    push_parser.add_argument('--all', action='store_true', help='Push every local image')
+    push_parser.add_argument('--category', action='append', help='Push every local image in this category (repeatable)')
+    push_parser.add_argument('-j', '--jobs', type=int, required=False, help="Parallel uploads (default: 'transfer_jobs' from config)")
+    push_parser.add_argument('-f', '--force', action='store_true', help='Upload even if the remote already has the version')
+    push_parser.add_argument('--compression', choices=['stored', 'deflate', 'bzip2', 'lzma'], help="Archive compression (default: 'upload_compression' from config)")
+    push_parser.add_argument('--level', type=int, help="Compression level (default: 'upload_compression_level' from config)")
     push_parser.add_argument('-v', '--verbose', action='store_true')
 
-    args = parser.parse_args()
+    # delete parser
+    delete_parser = subparsers.add_parser('delete', help='Delete a template image from the local cache')
+    delete_parser.add_argument('image', help='Template image (e.g. project/python:3.10)')
+
+    # serve parser
+    serve_parser = subparsers.add_parser('serve', help='Serve the local cache as a template registry')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1, use 0.0.0.0 for the LAN)')
+    serve_parser.add_argument('-p', '--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+    serve_parser.add_argument('-j', '--jobs', type=int, default=32, help='Worker threads handling connections (default: 32)')
+    serve_parser.add_argument('--token', help='Accept uploads authenticated with this token (read-only without it)')
+    serve_parser.add_argument('-v', '--verbose', action='store_true', help='Log every request')
+
+    # cache parser
+    cache_parser = subparsers.add_parser('cache', help='Inspect the local template cache')
+    cache_subparsers = cache_parser.add_subparsers(dest='cache_command', required=True)
+    cache_subparsers.add_parser('stats', help='Show how much space the deduplicated blob store saves')
+    gc_parser = cache_subparsers.add_parser('gc', help='Evict least recently used versions until the cache fits its size budget')
+    gc_parser.add_argument('--max-size', help="Size budget, e.g. 5G or 500M (default: 'cache_max_size' from config)")
+    gc_parser.add_argument('--keep-latest', type=int, help="Never evict the newest N versions of each template (default: 'cache_keep_latest' from config)")
+    gc_parser.add_argument('--dry-run', action='store_true', help='Report what would be evicted without deleting anything')
+    pin_parser = cache_subparsers.add_parser('pin', help='Never evict an image (category/name pins every version)')
+    pin_parser.add_argument('image', help='Template image (e.g. project/python:3.10 or project/python)')
+    unpin_parser = cache_subparsers.add_parser('unpin', help='Remove a pin again')
+    unpin_parser.add_argument('image', help='Template image as it was pinned')
+
+    # daemon parser
+    daemon_parser = subparsers.add_parser('daemon', help='Keep a warm background process that serves create and list')
+    daemon_parser.add_argument('action', choices=['start', 'stop', 'status', 'run'], help="'run' stays in the foreground (e.g. under systemd)")
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    parsed = time.perf_counter()
+    if args.command in FORWARDED_COMMANDS and not (args.no_daemon or args.timings or args.trace_json or args.startup_profile or getattr(args, 'batch', None)):
+        from daemon import forward
+        # a running daemon has everything imported and loaded already; without one the command runs here
+        if forward(sys.argv[1:]):
+            return
+
+    if args.timings or args.trace_json:
+        instrument.enable()
+        instrument.record("config", STARTED, CONFIG_LOADED)
+        instrument.record("startup", CONFIG_LOADED, parsed)
 
+    with instrument.phase(f"command.{args.command}"):
+        run_command(args)
+
+    if args.startup_profile:
+        print_startup_profile(parsed, time.perf_counter())
+    if args.timings:
+        print_timings()
+    if args.trace_json:
+        instrument.write_trace(Path(args.trace_json))
+        info(f"Trace written to {args.trace_json}")
+
+def print_startup_profile(parsed: float, finished: float):
+    # interpreter startup before main.py runs is not included, benchmarks/bench_startup.py measures that
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+    info(f"Imports:  {(parsed - STARTED) * 1000:7.1f} ms (main.py module level and argument parsing)")
+    info(f"Command:  {(finished - parsed) * 1000:7.1f} ms")
+    info(f"Total:    {(finished - STARTED) * 1000:7.1f} ms")
+    info(f"Modules:  {len(sys.modules)} loaded, heavy: {', '.join(heavy) or 'none'}")
+
+def format_counter(name: str, value: float) -> str:
+    if "bytes" in name:
+        return format_size(value)
+    if name.endswith("_ms"):
+        return f"{value:.1f} ms"
+    return f"{value:,.0f}"
+
+def print_timings():
+    # phases run on worker threads add up their own time, so they can exceed the command total
+    rows = [
+        (name, f"{stats['total_ms']:.1f}", str(stats['calls']))
+        for name, stats in instrument.phases().items()
+    ]
+    print_table("Timings", ("Phase", "Time (ms)", "Calls"), rows)
+    counters = instrument.counters()
+    if counters:
+        print_table("Counters", ("Counter", "Value"), [(name, format_counter(name, value)) for name, value in sorted(counters.items())])
+
+def run_command(args):
     # conditionals for subparsers
     if args.command == 'create':
         try:
-            image = TemplateImage.parse(args.image, config.get_allow_missing_version())
+            with instrument.phase("resolve"):
+                image = TemplateImage.parse(args.image, config.get_allow_missing_version())
         except ValueError as e:
             error(str(e))
             return
@@ -152,65 +468,196 @@ def main():
         project_name = args.project_name
 
         try:
-            metadata, template_path = load_local_template_image(image)
+            with instrument.phase("metadata"):
+                metadata, template_path = load_local_template_image(image)
         except Exception as e:
             error(f"Failed to load image {image}: {e}")
             return
         info(f"Using template '{image}' from: {template_path}")
         info(f"Placeholders: {metadata.placeholders}")
+        jobs = args.jobs if args.jobs is not None else config.get_jobs()
+        if args.batch:
+            if args.sync:
+                error("--sync can't be combined with --batch")
+                return
+            try:
+                create_batch(metadata, template_path, Path(args.batch), output_dir, jobs=jobs)
+            except OSError as e:
+                error(f"Failed to read batch file: {e}")
+            return
+        if not project_name:
+            error("A project name is required (or use --batch)")
+            return
+        if args.sync:
+            try:
+                sync_project(metadata, template_path, project_name, output_dir, jobs=jobs)
+            except OSError as e:
+                error(f"Failed to sync project: {e}")
+            return
         try:
-            create_project(metadata, template_path, project_name, output_dir)
+            create_project(metadata, template_path, project_name, output_dir, jobs=jobs)
         except FileExistsError:
             error(f"Project directory '{(output_dir / project_name)}' already exists.")
+        except OSError as e:
+            error(f"Failed to create project: {e}")
 
     elif args.command == 'list':
-        list_templates(args.origin)
+        list_templates(args.origin, refresh=args.refresh, offline=args.offline)
 
     elif args.command == 'build':
+        from builder import build_template
         try:
             image = TemplateImage.parse(args.image, config.get_allow_missing_version())
         except ValueError as e:
             error(str(e))
             return
         source_path = Path(args.source).resolve()
+        if args.watch:
+            watch_template(image, source_path, args.preview, args.poll, args.debounce, args.verbose, args.force)
+            return
         try:
             build_template(
                 image=image,
                 source_path=source_path,
                 force=args.force,
                 dry_run=args.dry_run,
-                verbose=args.verbose
+                verbose=args.verbose,
+                incremental=args.incremental,
+                packed=args.packed if args.packed is not None else config.get_packed_images()
             )
         except Exception as e:
             error(f"Failed to build image: {e}")
 
     elif args.command == 'pull':
-        from remote import pull_template
+        from remote import pull_templates, select_images, list_remote_templates, unique_images
+        remote_url = config.get_remote_url()
         try:
-            image = TemplateImage.parse(args.image, config.get_allow_missing_version())
-        except ValueError as e:
+            images = [TemplateImage.parse(ref, config.get_allow_missing_version()) for ref in args.images]
+            if args.all or args.category:
+                images += select_images(list_remote_templates(remote_url, refresh=True), None if args.all else args.category)
+        except Exception as e:
             error(str(e))
             return
+        if not images:
+            error("Nothing to pull: give image references, --all or --category")
+            return
+
+        images = unique_images(images)
+        jobs = args.jobs if args.jobs is not None else config.get_transfer_jobs()
+        info(f"Pulling {len(images)} image(s) from {remote_url}...")
+        packed = args.packed if args.packed is not None else config.get_packed_images()
+        results = pull_templates(remote_url, images, jobs=jobs, verbose=args.verbose, delta=not args.no_delta, force=args.force, packed=packed)
+        report_batch(results, len(images), "pull", "cached")
+
+    elif args.command == 'push':
+        from remote import upload_templates, select_images, unique_images
+        from image import list_local_images
         remote_url = config.get_remote_url()
         try:
-            info(f"Pulling {image} from {remote_url}...")
-            pull_template(remote_url, image, verbose=args.verbose)
-            success("Done.")
+            images = [TemplateImage.parse(ref, config.get_allow_missing_version()) for ref in args.images]
+            if args.all or args.category:
+                images += select_images(list_local_images(), None if args.all else args.category)
         except Exception as e:
-            error(f"Failed to pull image: {e}")
+            error(str(e))
+            return
+        if not images:
+            error("Nothing to push: give image references, --all or --category")
+            return
 
-    elif args.command == 'push':
-        from remote import upload_template
+        images = unique_images(images)
+        jobs = args.jobs if args.jobs is not None else config.get_transfer_jobs()
+        try:
+            results = upload_templates(
+                remote_url, images, jobs=jobs, verbose=args.verbose, force=args.force,
+                compression=args.compression, level=args.level
+            )
+        except Exception as e:
+            error(f"Upload failed: {e}")
+            return
+        report_batch(results, len(images), "upload", "already on remote")
+
+    elif args.command == 'delete':
+        from image import remove_local_image
+        from layers import dependents
         try:
             image = TemplateImage.parse(args.image, config.get_allow_missing_version())
-        except ValueError as e:
+            users = dependents(image)
+            if users:
+                error(f"{image} is the base of {', '.join(str(user) for user in users)}; delete those first")
+                return
+            remove_local_image(image)
+        except (ValueError, FileNotFoundError) as e:
             error(str(e))
             return
-        remote_url = config.get_remote_url()
+        success(f"Deleted {image}")
+
+    elif args.command == 'serve':
+        from server import serve
         try:
-            upload_template(remote_url, image, verbose=args.verbose)
-        except Exception as e:
-            error(f"Upload failed: {e}")
+            httpd = serve(args.host, args.port, workers=args.jobs, token=args.token, verbose=args.verbose)
+        except OSError as e:
+            error(f"Failed to listen on {args.host}:{args.port}: {e}")
+            return
+        info(f"Serving {args.host}:{httpd.server_port} ({'uploads enabled' if args.token else 'read-only'}), Ctrl+C to stop")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+
+    elif args.command == 'daemon':
+        import daemon
+        if args.action == 'run':
+            try:
+                daemon.run(run_command, build_parser())
+            except (OSError, RuntimeError) as e:
+                error(f"Failed to start daemon: {e}")
+        elif args.action == 'start':
+            try:
+                status = daemon.start()
+            except (OSError, RuntimeError) as e:
+                error(f"Failed to start daemon: {e}")
+                return
+            success(f"Daemon running (pid {status['pid']}) on {daemon.SOCKET_PATH}")
+        elif args.action == 'stop':
+            if daemon.stop():
+                success("Daemon stopped")
+            else:
+                warning("No daemon is running")
+        elif args.action == 'status':
+            status = daemon.status()
+            if status is None:
+                info("No daemon is running")
+                return
+            uptime = time.time() - status['started']
+            info(f"Daemon running (pid {status['pid']}) on {daemon.SOCKET_PATH}")
+            info(f"Up {uptime:.0f}s, {status['requests']} command(s) served, {status['templates']} compiled template(s) cached")
+
+    elif args.command == 'cache':
+        if args.cache_command == 'stats':
+            show_cache_stats()
+        elif args.cache_command == 'gc':
+            from config import parse_size
+            try:
+                max_size = parse_size(args.max_size) if args.max_size is not None else config.get_cache_max_size()
+            except ValueError as e:
+                error(str(e))
+                return
+            keep_latest = args.keep_latest if args.keep_latest is not None else config.get_cache_keep_latest()
+            run_cache_gc(max_size, keep_latest, dry_run=args.dry_run)
+        elif args.cache_command == 'pin':
+            parts = args.image.split(':', 1)[0].split('/')
+            if len(parts) != 2 or not all(parts):
+                error(f"Invalid image reference: '{args.image}' (expected category/name or category/name:version)")
+                return
+            config.add_cache_pin(args.image)
+            success(f"Pinned {args.image}")
+        elif args.cache_command == 'unpin':
+            if config.remove_cache_pin(args.image):
+                success(f"Unpinned {args.image}")
+            else:
+                warning(f"{args.image} is not pinned")
 
 if __name__ == "__main__":
     main()
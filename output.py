@@ -1,41 +1,105 @@
-from rich.console import Console
-from rich.panel import Panel
-from rich.text import Text
-from rich.prompt import Prompt
-from rich.prompt import Confirm
+import threading
+from contextlib import contextmanager
 
-console = Console()
+_console = None
+# set while the daemon runs a client's command on this thread
+_session = threading.local()
+
+def get_console():
+    console = getattr(_session, "console", None)
+    if console is not None:
+        return console
+    # rich is only imported once something is actually printed
+    global _console
+    if _console is None:
+        from rich.console import Console
+        _console = Console()
+    return _console
 
 def info(message: str):
-    console.print(f"[bold cyan][INFO][/bold cyan] {message}")
+    get_console().print(f"[bold cyan][INFO][/bold cyan] {message}")
 
 def success(message: str):
-    console.print(f"[bold green][SUCCESS][/bold green] {message}")
+    get_console().print(f"[bold green][SUCCESS][/bold green] {message}")
 
 def warning(message: str):
-    console.print(f"[bold yellow][WARNING][/bold yellow] {message}")
+    get_console().print(f"[bold yellow][WARNING][/bold yellow] {message}")
 
 def error(message: str):
-    console.print(f"[bold red][ERROR][/bold red] {message}")
+    get_console().print(f"[bold red][ERROR][/bold red] {message}")
 
 def rule(title: str = ""):
-    console.rule(title)
+    get_console().rule(title)
 
 def title(message: str):
-    console.print(Panel(Text(message, justify="center", style="bold magenta")))
+    from rich.panel import Panel
+    from rich.text import Text
+    get_console().print(Panel(Text(message, justify="center", style="bold magenta")))
+
+@contextmanager
+def redirect(console, ask=None, open_file=None):
+    # output, prompts and $EDITOR of the commands run inside go to console, ask and open_file instead
+    _session.console, _session.ask, _session.open_file = console, ask, open_file
+    try:
+        yield
+    finally:
+        _session.console = _session.ask = _session.open_file = None
 
 def prompt(message: str) -> str:
-    return Prompt.ask(f"[bold cyan]?[/bold cyan] {message}")
+    ask = getattr(_session, "ask", None)
+    if ask is not None:
+        return ask(message)
+    from rich.prompt import Prompt
+    return Prompt.ask(f"[bold cyan]?[/bold cyan] {message}", console=get_console())
 
 def confirm(message: str) -> bool:
-    return Confirm.ask(f"[bold yellow]?[/bold yellow] {message}")
+    from rich.prompt import Confirm
+    return Confirm.ask(f"[bold yellow]?[/bold yellow] {message}", console=get_console())
+
+def open_in_editor(path):
+    open_file = getattr(_session, "open_file", None)
+    if open_file is not None:
+        open_file(path)
+        return
+    import os
+    editor = os.environ.get("EDITOR")
+    if editor:
+        info(f"Opening {path} in $EDITOR...")
+        os.system(f"{editor} {path}")
+
+def transfer_progress():
+    from rich.progress import BarColumn, DownloadColumn, Progress, TextColumn, TimeRemainingColumn, TransferSpeedColumn
+    return Progress(
+        TextColumn("[bold cyan]{task.description}"),
+        BarColumn(),
+        DownloadColumn(),
+        TransferSpeedColumn(),
+        TimeRemainingColumn(),
+        console=get_console(),
+        transient=True
+    )
 
 def print_tree(tree):
-    console.print(tree)
+    get_console().print(tree)
 
 def print_raw(text: str):
-    console.print(text)
+    get_console().print(text)
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
 
 def verbose(message: str):
-    console.print(f"[dim]{message}[/dim]")
+    get_console().print(f"[dim]{message}[/dim]")
 
+def print_table(title: str, columns, rows):
+    from rich.table import Table
+    table = Table(title=title, title_justify="left")
+    for i, column in enumerate(columns):
+        table.add_column(column, justify="left" if i == 0 else "right")
+    for row in rows:
+        table.add_row(*row)
+    get_console().print(table)
@@ -0,0 +1,194 @@
+import json
+import mmap
+import os
+import struct
+import uuid
+from pathlib import Path
+from typing import List, Optional, Tuple
+from render_plan import RenderPlan, RENDER_PLAN_FILE
+from template_metadata import TemplateMetadata
+from renderer import is_binary, SNIFF_SIZE
+from store import LAYER_FILE, MANIFEST_FILE, PACK_SUFFIX
+
+# one file per version: MAGIC, the file contents back to back, a JSON index, then the footer
+MAGIC = b"NEWPACK1"
+# index offset, index length, MAGIC again so truncated files are caught
+FOOTER = struct.Struct("<QQ8s")
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def is_pack(path: Path) -> bool:
+    return path.suffix == PACK_SUFFIX and path.is_file()
+
+def pack_path(version_path: Path) -> Path:
+    return version_path.with_name(version_path.name + PACK_SUFFIX)
+
+class PackWriter:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        self._f = open(self._tmp, "wb")
+        self._f.write(MAGIC)
+        self.dirs: List[str] = []
+        # [relative path, offset, size, mode, binary]
+        self.files: List[list] = []
+
+    def add_dir(self, rel_path: str):
+        self.dirs.append(rel_path)
+
+    def add_stream(self, rel_path: str, f, mode: int, binary: Optional[bool] = None):
+        offset = self._f.tell()
+        prefix = f.read(SNIFF_SIZE)
+        self._f.write(prefix)
+        size = len(prefix)
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            self._f.write(chunk)
+            size += len(chunk)
+        if binary is None:
+            binary = is_binary(prefix, complete=size == len(prefix))
+        self.files.append([rel_path, offset, size, mode & 0o777, binary])
+
+    def add_file(self, rel_path: str, src: Path, binary: Optional[bool] = None):
+        with open(src, "rb") as f:
+            self.add_stream(rel_path, f, os.fstat(f.fileno()).st_mode, binary)
+
+    def close(self, metadata: dict, plan: Optional[RenderPlan] = None, layer: Optional[dict] = None):
+        index = json.dumps({
+            "metadata": metadata,
+            "plan": plan.dump() if plan is not None else None,
+            "layer": layer,
+            "dirs": self.dirs,
+            "files": self.files
+        }).encode("utf-8")
+        index_offset = self._f.tell()
+        self._f.write(index)
+        self._f.write(FOOTER.pack(index_offset, len(index), MAGIC))
+        self._f.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._f.close()
+        self._tmp.unlink(missing_ok=True)
+
+class PackReader:
+    # the whole pack is mapped once; file contents are served as slices of the mapping
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < len(MAGIC) + FOOTER.size or self._mmap[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"Not a template pack: {path}")
+        index_offset, index_length, magic = FOOTER.unpack_from(self._mmap, len(self._mmap) - FOOTER.size)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"Truncated template pack: {path}")
+        index = json.loads(self._mmap[index_offset:index_offset + index_length])
+        self.metadata_dict = index["metadata"]
+        self.plan = RenderPlan(**index["plan"]) if index.get("plan") is not None else None
+        self.layer: Optional[dict] = index.get("layer")
+        self.dirs: List[str] = index["dirs"]
+        self.files: List[list] = index["files"]
+        self._view = memoryview(self._mmap)
+
+    @property
+    def metadata(self) -> TemplateMetadata:
+        data = self.metadata_dict
+        return TemplateMetadata(
+            name=data.get("name"),
+            description=data.get("description"),
+            placeholders=data.get("placeholders", []),
+            open_file=data.get("open"),
+            category=data.get("category"),
+            version=data.get("version"),
+            base=data.get("base")
+        )
+
+    def data(self, entry: list) -> memoryview:
+        _, offset, size, _, _ = entry
+        return self._view[offset:offset + size]
+
+    def close(self):
+        if getattr(self, "_view", None) is not None:
+            self._view.release()
+            self._view = None
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_pack_metadata(path: Path) -> TemplateMetadata:
+    with PackReader(path) as reader:
+        return reader.metadata
+
+def pack_zip(zipf, path: Path):
+    # pulls write straight into a pack, the archive is never extracted
+    metadata = None
+    plan = None
+    layer = None
+    writer = PackWriter(path)
+    try:
+        if RENDER_PLAN_FILE in zipf.namelist():
+            plan = RenderPlan(**json.loads(zipf.read(RENDER_PLAN_FILE)))
+        for member in zipf.infolist():
+            rel_path = "/".join(p for p in member.filename.replace("\\", "/").split("/") if p not in ("", "."))
+            if not rel_path or ".." in rel_path.split("/"):
+                raise ValueError(f"Unsafe path in archive: {member.filename}")
+            if member.is_dir():
+                writer.add_dir(rel_path)
+                continue
+            if rel_path == "template.json":
+                metadata = json.loads(zipf.read(member))
+                continue
+            if rel_path == LAYER_FILE:
+                layer = json.loads(zipf.read(member))
+                continue
+            if rel_path in (RENDER_PLAN_FILE, MANIFEST_FILE):
+                continue
+            entry = plan.files.get(rel_path) if plan is not None else None
+            binary = entry["type"] == "binary" if entry is not None and entry.get("size") == member.file_size else None
+            mode = (member.external_attr >> 16) or 0o644
+            with zipf.open(member) as src:
+                writer.add_stream(rel_path, src, mode, binary)
+        if metadata is None:
+            raise ValueError("Archive has no template.json")
+        # directories that only show up as parents of files
+        known = set(writer.dirs)
+        for rel_path, *_ in writer.files:
+            parts = rel_path.split("/")[:-1]
+            for i in range(1, len(parts) + 1):
+                parent = "/".join(parts[:i])
+                if parent not in known:
+                    known.add(parent)
+                    writer.add_dir(parent)
+        writer.close(metadata, plan, layer)
+    except BaseException:
+        writer.abort()
+        raise
+
+def write_pack_zip(path: Path, zipf):
+    # the loose layout's archive, so registries and older clients can't tell the difference
+    from zipfile import ZipInfo
+    with PackReader(path) as reader:
+        zipf.writestr("template.json", json.dumps(reader.metadata_dict, indent=2))
+        if reader.plan is not None:
+            zipf.writestr(RENDER_PLAN_FILE, json.dumps(reader.plan.dump()))
+        if reader.layer is not None:
+            zipf.writestr(LAYER_FILE, json.dumps(reader.layer))
+        for rel_path in sorted(reader.dirs):
+            zipf.writestr(ZipInfo(rel_path + "/"), b"")
+        for entry in sorted(reader.files):
+            info = ZipInfo(entry[0])
+            info.external_attr = (0o100000 | entry[3]) << 16
+            info.compress_type = zipf.compression
+            with reader.data(entry) as data, zipf.open(info, "w", force_zip64=len(data) > 0x7fffffff) as dst:
+                for start in range(0, len(data), COPY_CHUNK_SIZE):
+                    dst.write(data[start:start + COPY_CHUNK_SIZE])
+
+def pack_stats(path: Path) -> Tuple[int, int]:
+    # (files, logical bytes) of a pack, for cache statistics
+    with PackReader(path) as reader:
+        return len(reader.files), sum(entry[2] for entry in reader.files)
@@ -1,40 +1,350 @@
 import requests
+import base64
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hashlib
+import shutil
+import json
+import os
+import time
 from pathlib import Path
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
 from io import BytesIO
-from image import TemplateImage, get_local_image_path
+from image import TemplateImage, get_local_image_path, get_packed_image_path, find_local_image, load_local_template_image, safe_version
 from template_metadata import TemplateMetadata
 from getpass import getpass
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from config import config
+from output import warning, transfer_progress
+import store
+import image_index
+import instrument
+
+CATALOG_CACHE_ROOT = store.CACHE_ROOT / "remote"
+HTTP_POOL_SIZE = 16
+
+_session = None
+_session_lock = threading.Lock()
+_base_locks: Dict[str, threading.Lock] = {}
+_base_locks_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    # one pooled session per process, so every call reuses its keep-alive connections
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=4,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset({"GET", "HEAD"}),
+                respect_retry_after_header=True
+            )
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.hooks["response"].append(_record_response)
+            _session = session
+        return _session
+
+def _record_response(response, *args, **kwargs):
+    # latency up to the response headers; body bytes are counted where they are read
+    if instrument.enabled:
+        finished = time.perf_counter()
+        instrument.record(f"http.{response.request.method}", finished - response.elapsed.total_seconds(), finished)
+        instrument.count("http.requests")
+
+@contextmanager
+def _progress_task(progress, description: str, total: Optional[int], completed: int = 0):
+    if progress is None:
+        with transfer_progress() as own:
+            yield own, own.add_task(description, total=total, completed=completed)
+        return
+    task = progress.add_task(description, total=total, completed=completed)
+    try:
+        yield progress, task
+    finally:
+        progress.remove_task(task)
+
+def _remote_id(remote_url: str) -> str:
+    return hashlib.sha256(remote_url.rstrip("/").encode("utf-8")).hexdigest()[:16]
+
+def _catalog_cache_path(remote_url: str, key: str) -> Path:
+    return CATALOG_CACHE_ROOT / _remote_id(remote_url) / f"{key}.json"
+
+def _load_cached(path: Path) -> Optional[dict]:
+    try:
+        with path.open("r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _save_cached(path: Path, entry: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with tmp.open("w") as f:
+        json.dump(entry, f)
+    os.replace(tmp, path)
+
+def invalidate_cached_json(remote_url: str, key: str):
+    _catalog_cache_path(remote_url, key).unlink(missing_ok=True)
+
+def get_cached_json(remote_url: str, path: str, key: str, refresh: bool = False, offline: bool = False):
+    cache_path = _catalog_cache_path(remote_url, key)
+    cached = _load_cached(cache_path)
+    offline = offline or config.get_offline()
+
+    if offline:
+        if cached is None:
+            raise Exception(f"Offline and no cached copy of {remote_url}{path}")
+        return cached["body"]
+
+    if cached is not None and not refresh and time.time() - cached["fetched_at"] < config.get_remote_cache_ttl():
+        return cached["body"]
+
+    headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        response = get_session().get(f"{remote_url}{path}", headers=headers, timeout=60)
+    except requests.RequestException as e:
+        if cached is None:
+            raise
+        warning(f"Remote unreachable ({e.__class__.__name__}), using cached data from {time.ctime(cached['fetched_at'])}")
+        return cached["body"]
+
+    if response.status_code == 304 and cached is not None:
+        cached["fetched_at"] = time.time()
+        _save_cached(cache_path, cached)
+        return cached["body"]
 
-def fetch_metadata(remote_url: str, image: TemplateImage) -> TemplateMetadata:
-    url = f"{remote_url}/meta/{image.category}/{image.name}/{image.version}"
-    response = requests.get(url)
     response.raise_for_status()
-    return TemplateMetadata(**response.json())
+    instrument.count("http.bytes_received", len(response.content))
+    body = response.json()
+    _save_cached(cache_path, {
+        "fetched_at": time.time(),
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "body": body
+    })
+    return body
 
-def pull_template(remote_url: str, image: TemplateImage, verbose: bool = False) -> Path:
-    url = f"{remote_url}/get/{image.category}/{image.name}/{image.version}"
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise Exception(f"Template '{image}' not found at remote: {remote_url}")
+def fetch_metadata(remote_url: str, image: TemplateImage, refresh: bool = False, offline: bool = False) -> TemplateMetadata:
+    path = f"/meta/{image.category}/{image.name}/{image.version}"
+    data = get_cached_json(remote_url, path, f"meta/{image.category}/{image.name}/{image.version}", refresh, offline)
+    return TemplateMetadata(**data)
+
+DOWNLOADS_ROOT = store.CACHE_ROOT / "downloads"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+
+def advertised_checksum(response) -> Optional[str]:
+    checksum = response.headers.get("X-Checksum-Sha256")
+    if checksum:
+        return checksum.strip().lower()
+    # RFC 3230: Digest: sha-256=<base64>
+    for part in response.headers.get("Digest", "").split(","):
+        algorithm, _, value = part.strip().partition("=")
+        if algorithm.lower() == "sha-256" and value:
+            return base64.b64decode(value).hex()
+    return None
+
+def download_archive(url: str, part_path: Path, description: str = "Downloading", progress=None) -> Optional[str]:
+    # resumable: a leftover .part file from an earlier attempt or run is continued with Range
+    part_path.parent.mkdir(parents=True, exist_ok=True)
+    state_path = part_path.with_name(part_path.name + ".json")
+    state = _load_cached(state_path) or {}
+    attempt = 0
+
+    while True:
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        # byte offsets must refer to the archive itself, not a compressed transfer of it
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if state.get("etag"):
+                headers["If-Range"] = state["etag"]  # start over if the archive changed meanwhile
+
+        try:
+            with get_session().get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 404:
+                    raise Exception(f"Archive not found: {url}")
+                if response.status_code == 416:
+                    # nothing left to send for this offset; the checksum decides if the file is whole
+                    return state.get("checksum")
+                response.raise_for_status()
+
+                if response.status_code != 206:
+                    offset = 0  # the server ignored the Range header
+                checksum = advertised_checksum(response) or (state.get("checksum") if offset else None)
+                state = {"etag": response.headers.get("ETag"), "checksum": checksum}
+                _save_cached(state_path, state)
+
+                length = response.headers.get("Content-Length")
+                total = offset + int(length) if length is not None else None
+                with open(part_path, "ab" if offset else "wb") as f, _progress_task(progress, description, total, offset) as (bar, task):
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        bar.update(task, advance=len(chunk))
+                        instrument.count("http.bytes_received", len(chunk))
+
+                if total is not None and part_path.stat().st_size != total:
+                    raise requests.ConnectionError(f"Connection closed after {part_path.stat().st_size} of {total} bytes")
+                return checksum
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            attempt += 1
+            if attempt > DOWNLOAD_RETRIES:
+                raise Exception(f"Download failed after {DOWNLOAD_RETRIES} retries: {e}")
+            time.sleep(min(2 ** attempt, 30))
+
+def verify_checksum(path: Path, checksum: Optional[str], image: TemplateImage, verbose: bool = False):
+    if checksum is None:
+        if verbose:
+            print("Remote did not advertise a checksum, skipping verification")
+        return
+    actual = store.hash_file(path)
+    if actual != checksum:
+        path.unlink()
+        raise ValueError(f"Checksum mismatch for '{image}': expected {checksum}, got {actual}")
+
+def find_delta_base(image: TemplateImage) -> Optional[Tuple[str, Dict[str, dict]]]:
+    # the newest other cached version of the same template that has a blob manifest
+    versions = image_index.list_versions(image.category, image.name)
+    for version in sorted(versions, key=safe_version, reverse=True):
+        if version == image.version:
+            continue
+        files = store.load_manifest(get_local_image_path(TemplateImage(image.category, image.name, version)))
+        if files:
+            return version, files
+    return None
+
+def download_delta(remote_url: str, image: TemplateImage, base_version: str, base_files: Dict[str, dict], part_path: Path, progress=None) -> bool:
+    url = f"{remote_url}/delta/{image.category}/{image.name}/{image.version}"
+    body = {"base": base_version, "files": {path: entry["hash"] for path, entry in base_files.items()}}
+    part_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with get_session().post(url, json=body, headers={"Accept-Encoding": "identity"}, stream=True, timeout=60) as response:
+        if response.status_code in (404, 405, 501):
+            return False  # registry without delta support
+        response.raise_for_status()
+        checksum = advertised_checksum(response)
+        length = response.headers.get("Content-Length")
+        total = int(length) if length is not None else None
+        with open(part_path, "wb") as f, _progress_task(progress, f"{image} (delta from {base_version})", total) as (bar, task):
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                bar.update(task, advance=len(chunk))
+                instrument.count("http.bytes_received", len(chunk))
 
+    verify_checksum(part_path, checksum, image)
+    return True
+
+def _base_lock(image: TemplateImage) -> threading.Lock:
+    with _base_locks_lock:
+        return _base_locks.setdefault(image.id(), threading.Lock())
+
+def pull_template(remote_url: str, image: TemplateImage, verbose: bool = False, delta: bool = True, progress=None, packed: bool = False) -> Path:
+    from layers import load_layer, MAX_LAYERS
+    # the same lock as for bases, so an image is never pulled twice at once when it's also another image's base
+    with _base_lock(image):
+        path = pull_image(remote_url, image, verbose, delta, progress, packed)
+    # a layered image is only usable on top of its base, which is pulled unless it is already cached
+    layer = load_layer(path)
+    for _ in range(MAX_LAYERS):
+        if layer is None:
+            break
+        base = TemplateImage.parse(layer["base"])
+        # images pulled side by side often share a base, it is fetched once
+        with _base_lock(base):
+            base_path = find_local_image(base)
+            if base_path is None:
+                if verbose:
+                    print(f"Pulling base image {base}")
+                base_path = pull_image(remote_url, base, verbose, delta, progress, packed)
+        layer = load_layer(base_path)
+    return path
+
+def pull_image(remote_url: str, image: TemplateImage, verbose: bool = False, delta: bool = True, progress=None, packed: bool = False) -> Path:
+    url = f"{remote_url}/get/{image.category}/{image.name}/{image.version}"
+    download_dir = DOWNLOADS_ROOT / _remote_id(remote_url)
+    part_path = download_dir / f"{image.category}-{image.name}-{image.version}.zip.part"
+    delta_path = download_dir / f"{image.category}-{image.name}-{image.version}.delta.zip.part"
     target_path = get_local_image_path(image)
+
+    # a delta only lists what is missing from the blob store, which packs don't use
+    base = find_delta_base(image) if delta and not packed else None
+    if base is not None:
+        base_version, base_files = base
+        if verbose:
+            print(f"Requesting delta against cached version {base_version}")
+        try:
+            if download_delta(remote_url, image, base_version, base_files, delta_path, progress):
+                return install_archive(delta_path, image, target_path, verbose)
+            if verbose:
+                print("Remote does not support delta pulls, falling back to a full pull")
+        # a delta is only an optimization: whatever goes wrong with it, /get may still work
+        except (requests.RequestException, ValueError, BadZipFile, FileNotFoundError) as e:
+            if verbose:
+                print(f"Delta pull failed ({e}), falling back to a full pull")
+        finally:
+            delta_path.unlink(missing_ok=True)
+
+    checksum = download_archive(url, part_path, description=str(image), progress=progress)
+    verify_checksum(part_path, checksum, image, verbose)
+    try:
+        if packed:
+            return install_pack(part_path, image, verbose)
+        return install_archive(part_path, image, target_path, verbose)
+    finally:
+        part_path.unlink(missing_ok=True)
+        part_path.with_name(part_path.name + ".json").unlink(missing_ok=True)
+
+def install_archive(archive_path: Path, image: TemplateImage, target_path: Path, verbose: bool = False) -> Path:
+    staging_path = store.create_staging_dir()
     if verbose:
-        print(f"Extracting to {target_path}")
+        print(f"Extracting to {staging_path}")
 
-    with ZipFile(BytesIO(response.content)) as zipf:
-        zipf.extractall(target_path)
+    try:
+        with ZipFile(archive_path) as zipf:
+            store.extract_zip(zipf, staging_path)
+        if verbose:
+            print(f"Installing to {target_path}")
+        store.install_staged(staging_path, target_path)
+    except BaseException:
+        shutil.rmtree(staging_path, ignore_errors=True)
+        raise
+    get_packed_image_path(image).unlink(missing_ok=True)
+    image_index.add(image)
 
     return target_path
 
-def list_remote_templates(remote_url: str) -> List[TemplateImage]:
-    url = f"{remote_url}/list"
-    response = requests.get(url)
-    response.raise_for_status()
+def install_pack(archive_path: Path, image: TemplateImage, verbose: bool = False) -> Path:
+    from pack import pack_zip
+    target_path = get_packed_image_path(image)
+    if verbose:
+        print(f"Packing into {target_path}")
+    # the pack is written next to its final name and renamed into place, like a staged directory
+    with ZipFile(archive_path) as zipf:
+        pack_zip(zipf, target_path)
+    loose_path = get_local_image_path(image)
+    if loose_path.exists():
+        old_files = store.load_manifest(loose_path) or {}
+        shutil.rmtree(loose_path)
+        store.release_blobs(old_files)
+    image_index.add(image)
+    return target_path
 
-    result = response.json()['result']
+def list_remote_templates(remote_url: str, refresh: bool = False, offline: bool = False) -> List[TemplateImage]:
+    result = get_cached_json(remote_url, "/list", "list", refresh, offline)['result']
 
     templates = []
 
@@ -47,49 +357,108 @@ def list_remote_templates(remote_url: str) -> List[TemplateImage]:
         templates.append(template)
 
     return templates
-def zip_template_folder(folder: Path) -> BytesIO:
-    buffer = BytesIO()
-    with ZipFile(buffer, "w") as zipf:
-        for path in folder.rglob("*"):
+COMPRESSION_METHODS = {
+    "stored": ZIP_STORED,
+    "deflate": ZIP_DEFLATED,
+    "bzip2": ZIP_BZIP2,
+    "lzma": ZIP_LZMA,
+}
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+def write_template_zip(folder: Path, fileobj, compression: str = "deflate", level: Optional[int] = None):
+    # works on unseekable streams too (zipfile then writes data descriptors)
+    if compression not in COMPRESSION_METHODS:
+        raise ValueError(f"Unknown compression '{compression}', expected one of: {', '.join(COMPRESSION_METHODS)}")
+    with ZipFile(fileobj, "w", compression=COMPRESSION_METHODS[compression], compresslevel=level) as zipf:
+        if folder.is_file():
+            from pack import write_pack_zip
+            write_pack_zip(folder, zipf)
+            return
+        for path in sorted(folder.rglob("*")):
             arcname = path.relative_to(folder)
             zipf.write(path, arcname)
+
+def zip_template_folder(folder: Path, compression: str = "deflate", level: Optional[int] = None) -> BytesIO:
+    buffer = BytesIO()
+    write_template_zip(folder, buffer, compression, level)
     buffer.seek(0)
     return buffer
 
-def upload_template(remote_url: str, image: TemplateImage, verbose: bool = False):
-    path = get_local_image_path(image)
-
-    if not path.exists():
-        raise FileNotFoundError(f"Template not found in local cache: {path}")
+def stream_template_zip(folder: Path, compression: str = "deflate", level: Optional[int] = None):
+    # a writer thread compresses into a pipe while the caller consumes chunks, so memory stays flat
+    read_fd, write_fd = os.pipe()
+    failure = []
 
-    metadata_path = path / "template.json"
-    if not metadata_path.exists():
-        raise FileNotFoundError(f"Missing template.json in: {path}")
+    def produce():
+        try:
+            with os.fdopen(write_fd, "wb") as pipe:
+                write_template_zip(folder, pipe, compression, level)
+        except BaseException as e:
+            failure.append(e)
 
-    metadata = TemplateMetadata.load(metadata_path)
+    writer = threading.Thread(target=produce, daemon=True)
+    writer.start()
+    with os.fdopen(read_fd, "rb") as pipe:
+        for chunk in iter(lambda: pipe.read(UPLOAD_CHUNK_SIZE), b""):
+            instrument.count("http.bytes_sent", len(chunk))
+            yield chunk
+    writer.join()
+    if failure:
+        raise failure[0]
 
-    zip_bytes = zip_template_folder(path)
+def stream_multipart(fields: Dict[str, str], file_field: str, filename: str, content_type: str, chunks, boundary: str):
+    for key, value in fields.items():
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{key}\"\r\n\r\n"
+            f"{value}\r\n"
+        ).encode("utf-8")
+    yield (
+        f"--{boundary}\r\n"
+        f"Content-Disposition: form-data; name=\"{file_field}\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8")
+    yield from chunks
+    yield f"\r\n--{boundary}--\r\n".encode("utf-8")
 
+def get_upload_token() -> str:
     token_valid, token_config = config.get_upload_token()
-
     if not token_valid:
-        token = getpass("Upload token: ")
-    else:
-        token = token_config
+        return getpass("Upload token: ")
+    return token_config
+
+def upload_template(remote_url: str, image: TemplateImage, verbose: bool = False, token: Optional[str] = None, compression: Optional[str] = None, level: Optional[int] = None):
+    metadata, path = load_local_template_image(image)
+
+    compression = compression or config.get_upload_compression()
+    level = level if level is not None else config.get_upload_compression_level()
+
+    if token is None:
+        token = get_upload_token()
 
     if verbose:
         print(f"Uploading {image} to {remote_url}...")
 
-    response = requests.post(
-        f"{remote_url}/upload",
-        headers={"Authorization": f"Bearer {token}"},
-        files={"file": ("template.zip", zip_bytes.getvalue(), "application/zip")},
-        data={
+    boundary = uuid.uuid4().hex
+    body = stream_multipart(
+        {
             "category": image.category,
             "name": image.name,
             "version": image.version,
             "description": metadata.description or "No description"
-        }
+        },
+        "file", "template.zip", "application/zip",
+        stream_template_zip(path, compression, level),
+        boundary
+    )
+    # a generator body is sent with chunked transfer encoding, nothing is buffered
+    response = get_session().post(
+        f"{remote_url}/upload",
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": f"multipart/form-data; boundary={boundary}"
+        },
+        data=body
     )
 
     if response.status_code == 200:
@@ -97,3 +466,64 @@ def upload_template(remote_url: str, image: TemplateImage, verbose: bool = False
     else:
         raise Exception(f"Upload failed: {response.status_code} - {response.text}")
 
+
+def run_batch(func, images: List[TemplateImage], jobs: int) -> List[Tuple[TemplateImage, Optional[Exception]]]:
+    # runs func(image) with bounded concurrency and reports every image, failed or not
+    def run(image):
+        try:
+            func(image)
+            return image, None
+        except Exception as e:
+            return image, e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(images) or 1))) as executor:
+        return list(executor.map(run, images))
+
+def select_images(images: List[TemplateImage], categories: Optional[List[str]] = None) -> List[TemplateImage]:
+    if categories:
+        images = [image for image in images if image.category in categories]
+    return sorted(images, key=lambda image: (image.category, image.name, safe_version(image.version)))
+
+def unique_images(images: List[TemplateImage]) -> List[TemplateImage]:
+    # the same image twice in one batch would download into the same .part file and staging target
+    seen = {}
+    for image in images:
+        seen.setdefault(image.id(), image)
+    return list(seen.values())
+
+def pull_templates(remote_url: str, images: List[TemplateImage], jobs: int = 4, verbose: bool = False, delta: bool = True, force: bool = False, packed: bool = False) -> List[Tuple[TemplateImage, Optional[Exception]]]:
+    images = unique_images(images)
+    if not force:
+        images = [image for image in images if find_local_image(image) is None]
+    with transfer_progress() as progress:
+        return run_batch(lambda image: pull_template(remote_url, image, verbose, delta, progress, packed), images, jobs)
+
+def upload_templates(remote_url: str, images: List[TemplateImage], jobs: int = 4, verbose: bool = False, force: bool = False, compression: Optional[str] = None, level: Optional[int] = None) -> List[Tuple[TemplateImage, Optional[Exception]]]:
+    from layers import base_images
+    images = unique_images(images)
+    published = None
+    if not force:
+        published = {image.id() for image in list_remote_templates(remote_url, refresh=True)}
+        images = [image for image in images if image.id() not in published]
+    # layered images are pushed together with every base the remote doesn't have yet
+    requested = {image.id() for image in images}
+    bases = {}
+    for image in images:
+        for base in base_images(image):
+            if base.id() not in requested:
+                bases.setdefault(base.id(), base)
+    if bases:
+        if published is None:
+            published = {image.id() for image in list_remote_templates(remote_url, refresh=True)}
+        images = [base for base_id, base in bases.items() if base_id not in published] + images
+    if not images:
+        return []
+    token = get_upload_token()
+    results = run_batch(lambda image: upload_template(remote_url, image, verbose, token, compression, level), images, jobs)
+    # the cached listing and metadata predate these uploads, the next read fetches them again
+    uploaded = [image for image, exc in results if exc is None]
+    if uploaded:
+        invalidate_cached_json(remote_url, "list")
+    for image in uploaded:
+        invalidate_cached_json(remote_url, f"meta/{image.category}/{image.name}/{image.version}")
+    return results
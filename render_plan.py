@@ -0,0 +1,73 @@
+from pathlib import Path
+import json
+from typing import Dict, Iterable, List, Optional, Set
+
+RENDER_PLAN_FILE = "render_plan.json"
+
+class RenderPlan:
+    def __init__(
+        self,
+        placeholders: Optional[List[str]] = None,
+        paths: Optional[Dict[str, List[str]]] = None,
+        files: Optional[Dict[str, dict]] = None
+    ) -> None:
+        # every placeholder name the plan was scanned for
+        self.placeholders = sorted(placeholders or [])
+        # relative paths whose file or directory name contains placeholders
+        self.paths = paths or {}
+        # relative file path -> {"type": "binary" | "static" | "template", "size": ..., "offsets": ...}
+        self.files = files or {}
+
+    @classmethod
+    def load(cls, path: Path) -> "RenderPlan":
+        if not path.exists():
+            raise FileNotFoundError(f"{RENDER_PLAN_FILE} not found: {path}")
+
+        with path.open("r") as f:
+            data = json.load(f)
+
+        return cls(
+            placeholders=data.get("placeholders", []),
+            paths=data.get("paths", {}),
+            files=data.get("files", {})
+        )
+
+    def add_path(self, rel_path: str, matcher):
+        used = sorted({m.group(1) for m in matcher.finditer(Path(rel_path).name)})
+        if used:
+            self.paths[rel_path] = used
+
+    def add_file(self, rel_path: str, entry: dict):
+        self.files[rel_path] = entry
+
+    def covers(self, names: Iterable[str]) -> bool:
+        return set(names) <= set(self.placeholders)
+
+    def used_placeholders(self) -> Set[str]:
+        used = set()
+        for names in self.paths.values():
+            used.update(names)
+        for entry in self.files.values():
+            used.update(entry.get("placeholders", []))
+        return used
+
+    def dump(self) -> dict:
+        return {
+            "placeholders": self.placeholders,
+            "paths": self.paths,
+            "files": self.files
+        }
+
+    def save(self, path: Path):
+        with path.open("w") as f:
+            json.dump(self.dump(), f)
+
+def load_render_plan(template_path: Path) -> Optional[RenderPlan]:
+    if template_path.is_file():
+        from pack import PackReader
+        with PackReader(template_path) as reader:
+            return reader.plan
+    plan_path = template_path / RENDER_PLAN_FILE
+    if not plan_path.exists():
+        return None
+    return RenderPlan.load(plan_path)
@@ -1,35 +1,668 @@
+import codecs
+import datetime
+import hashlib
+import getpass
 import os
+import platform
+import re
 import shutil
+import socket
+import stat
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from io import BytesIO
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from render_plan import RenderPlan, RENDER_PLAN_FILE
+from fastcopy import copy_file
+from store import LAYER_FILE, MANIFEST_FILE, hash_file, load_manifest
+import instrument
 
-def apply_replacements(text: str, replacements: Dict[str, str]) -> str:
-    for key, value in replacements.items():
-        text = text.replace(f"{{{{{key}}}}}", value)
-    return text
+# set by `new daemon` for the command it runs on this thread: the client's USER, LOGNAME and TZ
+_client = threading.local()
 
-def render_template(template_path: Path, target_path: Path, replacements: Dict[str, str]):
+@contextmanager
+def client_environment(env: Optional[Dict[str, str]]):
+    _client.env = env
+    try:
+        yield
+    finally:
+        _client.env = None
+
+def _now() -> datetime.datetime:
+    # a client's zone is applied to this datetime only; TZ and tzset() would change it for every thread
+    env = getattr(_client, "env", None)
+    if env is None or not env.get("TZ"):
+        return datetime.datetime.now()
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    try:
+        return datetime.datetime.now(ZoneInfo(env["TZ"].lstrip(":")))
+    except (ZoneInfoNotFoundError, ValueError):
+        return datetime.datetime.now()
+
+def _user() -> str:
+    env = getattr(_client, "env", None)
+    if env is None:
+        return getpass.getuser()
+    # the order getpass.getuser() checks them in, with the account name behind the uid as the last resort
+    for name in ("LOGNAME", "USER", "LNAME", "USERNAME"):
+        if env.get(name):
+            return env[name]
+    import pwd
+    return pwd.getpwuid(os.getuid()).pw_name
+
+def get_default_placeholders(project_name: str, template_name: str) -> dict:
+    now = _now()
+    return {
+        "timestamp": now.strftime("%A, %d. %B %Y %I:%M%p"),
+        "date": now.strftime("%Y-%m-%d"),
+        "year": now.strftime("%Y"),
+        "month": now.strftime("%m"),
+        "day": now.strftime("%d"),
+        "weekday": now.strftime("%A"),
+        "time": now.strftime("%I:%M%p"),
+        "user": _user(),
+        "hostname": socket.gethostname(),
+        "os": platform.system(),
+        "template_name": template_name,
+        "project_name": project_name,
+        "project_title": project_name.replace("-", " ").replace("_", " ").title(),
+        "uuid": str(uuid.uuid4()),
+    }
+
+# files are rendered in chunks of this size so memory stays flat for huge files
+CHUNK_SIZE = 1024 * 1024
+# binary detection only looks at this many leading bytes
+SNIFF_SIZE = 8192
+
+def default_placeholder_names() -> List[str]:
+    return list(get_default_placeholders("", "").keys())
+
+class PlaceholderMatcher:
+    def __init__(self, names: Iterable[str]) -> None:
+        # longest names first so overlapping alternatives resolve the same way everywhere
+        self.names = sorted(set(names), key=lambda n: (-len(n), n))
+        if self.names:
+            alternatives = "|".join(re.escape(name) for name in self.names)
+            self.pattern = re.compile(r"\{\{(" + alternatives + r")\}\}")
+            byte_alternatives = b"|".join(re.escape(name.encode("utf-8")) for name in self.names)
+            self.bytes_pattern = re.compile(rb"\{\{(" + byte_alternatives + rb")\}\}")
+            self.max_token_length = max(len(name.encode("utf-8")) for name in self.names) + 4
+        else:
+            self.pattern = None
+            self.bytes_pattern = None
+            self.max_token_length = 0
+
+    def finditer(self, text: str):
+        if self.pattern is None:
+            return iter(())
+        return self.pattern.finditer(text)
+
+    def finditer_bytes(self, data: bytes):
+        if self.bytes_pattern is None:
+            return iter(())
+        return self.bytes_pattern.finditer(data)
+
+    def iter_segments(self, f, chunk_size: int = CHUNK_SIZE):
+        # yields (data, name, offset): literal runs with name None, placeholders with their name
+        keep = max(self.max_token_length - 1, 0)
+        buffer = b""
+        base = 0
+        while True:
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer + chunk if buffer else chunk
+            if self.bytes_pattern is None:
+                if chunk:
+                    yield chunk, None, base
+                    base += len(chunk)
+                if eof:
+                    return
+                buffer = b""
+                continue
+
+            # a placeholder starting before the cutoff always ends inside the buffer
+            cutoff = len(buffer) if eof else len(buffer) - keep
+            pos = 0
+            if cutoff > 0:
+                for match in self.bytes_pattern.finditer(buffer):
+                    if match.start() >= cutoff:
+                        break
+                    if match.start() > pos:
+                        yield buffer[pos:match.start()], None, base + pos
+                    yield match.group(0), match.group(1), base + match.start()
+                    pos = match.end()
+                if pos < cutoff:
+                    yield buffer[pos:cutoff], None, base + pos
+                    pos = cutoff
+            if eof:
+                return
+            buffer = buffer[pos:]
+            base += pos
+
+class Replacer(PlaceholderMatcher):
+    def __init__(self, replacements: Dict[str, str]) -> None:
+        super().__init__(replacements.keys())
+        self.replacements = dict(replacements)
+        self.encoded = {k.encode("utf-8"): v.encode("utf-8") for k, v in self.replacements.items()}
+
+    def _substitute(self, match) -> str:
+        return self.replacements[match.group(1)]
+
+    def _substitute_bytes(self, match) -> bytes:
+        return self.encoded[match.group(1)]
+
+    def apply(self, text: str) -> str:
+        if self.pattern is None or "{{" not in text:
+            return text
+        return self.pattern.sub(self._substitute, text)
+
+    def apply_bytes(self, data: bytes) -> bytes:
+        if self.bytes_pattern is None or b"{{" not in data:
+            return data
+        return self.bytes_pattern.sub(self._substitute_bytes, data)
+
+    def stream(self, src, dst, chunk_size: int = CHUNK_SIZE) -> int:
+        replaced = 0
+        for data, name, _ in self.iter_segments(src, chunk_size):
+            if name is None:
+                dst.write(data)
+            else:
+                dst.write(self.encoded[name])
+                replaced += 1
+        return replaced
+
+    def splice_stream(self, src, dst, offsets: List[list], chunk_size: int = CHUNK_SIZE) -> int:
+        replaced = 0
+        pos = 0
+        for start, end, name in offsets:
+            value = self.encoded.get(name.encode("utf-8"))
+            if value is None:
+                continue
+            copy_range(src, dst, start - pos, chunk_size)
+            if src.read(end - start) != b"{{" + name.encode("utf-8") + b"}}":
+                # edited in place at the same size: the offsets are stale, so the file is scanned after all
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+                return self.stream(src, dst, chunk_size)
+            dst.write(value)
+            pos = end
+            replaced += 1
+        shutil.copyfileobj(src, dst, chunk_size)
+        return replaced
+
+def copy_range(src, dst, length: int, chunk_size: int = CHUNK_SIZE):
+    while length > 0:
+        data = src.read(min(chunk_size, length))
+        if not data:
+            break
+        dst.write(data)
+        length -= len(data)
+
+def is_binary(prefix: bytes, complete: bool = False) -> bool:
+    # a multi-byte character may be cut off at the end of an incomplete prefix
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(prefix, final=complete)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+def sniff_binary(f) -> bool:
+    prefix = f.read(SNIFF_SIZE)
+    f.seek(0)
+    return is_binary(prefix, complete=len(prefix) < SNIFF_SIZE)
+
+def scan_file(src_file: Path, matcher: PlaceholderMatcher) -> dict:
+    with open(src_file, "rb") as f:
+        entry = {"size": os.fstat(f.fileno()).st_size}
+        if sniff_binary(f):
+            entry["type"] = "binary"
+            return entry
+
+        offsets = [
+            [offset, offset + len(data), name.decode("utf-8")]
+            for data, name, offset in matcher.iter_segments(f)
+            if name is not None
+        ]
+
+    if offsets:
+        entry["type"] = "template"
+        entry["placeholders"] = sorted({name for _, _, name in offsets})
+        entry["offsets"] = offsets
+    else:
+        entry["type"] = "static"
+    return entry
+
+def compile_replacements(replacements: Union[Dict[str, str], Replacer]) -> Replacer:
+    if isinstance(replacements, Replacer):
+        return replacements
+    return Replacer(replacements)
+
+def apply_replacements(text: str, replacements: Union[Dict[str, str], Replacer]) -> str:
+    return compile_replacements(replacements).apply(text)
+
+def render_file(src_file: Path, dest_file_path: Path, replacer: Replacer, entry: Optional[dict] = None, stored: Optional[dict] = None):
+    # stored: the file's manifest entry, whose mode and mtime win over those of the shared blob
+    if not instrument.enabled:
+        _render_file(src_file, dest_file_path, replacer, entry, stored)
+        return
+    started = time.perf_counter()
+    kind, replaced = _render_file(src_file, dest_file_path, replacer, entry, stored)
+    _record_render(kind, replaced, started, os.stat(src_file).st_size, dest_file_path)
+
+def _record_render(kind: str, replaced: int, started: float, bytes_read: int, dest_file_path: Path):
+    instrument.record(f"render.{kind}", started, time.perf_counter())
+    instrument.count("render.files")
+    instrument.count(f"render.{kind}_files")
+    instrument.count("render.bytes_read", bytes_read)
+    instrument.count("render.bytes_written", os.stat(dest_file_path).st_size)
+    instrument.count("render.replacements", replaced)
+
+def _copy_stored(src_file: Path, dest_file_path: Path, stored: Optional[dict]):
+    copy_file(src_file, dest_file_path)
+    if stored is not None:
+        os.chmod(dest_file_path, stored["mode"])
+        if "mtime" in stored:
+            os.utime(dest_file_path, ns=(stored["mtime"], stored["mtime"]))
+
+def _render_file(src_file: Path, dest_file_path: Path, replacer: Replacer, entry: Optional[dict] = None, stored: Optional[dict] = None) -> Tuple[str, int]:
+    # returns how the file was written and how many placeholders were replaced
+    if entry is not None and entry.get("size") != src_file.stat().st_size:
+        entry = None  # the image changed since the plan was written
+
+    if entry is not None and entry["type"] in ("binary", "static"):
+        _copy_stored(src_file, dest_file_path, stored)
+        return entry["type"], 0
+
+    if entry is None:
+        with open(src_file, "rb") as src:
+            binary = sniff_binary(src)
+        if binary:
+            _copy_stored(src_file, dest_file_path, stored)
+            return "binary", 0
+
+    with open(src_file, "rb") as src:
+        with open(dest_file_path, "wb") as dst:
+            if entry is not None:
+                replaced = replacer.splice_stream(src, dst, entry["offsets"])
+            else:
+                replaced = replacer.stream(src, dst)
+    if stored is not None:
+        os.chmod(dest_file_path, stored["mode"])
+    else:
+        shutil.copymode(src_file, dest_file_path)
+    return ("splice" if entry is not None else "stream"), replaced
+
+def sync_output(dest_file_path: Path, size: int, digest, mode: int, write) -> str:
+    # the project's file is only replaced when its size, hash or mode differs, so untouched files keep their mtime.
+    # digest() is only called when the sizes match; write(path) puts the new content at path
+    try:
+        st = os.stat(dest_file_path)
+    except FileNotFoundError:
+        st = None
+    if st is not None and st.st_size == size and hash_file(dest_file_path) == digest():
+        if stat.S_IMODE(st.st_mode) == mode:
+            return "unchanged"
+        os.chmod(dest_file_path, mode)
+        return "updated"
+    tmp = dest_file_path.with_name(f".{dest_file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        write(tmp)
+        os.chmod(tmp, mode)
+        os.replace(tmp, dest_file_path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return "created" if st is None else "updated"
+
+def sync_content(dest_file_path: Path, content: bytes, mode: int) -> str:
+    return sync_output(dest_file_path, len(content), lambda: hashlib.sha256(content).hexdigest(), mode, lambda path: path.write_bytes(content))
+
+def _copy_for_sync(src_file: Path, path: Path):
+    copy_file(src_file, path)
+    os.utime(path)  # a replaced project file is new to the project's build tools, whatever the image's mtime
+
+def sync_file(src_file: Path, dest_file_path: Path, replacer: Replacer, entry: Optional[dict] = None, stored: Optional[dict] = None) -> Tuple[Path, str]:
+    # templated text is rendered into memory and compared; binary and static files are compared by hash and copied
+    st = os.stat(src_file)
+    mode = stored["mode"] if stored is not None else stat.S_IMODE(st.st_mode)
+    if entry is not None and entry.get("size") != st.st_size:
+        entry = None
+    with open(src_file, "rb") as src:
+        copy = (entry is not None and entry["type"] in ("binary", "static")) or (entry is None and sniff_binary(src))
+        if not copy:
+            buffer = BytesIO()
+            if entry is not None:
+                replacer.splice_stream(src, buffer, entry["offsets"])
+            else:
+                replacer.stream(src, buffer)
+    if copy:
+        status = sync_output(dest_file_path, st.st_size, lambda: hash_file(src_file), mode, partial(_copy_for_sync, src_file))
+    else:
+        status = sync_content(dest_file_path, buffer.getvalue(), mode)
+    instrument.count(f"sync.{status}_files")
+    return dest_file_path, status
+
+class CompiledTemplate:
+    # the template walk done once, so any number of projects can be rendered from it
+    def __init__(self, template_path: Path, plan: Optional[RenderPlan] = None) -> None:
+        self.template_path = template_path
+        self.plan = plan
+        # relative path -> manifest entry, for the mode and mtime each file had in the source
+        self.stored: Dict[str, dict] = load_manifest(template_path) or {}
+        self.directories: List[str] = []
+        self.files: List[Tuple[str, str, Optional[dict]]] = []
+        for root, dirs, files in os.walk(template_path):
+            rel_path = Path(root).relative_to(template_path)
+            self.directories.append(str(rel_path))
+
+            for file in files:
+                if file == "template.json":
+                    continue
+                if file in (RENDER_PLAN_FILE, MANIFEST_FILE, LAYER_FILE) and rel_path == Path("."):
+                    continue
+
+                entry = plan.files.get((rel_path / file).as_posix()) if plan is not None else None
+                self.files.append((str(rel_path), file, entry))
+
+    def tasks(self, target_path: Path, replacer: Replacer) -> Tuple[List[Path], List[tuple]]:
+        # a plan scanned for other placeholders is useless, every file is scanned instead
+        use_plan = self.plan is not None and self.plan.covers(replacer.names)
+        directories = [target_path / replacer.apply(rel_path) for rel_path in self.directories]
+        tasks = [
+            (
+                self.template_path / rel_path / file,
+                target_path / replacer.apply(rel_path) / replacer.apply(file),
+                entry if use_plan else None,
+                self.stored.get((Path(rel_path) / file).as_posix())
+            )
+            for rel_path, file, entry in self.files
+        ]
+        return directories, tasks
+
+    def render(self, target_path: Path, replacements: Union[Dict[str, str], Replacer], jobs: int = 1, sync: bool = False):
+        if target_path.exists() and not sync:
+            raise FileExistsError(f"Target folder '{target_path}' already exists.")
+
+        replacer = compile_replacements(replacements)
+        directories, tasks = self.tasks(target_path, replacer)
+        with instrument.phase("render.mkdir"):
+            for directory in directories:
+                os.makedirs(directory, exist_ok=True)
+        write = sync_file if sync else render_file
+        return run_render_tasks(lambda src_file, dest_file_path, entry, stored: write(src_file, dest_file_path, replacer, entry, stored), tasks, jobs)
+
+class _ViewReader:
+    # just enough of a file over a memoryview for the streaming replacer
+    def __init__(self, view: memoryview) -> None:
+        self.view = view
+        self.pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.view) if size < 0 else min(self.pos + size, len(self.view))
+        data = bytes(self.view[self.pos:end])
+        self.pos = end
+        return data
+
+    def seek(self, pos: int):
+        self.pos = pos
+
+def render_packed_file(reader, replacer: Replacer, file_entry: list, dest_file_path: Path, entry: Optional[dict] = None):
+    if not instrument.enabled:
+        _render_packed_file(reader, file_entry, dest_file_path, entry, replacer)
+        return
+    started = time.perf_counter()
+    kind, replaced = _render_packed_file(reader, file_entry, dest_file_path, entry, replacer)
+    _record_render(kind, replaced, started, file_entry[2], dest_file_path)
+
+def _render_packed_file(reader, file_entry: list, dest_file_path: Path, entry: Optional[dict], replacer: Replacer) -> Tuple[str, int]:
+    _, _, size, mode, binary = file_entry
+    if entry is not None and entry.get("size") != size:
+        entry = None
+    kind, replaced = "binary", 0
+    with reader.data(file_entry) as data, open(dest_file_path, "wb") as dst:
+        if not binary and entry is not None and entry["type"] in ("binary", "static"):
+            kind = entry["type"]
+        elif not binary and entry is not None:
+            kind, replaced = "splice", replacer.splice_stream(_ViewReader(data), dst, entry["offsets"])
+        elif not binary:
+            kind, replaced = "stream", replacer.stream(_ViewReader(data), dst)
+        if kind in ("binary", "static"):
+            dst.write(data)
+    os.chmod(dest_file_path, mode)
+    return kind, replaced
+
+def sync_packed_file(reader, replacer: Replacer, file_entry: list, dest_file_path: Path, entry: Optional[dict] = None) -> Tuple[Path, str]:
+    _, _, size, mode, binary = file_entry
+    if entry is not None and entry.get("size") != size:
+        entry = None
+    with reader.data(file_entry) as data:
+        if binary or (entry is not None and entry["type"] in ("binary", "static")):
+            # hashed and written straight from the mapping, never copied onto the heap
+            status = sync_output(dest_file_path, size, lambda: hashlib.sha256(data).hexdigest(), stat.S_IMODE(mode), lambda path: path.write_bytes(data))
+        else:
+            buffer = BytesIO()
+            if entry is not None:
+                replacer.splice_stream(_ViewReader(data), buffer, entry["offsets"])
+            else:
+                replacer.stream(_ViewReader(data), buffer)
+            status = sync_content(dest_file_path, buffer.getvalue(), stat.S_IMODE(mode))
+    instrument.count(f"sync.{status}_files")
+    return dest_file_path, status
+
+class PackedTemplate:
+    # renders straight out of the mapped pack: no directory walk and a single open() for the whole image
+    def __init__(self, pack_path: Path, plan: Optional[RenderPlan] = None) -> None:
+        from pack import PackReader
+        self.pack_path = pack_path
+        self.reader = PackReader(pack_path)
+        self.plan = plan if plan is not None else self.reader.plan
+
+    def __getstate__(self):
+        # a mapping can't be sent to batch workers, they map the pack themselves
+        return {"pack_path": self.pack_path, "plan": self.plan}
+
+    def __setstate__(self, state):
+        self.__init__(state["pack_path"], state["plan"])
+
+    def render(self, target_path: Path, replacements: Union[Dict[str, str], Replacer], jobs: int = 1, sync: bool = False):
+        if target_path.exists() and not sync:
+            raise FileExistsError(f"Target folder '{target_path}' already exists.")
+
+        replacer = compile_replacements(replacements)
+        use_plan = self.plan is not None and self.plan.covers(replacer.names)
+        with instrument.phase("render.mkdir"):
+            os.makedirs(target_path, exist_ok=sync)
+            for rel_path in self.reader.dirs:
+                os.makedirs(target_path / replacer.apply(rel_path), exist_ok=True)
+        tasks = [
+            (file_entry, target_path / replacer.apply(file_entry[0]), self.plan.files.get(file_entry[0]) if use_plan else None)
+            for file_entry in self.reader.files
+        ]
+        return run_render_tasks(partial(sync_packed_file if sync else render_packed_file, self.reader, replacer), tasks, jobs)
+
+class LayeredTemplate:
+    # an image built on a base, rendered in one pass: each file comes straight from the layer that holds it
+    def __init__(self, template_path: Path, plan: Optional[RenderPlan] = None) -> None:
+        from layers import layer_chain
+        from pack import is_pack
+        self.template_path = template_path
+        self.plan = plan
+        # compiled layers, the image itself first
+        self.layers: List[Union[CompiledTemplate, PackedTemplate]] = []
+        self.directories: List[str] = []
+        # (layer index, relative path, source path or pack entry)
+        self.files: List[Tuple[int, str, Union[Path, list]]] = []
+        hidden = set()
+        seen_dirs = set()
+        seen_files = set()
+        chain = layer_chain(template_path)
+        for path, layer in chain:
+            index = len(self.layers)
+            if is_pack(path):
+                compiled = PackedTemplate(path)
+                dirs = compiled.reader.dirs
+                files = [(file_entry[0], file_entry) for file_entry in compiled.reader.files]
+            else:
+                compiled = CompiledTemplate(path)
+                dirs = [Path(rel_path).as_posix() for rel_path in compiled.directories if rel_path != "."]
+                files = [((Path(rel_path) / file).as_posix(), path / rel_path / file) for rel_path, file, _ in compiled.files]
+            self.layers.append(compiled)
+            for rel_path in dirs:
+                if rel_path not in hidden and rel_path not in seen_dirs:
+                    seen_dirs.add(rel_path)
+                    self.directories.append(rel_path)
+            for rel_file, source in files:
+                # a path that an upper layer has already provided or removed is never taken from below
+                if rel_file not in hidden and rel_file not in seen_files:
+                    seen_files.add(rel_file)
+                    self.files.append((index, rel_file, source))
+            if layer is not None:
+                hidden.update(layer["removed"])
+        # the plan's offsets for files left to the base only hold while the base still has the same bytes
+        from_base = chain[0][1].get("from_base", {})
+        self.stale = set()
+        for index, rel_file, source in self.files:
+            if index == 0 or plan is None or rel_file not in plan.files:
+                continue
+            if from_base.get(rel_file) != self._hash(index, source):
+                self.stale.add(rel_file)
+
+    def _hash(self, index: int, source: Union[Path, list]) -> str:
+        layer = self.layers[index]
+        if isinstance(layer, PackedTemplate):
+            with layer.reader.data(source) as data:
+                return hashlib.sha256(data).hexdigest()
+        stored = layer.stored.get(source.relative_to(layer.template_path).as_posix())
+        return stored["hash"] if stored is not None else hash_file(source)
+
+    def render(self, target_path: Path, replacements: Union[Dict[str, str], Replacer], jobs: int = 1, sync: bool = False):
+        if target_path.exists() and not sync:
+            raise FileExistsError(f"Target folder '{target_path}' already exists.")
+
+        replacer = compile_replacements(replacements)
+        use_plan = self.plan is not None and self.plan.covers(replacer.names)
+        with instrument.phase("render.mkdir"):
+            os.makedirs(target_path, exist_ok=sync)
+            for rel_path in self.directories:
+                os.makedirs(target_path / replacer.apply(rel_path), exist_ok=True)
+        tasks = [
+            (index, source, target_path / replacer.apply(rel_file), self.plan.files.get(rel_file) if use_plan and rel_file not in self.stale else None)
+            for index, rel_file, source in self.files
+        ]
+        return run_render_tasks(partial(self._render_file, replacer, sync), tasks, jobs)
+
+    def _render_file(self, replacer: Replacer, sync: bool, index: int, source: Union[Path, list], dest_file_path: Path, entry: Optional[dict]):
+        layer = self.layers[index]
+        if isinstance(layer, PackedTemplate):
+            return (sync_packed_file if sync else render_packed_file)(layer.reader, replacer, source, dest_file_path, entry)
+        stored = layer.stored.get(source.relative_to(layer.template_path).as_posix())
+        return (sync_file if sync else render_file)(source, dest_file_path, replacer, entry, stored)
+
+# set by `new daemon`: template path -> (version stamps of its layers, compiled template)
+_template_cache: Optional[Dict[Path, tuple]] = None
+_template_cache_lock = threading.Lock()
+
+def run_render_tasks(func, tasks: List[tuple], jobs: int = 1) -> list:
+    # what func returned for every task, in task order
+    jobs = min(resolve_jobs(jobs), len(tasks))
+    if jobs <= 1:
+        return [func(*task) for task in tasks]
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = [executor.submit(func, *task) for task in tasks]
+        wait(futures, return_when=FIRST_EXCEPTION)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    # report the first failing file in walk order, the same one serial mode would stop at
+    for future in futures:
+        if not future.cancelled() and future.exception() is not None:
+            raise future.exception()
+    return [future.result() for future in futures]
+
+def enable_template_cache():
+    global _template_cache
+    _template_cache = {}
+
+def cached_template_count() -> int:
+    return len(_template_cache or {})
+
+def compile_template(template_path: Path, plan: Optional[RenderPlan] = None):
+    if _template_cache is None:
+        return _compile_template(template_path, plan)
+    from layers import layer_chain
+    from store import version_stamp
+    # reused until a build or pull changes the image or one of its bases
+    stamps = tuple(version_stamp(path) for path, _ in layer_chain(template_path))
+    with _template_cache_lock:
+        cached = _template_cache.get(template_path)
+    if cached is not None and cached[0] == stamps:
+        return cached[1]
+    compiled = _compile_template(template_path, plan)
+    with _template_cache_lock:
+        _template_cache[template_path] = (stamps, compiled)
+    return compiled
+
+def _compile_template(template_path: Path, plan: Optional[RenderPlan] = None):
+    from layers import load_layer
+    from pack import is_pack
+    if load_layer(template_path) is not None:
+        return LayeredTemplate(template_path, plan)
+    if is_pack(template_path):
+        return PackedTemplate(template_path, plan)
+    return CompiledTemplate(template_path, plan)
+
+def resolve_jobs(jobs: int) -> int:
+    if jobs <= 0:
+        return os.cpu_count() or 1
+    return jobs
+
+def render_template(template_path: Path, target_path: Path, replacements: Dict[str, str], plan: Optional[RenderPlan] = None, jobs: int = 1):
     if target_path.exists():
         raise FileExistsError(f"Target folder '{target_path}' already exists.")
+    with instrument.phase("render.walk"):
+        compiled = compile_template(template_path, plan)
+    compiled.render(target_path, replacements, jobs)
 
-    for root, dirs, files in os.walk(template_path):
-        rel_path = Path(root).relative_to(template_path)
-        rendered_path = target_path / apply_replacements(str(rel_path), replacements)
-        rendered_path.mkdir(parents=True, exist_ok=True)
+def sync_template(template_path: Path, target_path: Path, replacements: Dict[str, str], plan: Optional[RenderPlan] = None, jobs: int = 1) -> Dict[str, List[Path]]:
+    # re-applies an image to an existing project: {"created": [...], "updated": [...], "unchanged": [...]}
+    with instrument.phase("render.walk"):
+        compiled = compile_template(template_path, plan)
+    summary = {"created": [], "updated": [], "unchanged": []}
+    for dest_file_path, status in compiled.render(target_path, replacements, jobs, sync=True):
+        summary[status].append(dest_file_path)
+    return summary
 
-        for file in files:
-            if file == "template.json":
-                continue
+# set once in every batch worker process, so the compiled template isn't sent along with each item
+_batch_template = None
 
-            src_file = Path(root) / file
-            dest_file_name = apply_replacements(file, replacements)
-            dest_file_path = rendered_path / dest_file_name
+def _init_batch_worker(compiled):
+    global _batch_template
+    _batch_template = compiled
 
+def _render_batch_item(target_path: Path, replacements: Dict[str, str]):
+    _batch_template.render(target_path, replacements)
+
+def render_batch(compiled, items: List[Tuple[Path, Dict[str, str]]], processes: int = 0) -> List[Optional[Exception]]:
+    # one project per worker process; returns the error of every item, None where it succeeded
+    processes = min(resolve_jobs(processes), len(items))
+    if processes <= 1:
+        results = []
+        for target_path, replacements in items:
             try:
-                with open(src_file, "r", encoding="utf-8") as f:
-                    content = f.read()
-                content = apply_replacements(content, replacements)
-                with open(dest_file_path, "w", encoding="utf-8") as f:
-                    f.write(content)
-            except UnicodeDecodeError:
-                shutil.copy2(src_file, dest_file_path)
+                compiled.render(target_path, replacements)
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_batch_worker, initargs=(compiled,)) as executor:
+        futures = [executor.submit(_render_batch_item, target_path, replacements) for target_path, replacements in items]
+        return [future.exception() for future in futures]
@@ -0,0 +1,415 @@
+import email.message
+import email.parser
+import hashlib
+import hmac
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from typing import Dict, Iterator, Optional, Tuple
+from image import TemplateImage, get_local_image_path, find_local_image, load_local_template_image, list_local_images
+from config import config
+import store
+import image_index
+
+UPLOADS_ROOT = store.CACHE_ROOT / "uploads"
+SEND_CHUNK_SIZE = 1024 * 1024
+# request bodies and deltas larger than this are spooled to disk
+UPLOAD_SPOOL_SIZE = 16 * 1024 * 1024
+# form fields other than the uploaded file are held in memory up to this size
+MULTIPART_FIELD_LIMIT = 64 * 1024
+# idle keep-alive connections give their worker back after this many seconds
+KEEP_ALIVE_TIMEOUT = 15
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+def archive_path(image: TemplateImage) -> Path:
+    return store.archive_files(image.category, image.name, image.version)[0]
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    # a single "bytes=start-end" range, inclusive; None if it can't be satisfied
+    match = _RANGE.match(header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        start, end = max(size - int(end), 0), size - 1  # suffix range: the last N bytes
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+class ArchiveCache:
+    # zips every version once and reuses the file until the version changes
+    def __init__(self, compression: str = "deflate", level: Optional[int] = None) -> None:
+        self.compression = compression
+        self.level = level
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _version_lock(self, image: TemplateImage) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(image.id(), threading.Lock())
+
+    def get(self, image: TemplateImage) -> Tuple[Path, str]:
+        from remote import write_template_zip
+        version_path = find_local_image(image)
+        if version_path is None:
+            raise FileNotFoundError(f"No local template image found for {image}")
+        image_index.touch(image)  # a download from the registry counts as a use
+        path = archive_path(image)
+        info_path = path.with_suffix(".json")
+        # concurrent requests for the same version wait for one build instead of each zipping it
+        with self._version_lock(image):
+            stamp = store.version_stamp(version_path)
+            try:
+                with info_path.open("r") as f:
+                    info = json.load(f)
+                if info["source"] == stamp and path.exists():
+                    return path, info["sha256"]
+            except (FileNotFoundError, json.JSONDecodeError, KeyError):
+                pass
+
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+            try:
+                with open(tmp, "wb") as f:
+                    write_template_zip(version_path, f, self.compression, self.level)
+                digest = store.hash_file(tmp)
+                os.replace(tmp, path)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+            with info_path.open("w") as f:
+                json.dump({"source": stamp, "sha256": digest}, f)
+            return path, digest
+
+def build_delta(image: TemplateImage, have: set, fileobj):
+    # the full version minus every file whose blob the client already holds
+    from zipfile import ZipFile, ZIP_DEFLATED
+    version_path = get_local_image_path(image)
+    files = store.load_manifest(version_path) or {}
+    with ZipFile(fileobj, "w", compression=ZIP_DEFLATED) as zipf:
+        for path in sorted(version_path.rglob("*")):
+            rel_file = path.relative_to(version_path).as_posix()
+            entry = files.get(rel_file)
+            if entry is not None and entry["hash"] in have:
+                continue
+            zipf.write(path, rel_file)
+
+def read_multipart(content_type: str, chunks: Iterator[bytes], file_field: str, file_path: Path) -> Dict[str, bytes]:
+    # streams a multipart/form-data body: file_field goes straight to file_path, the other fields are returned
+    message = email.message.Message()
+    message["Content-Type"] = content_type
+    boundary = message.get_param("boundary")
+    if message.get_content_type() != "multipart/form-data" or not isinstance(boundary, str) or not boundary:
+        raise ValueError("Expected a multipart/form-data body")
+    delimiter = b"\r\n--" + boundary.encode("latin-1")
+    keep = len(delimiter) - 1  # a delimiter may be split across two chunks
+
+    def fill(buf: bytes) -> bytes:
+        chunk = next(chunks, b"")
+        if not chunk:
+            raise ValueError("truncated multipart body")
+        return buf + chunk
+
+    buf = b"\r\n"  # the first delimiter has no line break of its own
+    while delimiter not in buf:
+        buf = fill(buf[-keep:])
+    buf = buf[buf.index(delimiter) + len(delimiter):]
+    fields = {}
+    while True:
+        while len(buf) < 2:
+            buf = fill(buf)
+        if buf.startswith(b"--"):
+            return fields
+        while b"\r\n\r\n" not in buf:
+            if len(buf) > MULTIPART_FIELD_LIMIT:
+                raise ValueError("multipart part headers are too large")
+            buf = fill(buf)
+        head, buf = buf.split(b"\r\n\r\n", 1)
+        name = email.parser.BytesHeaderParser().parsebytes(head.lstrip()).get_param("name", header="content-disposition")
+        with (open(file_path, "wb") if name == file_field else io.BytesIO()) as sink:
+            while True:
+                index = buf.find(delimiter)
+                end = index if index != -1 else max(len(buf) - keep, 0)
+                sink.write(buf[:end])
+                if name != file_field and sink.tell() > MULTIPART_FIELD_LIMIT:
+                    raise ValueError(f"multipart field {name!r} is too large")
+                if index != -1:
+                    buf = buf[index + len(delimiter):]
+                    break
+                buf = fill(buf[end:])
+            if name != file_field:
+                fields[name] = sink.getvalue()
+
+class PooledHTTPServer(ThreadingHTTPServer):
+    # a bounded worker pool instead of one thread per connection
+    def __init__(self, address, handler, workers: int) -> None:
+        super().__init__(address, handler)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class Registry:
+    def __init__(self, token: Optional[str] = None, verbose: bool = False) -> None:
+        self.token = token
+        self.verbose = verbose
+        self.archives = ArchiveCache(config.get_upload_compression(), config.get_upload_compression_level())
+        self._descriptions: Dict[str, Tuple[int, Optional[str]]] = {}
+
+    def description(self, image: TemplateImage) -> Optional[str]:
+        path = find_local_image(image)
+        if path is None:
+            raise FileNotFoundError(f"No local template image found for {image}")
+        mtime = os.stat(path if path.is_file() else path / "template.json").st_mtime_ns
+        cached = self._descriptions.get(image.id())
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, load_local_template_image(image, record_use=False)[0].description)
+            self._descriptions[image.id()] = cached
+        return cached[1]
+
+    def catalog(self) -> dict:
+        result = {}
+        for image in list_local_images():
+            try:
+                description = self.description(image)
+            except FileNotFoundError:
+                continue  # removed since the index was read
+            result[image.id()] = {
+                "category": image.category,
+                "name": image.name,
+                "version": image.version,
+                "description": description
+            }
+        return {"result": result}
+
+    def metadata(self, image: TemplateImage) -> dict:
+        metadata, _ = load_local_template_image(image, record_use=False)
+        # keyword names of TemplateMetadata, which is how remote.fetch_metadata builds it
+        return {
+            "name": metadata.name,
+            "description": metadata.description,
+            "placeholders": metadata.placeholders,
+            "open_file": metadata.open,
+            "category": metadata.category,
+            "version": metadata.version
+        }
+
+    def install(self, image: TemplateImage, upload_path: Path):
+        from remote import install_archive
+        install_archive(upload_path, image, get_local_image_path(image))
+
+    def handler(self):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            server_version = "new-registry"
+            timeout = KEEP_ALIVE_TIMEOUT
+
+            def log_message(self, format, *args):
+                if registry.verbose:
+                    super().log_message(format, *args)
+
+            def _send(self, status: int, body: bytes = b"", content_type: str = "application/json", headers: Dict[str, str] = None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _json(self, data, status: int = 200, etag: bool = False):
+                body = json.dumps(data).encode("utf-8")
+                if not etag:
+                    return self._send(status, body)
+                tag = f'"{hashlib.sha256(body).hexdigest()}"'
+                if self.headers.get("If-None-Match") == tag:
+                    return self._send(304, headers={"ETag": tag})
+                self._send(status, body, headers={"ETag": tag})
+
+            def _error(self, status: int, detail: str):
+                self._json({"detail": detail}, status)
+
+            def _image(self, prefix: str) -> Optional[TemplateImage]:
+                parts = self.path[len(prefix):].split("?", 1)[0].strip("/").split("/")
+                if len(parts) != 3 or any(p in ("", ".", "..") for p in parts):
+                    return None
+                image = TemplateImage(*parts)
+                if find_local_image(image) is None:
+                    return None
+                return image
+
+            def _body_chunks(self) -> Iterator[bytes]:
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    while True:
+                        size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return
+                        while size > 0:
+                            chunk = self.rfile.read(min(SEND_CHUNK_SIZE, size))
+                            if not chunk:
+                                return
+                            yield chunk
+                            size -= len(chunk)
+                        self.rfile.readline()
+                else:
+                    remaining = int(self.headers.get("Content-Length", 0))
+                    while remaining > 0:
+                        chunk = self.rfile.read(min(SEND_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            return
+                        yield chunk
+                        remaining -= len(chunk)
+
+            def _read_body(self):
+                body = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+                for chunk in self._body_chunks():
+                    body.write(chunk)
+                return body
+
+            def _send_file(self, f, size: int, etag: str, headers: Dict[str, str]):
+                headers = dict(headers, **{"ETag": etag, "Accept-Ranges": "bytes"})
+                if self.headers.get("If-None-Match") == etag:
+                    return self._send(304, headers={"ETag": etag})
+
+                status, start, end = 200, 0, size - 1
+                range_header = self.headers.get("Range")
+                # If-Range with an old ETag means the client's partial copy is stale: send everything
+                if range_header and self.headers.get("If-Range", etag) == etag:
+                    byte_range = parse_range(range_header, size)
+                    if byte_range is None:
+                        return self._send(416, headers=dict(headers, **{"Content-Range": f"bytes */{size}"}))
+                    status, (start, end) = 206, byte_range
+                    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/zip")
+                self.send_header("Content-Length", str(end - start + 1))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if self.command == "HEAD" or size == 0:
+                    return
+                self.wfile.flush()
+                # zero-copy from the page cache to the socket where the platform has sendfile
+                self.connection.sendfile(f, start, end - start + 1)
+
+            def _send_archive(self, path: Path, digest: str):
+                with open(path, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    self._send_file(f, size, f'"{digest}"', {"X-Checksum-Sha256": digest})
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                if self.path.split("?", 1)[0] == "/list":
+                    return self._json(registry.catalog(), etag=True)
+                if self.path.startswith("/meta/"):
+                    image = self._image("/meta/")
+                    if image is None:
+                        return self._error(404, "not found")
+                    return self._json(registry.metadata(image), etag=True)
+                if self.path.startswith("/get/"):
+                    image = self._image("/get/")
+                    if image is None:
+                        return self._error(404, "not found")
+                    path, digest = registry.archives.get(image)
+                    return self._send_archive(path, digest)
+                self._error(404, "not found")
+
+            def do_POST(self):
+                if self.path == "/upload":
+                    return self._upload()
+                if self.path.startswith("/delta/"):
+                    return self._delta()
+                self._read_body().close()
+                self._error(404, "not found")
+
+            def _upload(self):
+                if registry.token is None:
+                    self._read_body().close()
+                    return self._error(403, "uploads are disabled on this registry (start it with --token)")
+                expected = f"Bearer {registry.token}".encode("utf-8")
+                if not hmac.compare_digest(self.headers.get("Authorization", "").encode("utf-8"), expected):
+                    self._read_body().close()
+                    return self._error(401, "invalid upload token")
+                UPLOADS_ROOT.mkdir(parents=True, exist_ok=True)
+                upload_path = UPLOADS_ROOT / f"{uuid.uuid4().hex}.zip"
+                try:
+                    # the archive goes from the socket to disk without being held in memory
+                    chunks = self._body_chunks()
+                    try:
+                        fields = read_multipart(self.headers.get("Content-Type", ""), chunks, "file", upload_path)
+                        image = TemplateImage(fields["category"].decode(), fields["name"].decode(), fields["version"].decode())
+                        if not upload_path.exists():
+                            raise KeyError("file")
+                    except (KeyError, ValueError, AttributeError, TypeError) as e:
+                        for _ in chunks:
+                            pass  # leave the connection ready for the next request
+                        return self._error(400, f"malformed upload: {e}")
+                    if any(p in ("", ".", "..") or "/" in p for p in (image.category, image.name, image.version)):
+                        return self._error(400, "invalid image reference")
+                    try:
+                        registry.install(image, upload_path)
+                    except Exception as e:
+                        return self._error(400, f"could not install archive: {e}")
+                finally:
+                    upload_path.unlink(missing_ok=True)
+                self.log_message("installed %s", image)
+                self._json({"status": "ok"})
+
+            def _delta(self):
+                with self._read_body() as body:
+                    body.seek(0)
+                    try:
+                        have = set(json.loads(body.read())["files"].values())
+                    except (ValueError, KeyError, AttributeError) as e:
+                        return self._error(400, f"malformed delta request: {e}")
+                image = self._image("/delta/")
+                if image is None:
+                    return self._error(404, "not found")
+                if store.load_manifest(find_local_image(image)) is None:
+                    return self._error(501, "version has no blob manifest")
+                with SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE) as delta:
+                    build_delta(image, have, delta)
+                    delta.seek(0)
+                    digest = hashlib.sha256()
+                    for chunk in iter(lambda: delta.read(SEND_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                    size = delta.tell()
+                    delta.seek(0)
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/zip")
+                    self.send_header("Content-Length", str(size))
+                    self.send_header("X-Checksum-Sha256", digest.hexdigest())
+                    self.end_headers()
+                    shutil.copyfileobj(delta, self.wfile, SEND_CHUNK_SIZE)
+
+        return Handler
+
+def serve(host: str, port: int, workers: int = 32, token: Optional[str] = None, verbose: bool = False) -> PooledHTTPServer:
+    registry = Registry(token=token, verbose=verbose)
+    image_index.list_images()  # bring the index up to date before the first request
+    return PooledHTTPServer((host, port), registry.handler(), workers)
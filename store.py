@@ -0,0 +1,320 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+from fastcopy import copy_file
+from render_plan import RENDER_PLAN_FILE
+
+CACHE_ROOT = Path.home() / ".cache" / "new"
+TEMPLATES_ROOT = CACHE_ROOT / "templates"
+BLOBS_ROOT = CACHE_ROOT / "blobs"
+# versions are assembled here and renamed into TEMPLATES_ROOT once complete
+STAGING_ROOT = CACHE_ROOT / "staging"
+# written into every version directory, maps relative paths to their blobs
+MANIFEST_FILE = "image_manifest.json"
+# images built on a base hold this next to template.json, naming the base and what the layer removes from it
+LAYER_FILE = "layer.json"
+# a packed version is this single file next to where its directory would be
+PACK_SUFFIX = ".pack"
+# new serve zips each version once into <category>/<name>/<version>.zip here, with a .json beside it
+ARCHIVES_ROOT = CACHE_ROOT / "archives"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def blob_path(digest: str, executable: bool = False) -> Path:
+    # executables get their own blob because every link to a blob shares its mode
+    name = f"{digest}.x" if executable else digest
+    return BLOBS_ROOT / digest[:2] / name
+
+def _blob_entry(digest: str, size: int, mode: int, mtime: Optional[int] = None) -> dict:
+    # mode and mtime are the file's own: a blob is shared by every version that links it, so its inode can't carry them
+    entry = {"hash": digest, "size": size, "mode": mode}
+    if mtime is not None:
+        entry["mtime"] = mtime
+    return entry
+
+def _temp_blob_path(blob: Path) -> Path:
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    return blob.with_name(f"{blob.name}.{uuid.uuid4().hex}.tmp")
+
+def store_file(src: Path) -> dict:
+    # always a copy (a reflink where the filesystem can): a blob that shared the source's inode would change with it
+    st = os.stat(src)
+    executable = bool(st.st_mode & 0o111)
+    digest = hash_file(src)
+    blob = blob_path(digest, executable)
+    try:
+        # caches from before this rule may still hold blobs that are a source file
+        stored = not os.path.samestat(os.stat(blob), st)
+    except FileNotFoundError:
+        stored = False
+    if not stored:
+        tmp = _temp_blob_path(blob)
+        copy_file(src, tmp)
+        os.chmod(tmp, 0o755 if executable else 0o644)
+        os.replace(tmp, blob)
+    return _blob_entry(digest, st.st_size, st.st_mode & 0o777, st.st_mtime_ns)
+
+def store_stream(f, mode: int = 0o644, mtime: Optional[int] = None) -> dict:
+    executable = bool(mode & 0o111)
+    digest = hashlib.sha256()
+    size = 0
+    tmp = _temp_blob_path(BLOBS_ROOT / "incoming")
+    try:
+        with open(tmp, "wb") as out:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        blob = blob_path(digest.hexdigest(), executable)
+        if blob.exists():
+            os.unlink(tmp)
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.chmod(tmp, 0o755 if executable else 0o644)
+            os.replace(tmp, blob)
+    except BaseException:
+        if tmp.exists():
+            os.unlink(tmp)
+        raise
+    return _blob_entry(digest.hexdigest(), size, mode, mtime)
+
+def has_blob(entry: dict) -> bool:
+    return blob_path(entry["hash"], entry["mode"] & 0o111 != 0).exists()
+
+def link_blob(entry: dict, dst: Path):
+    blob = blob_path(entry["hash"], entry["mode"] & 0o111 != 0)
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(blob, dst)
+    except OSError:
+        copy_file(blob, dst)  # cache spread over filesystems, or too many links
+
+def release_blobs(files: Dict[str, dict]):
+    # a blob whose only remaining link is the store itself is no longer used by any version
+    for entry in files.values():
+        blob = blob_path(entry["hash"], entry["mode"] & 0o111 != 0)
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.unlink(blob)
+        except FileNotFoundError:
+            pass
+
+def archive_files(category: str, name: str, version: str) -> List[Path]:
+    zip_path = ARCHIVES_ROOT / category / name / f"{version}.zip"
+    return [zip_path, zip_path.with_suffix(".json")]
+
+def remove_archive(category: str, name: str, version: str):
+    # a served archive is only a copy of its version and goes with it
+    for path in archive_files(category, name, version):
+        path.unlink(missing_ok=True)
+
+def save_manifest(version_path: Path, files: Dict[str, dict]):
+    with (version_path / MANIFEST_FILE).open("w") as f:
+        json.dump({"files": files}, f)
+
+def load_manifest(version_path: Path) -> Optional[Dict[str, dict]]:
+    manifest_path = version_path / MANIFEST_FILE
+    if not manifest_path.exists():
+        return None
+    with manifest_path.open("r") as f:
+        return json.load(f).get("files", {})
+
+def version_stamp(version_path: Path) -> str:
+    # changes with every build, pull or incremental build of the version, without reading its files
+    st = os.stat(version_path)
+    if version_path.is_file():
+        return f"{st.st_ino}:{st.st_mtime_ns}:{st.st_size}"
+    parts = [st.st_ino, st.st_mtime_ns]
+    for name in ("template.json", RENDER_PLAN_FILE, MANIFEST_FILE, LAYER_FILE):
+        try:
+            parts.append(os.stat(version_path / name).st_mtime_ns)
+        except FileNotFoundError:
+            parts.append(0)
+    return ":".join(str(part) for part in parts)
+
+def create_staging_dir() -> Path:
+    STAGING_ROOT.mkdir(parents=True, exist_ok=True)
+    path = STAGING_ROOT / uuid.uuid4().hex
+    path.mkdir()
+    return path
+
+# renameat2(2) flag that swaps two paths in one step
+RENAME_EXCHANGE = 2
+_AT_FDCWD = -100
+_renameat2 = None
+
+def exchange_paths(a: Path, b: Path) -> bool:
+    # False where the kernel, libc or filesystem can't swap atomically
+    global _renameat2
+    if _renameat2 is None:
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            _renameat2 = libc.renameat2
+            _renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+        except (OSError, AttributeError, TypeError):
+            _renameat2 = False
+    if not _renameat2:
+        return False
+    if _renameat2(_AT_FDCWD, os.fsencode(a), _AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0:
+        return True
+    import ctypes
+    errno = ctypes.get_errno()
+    if errno in (38, 22, 95):  # ENOSYS, EINVAL, EOPNOTSUPP
+        return False
+    raise OSError(errno, os.strerror(errno), str(a))
+
+def install_staged(staging_path: Path, target_path: Path):
+    # readers see either the old version or the complete new one: the new tree is moved next to the target
+    # (a dot name, which listings skip) and swapped in with a single renameat2(RENAME_EXCHANGE)
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    incoming = target_path.with_name(f".{target_path.name}.{uuid.uuid4().hex}")
+    os.rename(staging_path, incoming)
+    try:
+        if target_path.exists() and exchange_paths(incoming, target_path):
+            old_path = incoming
+        else:
+            old_path = None
+            if target_path.exists():
+                # no atomic swap here (not Linux, or an old kernel or filesystem): a reader can miss the
+                # version for the instant between these two renames
+                old_path = target_path.with_name(f".{target_path.name}.{uuid.uuid4().hex}.old")
+                os.rename(target_path, old_path)
+            os.rename(incoming, target_path)
+    except BaseException:
+        if old_path is not None and old_path.exists() and not target_path.exists():
+            os.rename(old_path, target_path)
+        if incoming.exists():
+            shutil.rmtree(incoming)
+        raise
+    if old_path is not None:
+        old_files = load_manifest(old_path) or {}
+        shutil.rmtree(old_path)
+        release_blobs(old_files)
+
+def member_path(target_path: Path, name: str) -> Path:
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or ".." in parts or ":" in parts[0]:
+        raise ValueError(f"Unsafe path in archive: {name}")
+    return target_path.joinpath(*parts)
+
+def extract_zip(zipf, target_path: Path) -> Dict[str, dict]:
+    # blobs go through the store, the per-version files are written as they are
+    plain_files = ("template.json", RENDER_PLAN_FILE, LAYER_FILE)
+    # archives pushed from a store-backed cache carry their manifest, which lets us skip known blobs unread
+    known = {}
+    if MANIFEST_FILE in zipf.namelist():
+        known = json.loads(zipf.read(MANIFEST_FILE)).get("files", {})
+
+    files = {}
+    for member in zipf.infolist():
+        dst = member_path(target_path, member.filename)
+        rel_file = dst.relative_to(target_path).as_posix()
+        if member.is_dir():
+            dst.mkdir(parents=True, exist_ok=True)
+            continue
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if rel_file == MANIFEST_FILE:
+            continue  # rebuilt from what we actually stored
+        entry = known.get(rel_file)
+        if entry is not None and entry.get("size") == member.file_size and has_blob(entry):
+            link_blob(entry, dst)
+            files[rel_file] = entry
+            continue
+        with zipf.open(member) as src:
+            if rel_file in plain_files:
+                with open(dst, "wb") as out:
+                    out.write(src.read())
+                continue
+            if entry is not None:
+                stored = store_stream(src, entry["mode"], entry.get("mtime"))
+            else:
+                stored = store_stream(src, (member.external_attr >> 16) & 0o777 or 0o644)
+        link_blob(stored, dst)
+        files[rel_file] = stored
+
+    # delta archives leave out every file whose content we already hold
+    for rel_file, entry in known.items():
+        if rel_file in files:
+            continue
+        if not has_blob(entry):
+            raise FileNotFoundError(f"Archive is missing '{rel_file}' and its blob is not in the local store")
+        dst = member_path(target_path, rel_file)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        link_blob(entry, dst)
+        files[rel_file] = entry
+
+    save_manifest(target_path, files)
+    return files
+
+def cache_stats() -> dict:
+    stats = {
+        "versions": 0,
+        "unmanaged_versions": 0,
+        "files": 0,
+        "logical_bytes": 0,
+        "unmanaged_bytes": 0,
+        "blobs": 0,
+        "blob_bytes": 0,
+        "packed_versions": 0,
+        "packed_bytes": 0,
+        "packed_logical_bytes": 0,
+        "archives": 0,
+        "archive_bytes": 0,
+    }
+    if TEMPLATES_ROOT.exists():
+        from pack import pack_stats
+        for pack_file in TEMPLATES_ROOT.glob(f"*/*/*{PACK_SUFFIX}"):
+            stats["versions"] += 1
+            stats["packed_versions"] += 1
+            stats["packed_bytes"] += pack_file.stat().st_size
+            try:
+                files, logical = pack_stats(pack_file)
+            except ValueError:
+                continue  # truncated or not a pack, only its size counts
+            stats["files"] += files
+            stats["logical_bytes"] += logical
+            stats["packed_logical_bytes"] += logical
+        for version_path in TEMPLATES_ROOT.glob("*/*/*"):
+            if not (version_path / "template.json").exists():
+                continue
+            stats["versions"] += 1
+            files = load_manifest(version_path)
+            if files is None:
+                # built before the blob store existed: a full private copy
+                stats["unmanaged_versions"] += 1
+                for root, dirs, names in os.walk(version_path):
+                    for name in names:
+                        stats["unmanaged_bytes"] += os.lstat(os.path.join(root, name)).st_size
+                continue
+            stats["files"] += len(files)
+            stats["logical_bytes"] += sum(entry["size"] for entry in files.values())
+    if BLOBS_ROOT.exists():
+        for blob in BLOBS_ROOT.glob("*/*"):
+            if blob.name.endswith(".tmp"):
+                continue
+            stats["blobs"] += 1
+            stats["blob_bytes"] += blob.stat().st_size
+    # packs are private copies, only files kept as blobs can be deduplicated
+    if ARCHIVES_ROOT.exists():
+        for path in ARCHIVES_ROOT.glob("*/*/*"):
+            if path.name.endswith(".tmp"):
+                continue
+            stats["archives"] += path.suffix == ".zip"
+            stats["archive_bytes"] += path.stat().st_size
+    stats["saved_bytes"] = max(stats["logical_bytes"] - stats["packed_logical_bytes"] - stats["blob_bytes"], 0)
+    # what the cache takes on disk, the figure `new cache gc` holds to cache_max_size
+    stats["usage_bytes"] = stats["blob_bytes"] + stats["unmanaged_bytes"] + stats["packed_bytes"] + stats["archive_bytes"]
+    return stats
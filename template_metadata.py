@@ -11,7 +11,8 @@ class TemplateMetadata:
         placeholders: Optional[List[str]] = None,
         open_file: Optional[str] = None,
         category: Optional[str] = None,
-        version: Optional[str] = None
+        version: Optional[str] = None,
+        base: Optional[str] = None
     ) -> None:
         self.name = name
         self.description = description
@@ -19,6 +20,8 @@ class TemplateMetadata:
         self.open = open_file
         self.category = category
         self.version = version
+        # image this one is layered on, e.g. "base/ci:1.0"
+        self.base = base
 
     @classmethod
     def load(cls, path: Path) -> "TemplateMetadata":
@@ -34,7 +37,8 @@ class TemplateMetadata:
             placeholders=data.get("placeholders", []),
             open_file=data.get("open"),
             category=data.get("category"),
-            version=data.get("version")
+            version=data.get("version"),
+            base=data.get("base")
         )
 
     def template(self) -> str:
@@ -47,7 +51,8 @@ class TemplateMetadata:
             "placeholders": self.placeholders,
             "open": self.open,
             "category": self.category,
-            "version": self.version
+            "version": self.version,
+            "base": self.base
         }
 
     def save(self, path: Path):
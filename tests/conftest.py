@@ -0,0 +1,43 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+# every module resolves ~/.cache/new and ~/.config/new when it is imported, so HOME points at a scratch folder first
+HOME = Path(tempfile.mkdtemp(prefix="new-tests-"))
+os.environ["HOME"] = str(HOME)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest
+import store
+
+@pytest.fixture
+def cache():
+    shutil.rmtree(store.CACHE_ROOT, ignore_errors=True)
+    yield store.CACHE_ROOT
+    shutil.rmtree(store.CACHE_ROOT, ignore_errors=True)
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(HOME, ignore_errors=True)
+
+@pytest.fixture
+def registry():
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+    from fake_registry import FakeRegistry
+    with FakeRegistry() as registry:
+        yield registry
+
+def make_source(path: Path, files: dict, metadata: dict = None) -> Path:
+    # a template source folder with template.json and {relative path: text or bytes}
+    import json
+    path.mkdir(parents=True, exist_ok=True)
+    (path / "template.json").write_text(json.dumps(metadata or {"placeholders": []}))
+    for rel_file, content in files.items():
+        file_path = path / rel_file
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(content, bytes):
+            file_path.write_bytes(content)
+        else:
+            file_path.write_text(content)
+    return path
@@ -0,0 +1,45 @@
+import json
+import pytest
+from builder import build_template
+from conftest import make_source
+from image import TemplateImage
+import main
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_create_batch_renders_every_line_and_reports_failures(cache, tmp_path, monkeypatch, jobs):
+    image = TemplateImage.parse("t/batch:1.0")
+    files = {"{{project_name}}/owner.txt": "{{owner}} owns {{project_name}}\n", "README": "static\n"}
+    build_template(image, make_source(tmp_path / "src", files, {"placeholders": ["owner"]}))
+    metadata, template_path = main.load_local_template_image(image)
+
+    out = tmp_path / "out"
+    (out / "taken").mkdir(parents=True)
+    lines = [
+        {"project_name": "billing", "owner": "payments"},
+        {"project_name": "search", "owner": "discovery"},
+        {"project_name": "nameless"},  # no value for owner
+        {"project_name": "billing", "owner": "again"},
+        {"project_name": "taken", "owner": "someone"},
+        {"project_name": "auth", "owner": "identity"},
+    ]
+    batch = tmp_path / "answers.jsonl"
+    batch.write_text("\n".join(json.dumps(line) for line in lines[:3]) + "\n\nnot json\n" + "\n".join(json.dumps(line) for line in lines[3:]) + "\n")
+
+    reported = []
+    monkeypatch.setattr(main, "report_batch", lambda results, *args: reported.extend(results))
+    main.create_batch(metadata, template_path, batch, out, jobs=jobs)
+
+    assert [(label, type(exc).__name__) for label, exc in reported] == [
+        ("billing", "NoneType"),
+        ("search", "NoneType"),
+        ("nameless", "ValueError"),
+        ("line 5", "JSONDecodeError"),
+        ("billing", "ValueError"),
+        ("taken", "FileExistsError"),
+        ("auth", "NoneType"),
+    ]
+    for name, owner in [("billing", "payments"), ("search", "discovery"), ("auth", "identity")]:
+        assert (out / name / name / "owner.txt").read_text() == f"{owner} owns {name}\n"
+        assert (out / name / "README").read_text() == "static\n"
+    assert sorted(p.name for p in out.iterdir()) == ["auth", "billing", "search", "taken"]
+    assert list((out / "taken").iterdir()) == []
@@ -0,0 +1,104 @@
+import shutil
+import pytest
+import builder
+import store
+from builder import build_template
+from image import TemplateImage, find_local_image
+from render_plan import load_render_plan
+from conftest import make_source
+
+def test_incremental_build_without_state_needs_force(cache, tmp_path):
+    image = TemplateImage.parse("t/inc:1.0")
+    source = make_source(tmp_path / "src", {"a.txt": "one"})
+    build_template(image, source)
+    shutil.rmtree(builder.BUILDS_ROOT)
+    (source / "a.txt").write_text("two")
+    with pytest.raises(FileExistsError):
+        build_template(image, source, incremental=True)
+    assert (find_local_image(image) / "a.txt").read_text() == "one"
+    build_template(image, source, incremental=True, force=True)
+    assert (find_local_image(image) / "a.txt").read_text() == "two"
+
+def test_incremental_build_updates_in_place(cache, tmp_path):
+    image = TemplateImage.parse("t/inc:1.0")
+    source = make_source(tmp_path / "src", {"a.txt": "one", "b.txt": "gone"})
+    build_template(image, source)
+    (source / "a.txt").write_text("two")
+    (source / "b.txt").unlink()
+    build_template(image, source, incremental=True)
+    path = find_local_image(image)
+    assert (path / "a.txt").read_text() == "two"
+    assert not (path / "b.txt").exists()
+
+def test_incremental_build_only_looks_at_changed_files(cache, tmp_path):
+    image = TemplateImage.parse("t/inc:1.0")
+    source = make_source(tmp_path / "src", {"a.txt": "one", "b.txt": "one", "sub/c.txt": "one"})
+    build_template(image, source)
+    (source / "a.txt").write_text("two")
+    (source / "b.txt").write_text("two, not reported")
+    (source / "sub/c.txt").unlink()
+    (source / "sub/d.txt").write_text("new")
+    updated = build_template(image, source, incremental=True, changed={"a.txt", "sub/c.txt", "sub/d.txt"})
+    assert updated == {"a.txt", "sub/c.txt", "sub/d.txt"}
+    path = find_local_image(image)
+    assert (path / "a.txt").read_text() == "two"
+    assert (path / "b.txt").read_text() == "one"
+    assert not (path / "sub/c.txt").exists()
+    assert (path / "sub/d.txt").read_text() == "new"
+
+def test_a_changed_directory_falls_back_to_a_full_walk(cache, tmp_path):
+    image = TemplateImage.parse("t/inc:1.0")
+    source = make_source(tmp_path / "src", {"a.txt": "one"})
+    build_template(image, source)
+    (source / "new").mkdir()
+    (source / "new/e.txt").write_text("e")
+    (source / "a.txt").write_text("two")
+    # a new directory also means the preview has to be rendered in full
+    assert build_template(image, source, incremental=True, changed={"new"}) is None
+    path = find_local_image(image)
+    assert (path / "a.txt").read_text() == "two"
+    assert (path / "new/e.txt").read_text() == "e"
+
+def test_preview_renders_only_updated_files(cache, tmp_path):
+    from main import render_preview
+    image = TemplateImage.parse("t/inc:1.0")
+    source = make_source(tmp_path / "src", {"a.txt": "one", "b.txt": "one"})
+    build_template(image, source)
+    preview = tmp_path / "preview"
+    render_preview(image, preview)
+    (preview / "b.txt").write_text("left alone")
+    (source / "a.txt").write_text("two")
+    (source / "c.txt").write_text("three")
+    updated = build_template(image, source, incremental=True, changed={"a.txt", "c.txt"})
+    render_preview(image, preview, changed=updated)
+    assert (preview / "a.txt").read_text() == "two"
+    assert (preview / "b.txt").read_text() == "left alone"
+    assert (preview / "c.txt").read_text() == "three"
+    (source / "c.txt").unlink()
+    render_preview(image, preview, changed=build_template(image, source, incremental=True, changed={"c.txt"}))
+    assert not (preview / "c.txt").exists()
+
+def test_a_removed_directory_means_a_full_preview(cache, tmp_path):
+    image = TemplateImage.parse("t/inc:1.0")
+    source = make_source(tmp_path / "src", {"a.txt": "one", "sub/b.txt": "b"})
+    build_template(image, source)
+    shutil.rmtree(source / "sub")
+    assert build_template(image, source, incremental=True, changed={"sub"}) is None
+
+@pytest.mark.parametrize("changed", [None, {"a", "a/b", "d", "d/e.txt"}], ids=["walk", "watch"])
+def test_incremental_build_handles_files_and_directories_swapping(cache, tmp_path, changed):
+    image = TemplateImage.parse("t/inc:1.0")
+    source = make_source(tmp_path / "src", {"a": "file a", "d/e.txt": "e"})
+    build_template(image, source)
+    (source / "a").unlink()
+    (source / "a/b").parent.mkdir()
+    (source / "a/b").write_text("now a directory")
+    shutil.rmtree(source / "d")
+    (source / "d").write_text("now a file")
+    build_template(image, source, incremental=True, changed=changed)
+    path = find_local_image(image)
+    assert (path / "a/b").read_text() == "now a directory"
+    assert (path / "d").read_text() == "now a file"
+    # the same image a full build would give
+    assert sorted(load_render_plan(path).files) == ["a/b", "d"]
+    assert sorted(store.load_manifest(path)) == ["a/b", "d"]
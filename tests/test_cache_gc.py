@@ -0,0 +1,89 @@
+import pytest
+import image_index
+from builder import build_template
+from cache_gc import collect_garbage
+from config import parse_size
+from image import TemplateImage, find_local_image
+from conftest import make_source
+
+@pytest.mark.parametrize("value, size", [
+    (5368709120, 5 * 1024 ** 3),
+    ("5G", 5 * 1024 ** 3),
+    ("5GiB", 5 * 1024 ** 3),
+    ("5 GB", 5 * 1024 ** 3),
+    ("1.5k", 1536),
+    ("512", 512),
+    ("0", 0),
+])
+def test_parse_size(value, size):
+    assert parse_size(value) == size
+
+@pytest.mark.parametrize("value", ["", "G", "5X", "five", "5GG"])
+def test_parse_size_rejects_garbage(value):
+    with pytest.raises(ValueError):
+        parse_size(value)
+
+@pytest.fixture
+def used(cache, tmp_path, monkeypatch):
+    # four versions of 1000 private bytes each, used in the order given
+    def build(*refs, shared=False):
+        images = []
+        for i, ref in enumerate(refs):
+            image = TemplateImage.parse(ref)
+            build_template(image, make_source(tmp_path / ref.replace("/", "-"), {"data.bin": "shared".ljust(1000, ".") if shared else ref.ljust(1000, ".")}))
+            monkeypatch.setattr(image_index.time, "time", lambda i=i: 1000.0 + i)
+            image_index.touch(image)
+            images.append(image)
+        return images
+    return build
+
+def test_least_recently_used_versions_go_first(used):
+    a1, b1, a2, b2 = used("t/a:1.0", "t/b:1.0", "t/a:2.0", "t/b:2.0")
+    result = collect_garbage(2500, keep_latest=0)
+    assert [version["image"].id() for version in result["evicted"]] == [a1.id(), b1.id()]
+    assert find_local_image(a1) is None and find_local_image(b1) is None
+    assert find_local_image(a2) is not None and find_local_image(b2) is not None
+
+def test_latest_and_pinned_versions_are_kept(used):
+    a1, b1, a2, b2 = used("t/a:1.0", "t/b:1.0", "t/a:2.0", "t/b:2.0")
+    result = collect_garbage(1, keep_latest=1, pins=["t/b"], dry_run=True)
+    assert [version["image"].id() for version in result["evicted"]] == [a1.id()]
+    assert find_local_image(a1) is not None  # dry run
+
+def test_shared_blobs_are_freed_with_their_last_user(used):
+    a1, b1 = used("t/a:1.0", "t/b:1.0", shared=True)
+    usage = collect_garbage(0, keep_latest=0, dry_run=True)["usage_bytes"]
+    result = collect_garbage(usage - 1, keep_latest=0, dry_run=True)
+    evicted = result["evicted"]
+    assert [version["image"].id() for version in evicted] == [a1.id(), b1.id()]
+    assert evicted[0]["frees"] == 0
+    assert evicted[1]["frees"] == 1000
+    assert result["remaining_bytes"] == usage - 1000
+
+def test_served_archives_count_and_go_with_their_version(used):
+    import store
+    from image import remove_local_image
+    from server import ArchiveCache
+    a1, b1, a2 = used("t/a:1.0", "t/b:1.0", "t/a:2.0")
+    archives = ArchiveCache()
+    zips = {image.id(): archives.get(image)[0] for image in (a1, b1, a2)}
+    usage = collect_garbage(0, keep_latest=0, dry_run=True)["usage_bytes"]
+    assert store.cache_stats()["usage_bytes"] == usage
+    assert store.cache_stats()["archives"] == 3
+
+    # a version deleted behind gc's back leaves its archive, which gc then removes
+    remove_local_image(b1)
+    assert not zips[b1.id()].exists()
+    stale = store.archive_files("t", "c", "1.0")
+    stale[0].parent.mkdir(parents=True)
+    stale[0].write_bytes(b"x" * 500)
+    stale[1].write_text("{}")
+    result = collect_garbage(usage, keep_latest=0)
+    assert result["stale_archives"] == 1 and not stale[0].exists() and not stale[1].exists()
+
+    archive_bytes = sum(path.stat().st_size for path in store.archive_files("t", "a", "1.0"))
+    result = collect_garbage(1, keep_latest=1)
+    assert [version["image"].id() for version in result["evicted"]] == [a1.id()]
+    assert result["evicted"][0]["frees"] == 1000 + archive_bytes
+    assert not zips[a1.id()].exists()
+    assert zips[a2.id()].exists()
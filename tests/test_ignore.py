@@ -0,0 +1,88 @@
+import time
+import pytest
+from ignore import IgnoreRules, walk_source
+from watcher import InotifyWatcher, PollingWatcher
+
+@pytest.mark.parametrize("pattern, path, is_dir, ignored", [
+    ("*.log", "a.log", False, True),
+    ("*.log", "deep/down/a.log", False, True),
+    ("*.log", "a.log.txt", False, False),
+    ("/build", "build", True, True),
+    ("/build", "src/build", True, False),
+    ("docs/*.md", "docs/a.md", False, True),
+    ("docs/*.md", "docs/sub/a.md", False, False),
+    ("docs/*.md", "other/docs/a.md", False, False),
+    ("**/cache", "a/b/cache", True, True),
+    ("**/cache", "cache", True, True),
+    ("logs/**", "logs/a/b.txt", False, True),
+    ("logs/**", "logs", True, False),
+    ("a/**/b", "a/b", False, True),
+    ("a/**/b", "a/x/y/b", False, True),
+    ("node_modules/", "node_modules", True, True),
+    ("node_modules/", "node_modules", False, False),
+    ("file?.txt", "file1.txt", False, True),
+    ("file?.txt", "file/.txt", False, False),
+    ("[abc].txt", "b.txt", False, True),
+    ("[!abc].txt", "b.txt", False, False),
+    ("[!abc].txt", "d.txt", False, True),
+    ("[]].txt", "].txt", False, True),
+    ("\\#notes", "#notes", False, True),
+    ("\\!important", "!important", False, True),
+    ("trailing\\ ", "trailing ", False, True),
+    ("trailing   ", "trailing", False, True),
+    ("*.txt", "a[1].txt", False, True),
+])
+def test_patterns(pattern, path, is_dir, ignored):
+    assert IgnoreRules([pattern]).ignored(path, is_dir) == ignored
+
+def test_last_matching_pattern_wins():
+    rules = IgnoreRules(["*.log", "!keep.log", "# a comment", "", "keep.log.bak"])
+    assert rules.ignored("a.log")
+    assert not rules.ignored("keep.log")
+    assert rules.ignored("keep.log.bak")
+    assert not rules.ignored("# a comment")
+
+def test_walk_source_skips_ignored_directories(tmp_path):
+    for rel_file in ("a.txt", "b.log", "node_modules/x/y.js", "src/c.txt", "src/!keep.log", ".newignore"):
+        (tmp_path / rel_file).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel_file).write_text("x")
+    (tmp_path / "src/keep.log").write_text("x")
+    (tmp_path / ".newignore").write_text("node_modules/\n*.log\n!src/keep.log\n")
+    ignored = []
+    seen = set()
+    for root, dirs, files in walk_source(tmp_path, on_ignore=lambda path, is_dir: ignored.append(path)):
+        assert "node_modules" not in root
+        seen.update((root[len(str(tmp_path)):].lstrip("/") + "/" + name).lstrip("/") for name in files)
+    assert seen == {"a.txt", "src/c.txt", "src/keep.log"}
+    assert sorted(ignored) == ["b.log", "node_modules", "src/!keep.log"]
+
+@pytest.mark.parametrize("open_watcher", [
+    lambda root, rules: InotifyWatcher(root, rules),
+    lambda root, rules: PollingWatcher(root, 0.05, rules),
+], ids=["inotify", "polling"])
+def test_watcher_picks_up_new_rules(tmp_path, open_watcher):
+    (tmp_path / "vendor").mkdir()
+    # a rule that would hide .newignore itself must not stop watch mode from seeing it change
+    (tmp_path / ".newignore").write_text("vendor/\n.*\n")
+    try:
+        watcher = open_watcher(tmp_path, IgnoreRules.load(tmp_path))
+    except OSError:
+        pytest.skip("inotify is not available")
+    try:
+        (tmp_path / ".newignore").write_text("")
+        assert tmp_path / ".newignore" in wait_for(watcher)
+        watcher.reload(IgnoreRules.load(tmp_path))
+        (tmp_path / "vendor/lib.txt").write_text("x")
+        assert tmp_path / "vendor/lib.txt" in wait_for(watcher)
+    finally:
+        watcher.close()
+
+def wait_for(watcher) -> set:
+    changed = set()
+    deadline = time.monotonic() + 2
+    while time.monotonic() < deadline:
+        changed |= watcher.wait(0.1)
+        if changed:
+            time.sleep(0.1)
+            return changed | watcher.wait(0.1)
+    return changed
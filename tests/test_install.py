@@ -0,0 +1,41 @@
+import os
+import threading
+import store
+
+def install(target, content: str):
+    staging = store.create_staging_dir()
+    (staging / "template.json").write_text(content)
+    store.install_staged(staging, target)
+
+def test_install_staged_replaces_the_version(cache):
+    target = store.TEMPLATES_ROOT / "t" / "a" / "1"
+    install(target, "first")
+    install(target, "second")
+    assert (target / "template.json").read_text() == "second"
+    # neither the swapped-out tree nor the incoming one is left behind
+    assert os.listdir(target.parent) == ["1"]
+
+def test_install_staged_never_leaves_the_version_missing(cache, tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    if not store.exchange_paths(tmp_path / "a", tmp_path / "b"):
+        return  # no renameat2 here, the fallback has a documented window
+    target = store.TEMPLATES_ROOT / "t" / "a" / "1"
+    install(target, "0")
+    missing = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            if not (target / "template.json").exists():
+                missing.append(True)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        for i in range(200):
+            install(target, str(i))
+    finally:
+        done.set()
+        reader.join()
+    assert not missing
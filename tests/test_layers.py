@@ -0,0 +1,49 @@
+import pytest
+import store
+from builder import build_template
+from image import TemplateImage, find_local_image
+from layers import load_layer, merged_contents
+from render_plan import load_render_plan
+from renderer import render_template
+from conftest import make_source
+
+@pytest.fixture
+def layered(cache, tmp_path):
+    base = TemplateImage.parse("t/base:1.0")
+    build_template(base, make_source(tmp_path / "base", {"a.txt": "base a", "b.txt": "base b", "keep/c.txt": "base c", "gone/d.txt": "d"}))
+    image = TemplateImage.parse("t/app:1.0")
+    build_template(image, make_source(tmp_path / "app", {"a.txt": "app a", "keep/c.txt": "base c", "e.txt": "app e"}, {"placeholders": [], "base": base.id()}))
+    return base, image
+
+def test_merged_contents_prefers_upper_layers(layered):
+    base, image = layered
+    dirs, files = merged_contents(find_local_image(image))
+    assert files["a.txt"][0] == store.hash_file(find_local_image(image) / "a.txt")
+    assert files["keep/c.txt"][0] == store.hash_file(find_local_image(base) / "keep/c.txt")
+    assert "e.txt" in files
+    assert "keep" in dirs
+
+def test_merged_contents_hides_what_the_image_removed(layered):
+    _, image = layered
+    dirs, files = merged_contents(find_local_image(image))
+    assert "b.txt" not in files
+    assert "gone/d.txt" not in files
+    assert "gone" not in dirs
+
+def test_unchanged_base_files_stay_in_the_base(layered):
+    _, image = layered
+    path = find_local_image(image)
+    assert not (path / "keep/c.txt").exists()
+    assert load_layer(path)["from_base"] == {"keep/c.txt": store.hash_file(find_local_image(TemplateImage.parse("t/base:1.0")) / "keep/c.txt")}
+
+def test_plan_offsets_are_not_used_after_the_base_changed(cache, tmp_path):
+    metadata = {"placeholders": ["who"]}
+    base = TemplateImage.parse("t/base:1.0")
+    build_template(base, make_source(tmp_path / "base", {"x.txt": "hello {{who}} and more"}, metadata))
+    image = TemplateImage.parse("t/app:1.0")
+    build_template(image, make_source(tmp_path / "app", {"x.txt": "hello {{who}} and more"}, dict(metadata, base=base.id())))
+    # same size, so only the hash tells the plan's offsets are wrong now
+    build_template(base, make_source(tmp_path / "base2", {"x.txt": "{{who}} hello and more"}, metadata), force=True)
+    path = find_local_image(image)
+    render_template(path, tmp_path / "out", {"who": "world"}, load_render_plan(path))
+    assert (tmp_path / "out/x.txt").read_text() == "world hello and more"
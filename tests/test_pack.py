@@ -0,0 +1,65 @@
+import io
+import zipfile
+import pytest
+from pack import MAGIC, PackReader, PackWriter, pack_zip, write_pack_zip
+from render_plan import RenderPlan
+
+def test_pack_round_trip(tmp_path):
+    src = tmp_path / "tool.sh"
+    src.write_bytes(b"#!/bin/sh\necho {{name}}\n")
+    src.chmod(0o755)
+    plan = RenderPlan(placeholders=["name"], files={"tool.sh": {"type": "template", "size": 24, "offsets": []}})
+    writer = PackWriter(tmp_path / "t.pack")
+    writer.add_dir("sub")
+    writer.add_file("tool.sh", src)
+    writer.add_stream("sub/logo.png", io.BytesIO(b"\x89PNG\x00" + bytes(range(256))), 0o644)
+    writer.add_stream("sub/empty.txt", io.BytesIO(b""), 0o600)
+    writer.close({"name": "t", "placeholders": ["name"]}, plan, {"base": "b/c:1.0", "removed": ["old.txt"]})
+
+    with PackReader(tmp_path / "t.pack") as reader:
+        assert reader.metadata.name == "t"
+        assert reader.plan.dump() == plan.dump()
+        assert reader.layer == {"base": "b/c:1.0", "removed": ["old.txt"]}
+        assert reader.dirs == ["sub"]
+        files = {entry[0]: entry for entry in reader.files}
+        assert bytes(reader.data(files["tool.sh"])) == src.read_bytes()
+        assert files["tool.sh"][3] == 0o755 and not files["tool.sh"][4]
+        assert bytes(reader.data(files["sub/logo.png"])) == b"\x89PNG\x00" + bytes(range(256))
+        assert files["sub/logo.png"][4]
+        assert bytes(reader.data(files["sub/empty.txt"])) == b""
+        assert files["sub/empty.txt"][3] == 0o600
+
+def test_aborted_pack_leaves_nothing(tmp_path):
+    writer = PackWriter(tmp_path / "t.pack")
+    writer.add_stream("a.txt", io.BytesIO(b"a"), 0o644)
+    writer.abort()
+    assert list(tmp_path.iterdir()) == []
+
+def test_truncated_pack_is_rejected(tmp_path):
+    writer = PackWriter(tmp_path / "t.pack")
+    writer.add_stream("a.txt", io.BytesIO(b"a" * 100), 0o644)
+    writer.close({"name": "t"})
+    data = (tmp_path / "t.pack").read_bytes()
+    (tmp_path / "t.pack").write_bytes(data[:-5])
+    with pytest.raises(ValueError):
+        PackReader(tmp_path / "t.pack")
+    (tmp_path / "t.pack").write_bytes(b"not a pack" + data[len(MAGIC):])
+    with pytest.raises(ValueError):
+        PackReader(tmp_path / "t.pack")
+
+def test_pack_zip_round_trip(tmp_path):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zipf:
+        zipf.writestr("template.json", '{"name": "t"}')
+        zipf.writestr("deep/er/a.txt", "hello {{name}}")
+    with zipfile.ZipFile(archive) as zipf:
+        pack_zip(zipf, tmp_path / "t.pack")
+    with PackReader(tmp_path / "t.pack") as reader:
+        assert sorted(reader.dirs) == ["deep", "deep/er"]
+        assert [entry[0] for entry in reader.files] == ["deep/er/a.txt"]
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as zipf:
+        write_pack_zip(tmp_path / "t.pack", zipf)
+    with zipfile.ZipFile(out) as zipf:
+        assert zipf.read("deep/er/a.txt") == b"hello {{name}}"
+        assert zipf.read("template.json") == b'{\n  "name": "t"\n}'
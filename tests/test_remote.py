@@ -0,0 +1,101 @@
+import pytest
+import requests
+import remote
+import store
+from builder import build_template
+from image import TemplateImage, find_local_image
+from conftest import make_source
+
+def publish(registry, tmp_path, ref: str, files: dict) -> TemplateImage:
+    # built locally, zipped into the fake registry, then dropped from the cache again
+    from image import remove_local_image
+    image = TemplateImage.parse(ref)
+    build_template(image, make_source(tmp_path / ref.replace("/", "-"), files))
+    registry.archives[(image.category, image.name, image.version)] = remote.zip_template_folder(find_local_image(image)).getvalue()
+    remove_local_image(image)
+    return image
+
+@pytest.fixture
+def versions(cache, registry, tmp_path):
+    old = publish(registry, tmp_path, "t/a:1.0", {"a.txt": "one", "b.txt": "shared"})
+    new = publish(registry, tmp_path, "t/a:2.0", {"a.txt": "two", "b.txt": "shared"})
+    remote.pull_image(registry.url, old)
+    return old, new
+
+@pytest.mark.parametrize("failure", [
+    requests.ConnectionError("reset by peer"),
+    ValueError("Checksum mismatch"),
+])
+def test_failed_delta_falls_back_to_a_full_pull(versions, registry, monkeypatch, failure):
+    _, new = versions
+
+    def broken(*args, **kwargs):
+        raise failure
+    monkeypatch.setattr(remote, "download_delta", broken)
+    path = remote.pull_image(registry.url, new)
+    assert (path / "a.txt").read_text() == "two"
+
+def test_delta_server_error_falls_back_to_a_full_pull(versions, registry):
+    _, new = versions
+    registry.delta_status = 500
+    path = remote.pull_image(registry.url, new)
+    assert [status for _, served_path, status in registry.served if served_path.startswith(("/delta/", "/get/"))][-2:] == [500, 200]
+    assert (path / "a.txt").read_text() == "two"
+    assert store.load_manifest(path)["b.txt"]["hash"] == store.hash_file(path / "b.txt")
+
+def test_delta_pull(versions, registry):
+    _, new = versions
+    del registry.served[:]
+    path = remote.pull_image(registry.url, new)
+    assert (path / "a.txt").read_text() == "two"
+    assert (path / "b.txt").read_text() == "shared"
+    # only the files the old version lacks came over, and the full archive was never fetched
+    assert ("POST", "/delta/t/a/2.0", 200) in registry.served
+    assert not [path for _, path, _ in registry.served if path.startswith("/get/")]
+
+def test_pull_templates_pulls_a_repeated_ref_once(cache, registry, tmp_path, monkeypatch):
+    image = publish(registry, tmp_path, "t/b:1.0", {"a.txt": "a"})
+    pulled = []
+    pull_template = remote.pull_template
+    monkeypatch.setattr(remote, "pull_template", lambda url, image, *args: pulled.append(image.id()) or pull_template(url, image, *args))
+    results = remote.pull_templates(registry.url, [image, TemplateImage.parse("t/b:1.0")], jobs=2)
+    assert [error for _, error in results] == [None]
+    assert pulled == ["t/b:1.0"]
+
+@pytest.mark.parametrize("etags", [True, False], ids=["etag", "last-modified"])
+def test_catalog_is_revalidated_once_stale(cache, registry, tmp_path, monkeypatch, etags):
+    registry.etags = etags
+    registry.modified -= 60
+    publish(registry, tmp_path, "t/a:1.0", {"a.txt": "a"})
+    monkeypatch.setattr(remote.config, "get_remote_cache_ttl", lambda: 0)
+    assert [image.id() for image in remote.list_remote_templates(registry.url)] == ["t/a:1.0"]
+    # unchanged: the registry answers 304 and the cached listing is used
+    assert [image.id() for image in remote.list_remote_templates(registry.url)] == ["t/a:1.0"]
+    publish(registry, tmp_path, "t/b:1.0", {"b.txt": "b"})
+    registry.modified += 30
+    assert sorted(image.id() for image in remote.list_remote_templates(registry.url)) == ["t/a:1.0", "t/b:1.0"]
+    assert [status for method, path, status in registry.served if path == "/list"] == [200, 304, 200]
+
+def test_catalog_is_served_from_the_cache_within_its_ttl_and_offline(cache, registry, tmp_path, monkeypatch):
+    with pytest.raises(Exception, match="Offline"):
+        remote.list_remote_templates(registry.url, offline=True)
+    image = publish(registry, tmp_path, "t/a:1.0", {"a.txt": "a"})
+    remote.list_remote_templates(registry.url)
+    remote.fetch_metadata(registry.url, image)
+    served = len(registry.served)
+    publish(registry, tmp_path, "t/b:1.0", {"b.txt": "b"})
+    assert [i.id() for i in remote.list_remote_templates(registry.url)] == ["t/a:1.0"]
+    monkeypatch.setattr(remote.config, "get_remote_cache_ttl", lambda: 0)
+    assert [i.id() for i in remote.list_remote_templates(registry.url, offline=True)] == ["t/a:1.0"]
+    assert remote.fetch_metadata(registry.url, image, offline=True).placeholders == []
+    assert len(registry.served) == served
+
+def test_upload_drops_the_cached_catalog(cache, registry, tmp_path, monkeypatch):
+    monkeypatch.setattr(remote, "get_upload_token", lambda: "token")
+    assert remote.list_remote_templates(registry.url) == []
+    image = TemplateImage.parse("t/up:1.0")
+    build_template(image, make_source(tmp_path / "src", {"a.txt": "a"}))
+    results = remote.upload_templates(registry.url, [image], jobs=1)
+    assert [error for _, error in results] == [None]
+    # within the TTL, yet the listing is fetched again because it predates the upload
+    assert [i.id() for i in remote.list_remote_templates(registry.url)] == ["t/up:1.0"]
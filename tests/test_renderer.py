@@ -0,0 +1,147 @@
+import datetime
+import os
+import threading
+import pytest
+from renderer import client_environment, get_default_placeholders
+
+def test_placeholders_use_the_client_environment(monkeypatch):
+    monkeypatch.setenv("LOGNAME", "daemon-user")
+    monkeypatch.delenv("TZ", raising=False)
+    with client_environment({"USER": "client", "TZ": "Etc/GMT-14"}):
+        values = get_default_placeholders("app", "t")
+        # the zone only goes into the datetime, the process environment is left alone
+        assert "TZ" not in os.environ
+    assert values["user"] == "client"
+    assert values["date"] == datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=14))).strftime("%Y-%m-%d")
+    assert get_default_placeholders("app", "t")["user"] == "daemon-user"
+
+def test_an_unknown_client_zone_falls_back_to_local_time():
+    with client_environment({"TZ": "Nowhere/Atlantis"}):
+        values = get_default_placeholders("app", "t")
+    assert values["date"] == datetime.datetime.now().strftime("%Y-%m-%d")
+
+def test_client_environment_is_per_thread(monkeypatch):
+    monkeypatch.setenv("LOGNAME", "daemon-user")
+    seen = []
+    with client_environment({"LOGNAME": "client"}):
+        thread = threading.Thread(target=lambda: seen.append(get_default_placeholders("app", "t")["user"]))
+        thread.start()
+        thread.join()
+        assert get_default_placeholders("app", "t")["user"] == "client"
+    assert seen == ["daemon-user"]
+
+def _chunked_outputs(data, replacements, chunk_size):
+    from io import BytesIO
+    from renderer import Replacer
+    replacer = Replacer(replacements)
+    whole = BytesIO()
+    replacer.stream(BytesIO(data), whole)
+    streamed = BytesIO()
+    replacer.stream(BytesIO(data), streamed, chunk_size)
+    offsets = [
+        [offset, offset + len(token), name.decode("utf-8")]
+        for token, name, offset in replacer.iter_segments(BytesIO(data), chunk_size)
+        if name is not None
+    ]
+    spliced = BytesIO()
+    replacer.splice_stream(BytesIO(data), spliced, offsets, chunk_size)
+    return whole.getvalue(), streamed.getvalue(), spliced.getvalue()
+
+def test_placeholders_split_across_chunks_render_like_the_whole_file():
+    data = "{{name}}-x{{project_name}}{{name}}é {{nam}} {{{name}}}}\n{{name}}".encode("utf-8") * 7
+    replacements = {"name": "Ünïcode", "project_name": "app"}
+    expected = data.decode("utf-8").replace("{{project_name}}", "app").replace("{{name}}", "Ünïcode").encode("utf-8")
+    for chunk_size in range(1, 40):
+        whole, streamed, spliced = _chunked_outputs(data, replacements, chunk_size)
+        assert whole == expected
+        assert streamed == expected, chunk_size
+        assert spliced == expected, chunk_size
+
+def test_a_character_cut_by_the_sniff_prefix_is_still_text(monkeypatch, tmp_path):
+    import renderer
+    monkeypatch.setattr(renderer, "SNIFF_SIZE", 8)
+    matcher = renderer.PlaceholderMatcher(["name"])
+    text = tmp_path / "text.txt"
+    text.write_bytes("abcdefg€ {{name}}".encode("utf-8"))  # the euro sign straddles byte 8
+    binary = tmp_path / "data.bin"
+    binary.write_bytes(b"abcdefg\xff {{name}}")
+    truncated = tmp_path / "short.txt"
+    truncated.write_bytes("abc€".encode("utf-8")[:-1])  # the whole file fits the prefix, so the cut is real
+    assert renderer.scan_file(text, matcher)["type"] == "template"
+    assert renderer.scan_file(binary, matcher)["type"] == "binary"
+    assert renderer.scan_file(truncated, matcher)["type"] == "binary"
+
+def _tree(path):
+    tree = {}
+    for root, dirs, files in os.walk(path):
+        rel = os.path.relpath(root, path)
+        tree[rel] = None
+        for file in files:
+            st = os.stat(os.path.join(root, file))
+            with open(os.path.join(root, file), "rb") as f:
+                tree[os.path.join(rel, file)] = (f.read(), st.st_mode & 0o777)
+    return tree
+
+@pytest.mark.parametrize("packed", [False, True], ids=["blobs", "pack"])
+def test_parallel_rendering_matches_serial(cache, tmp_path, packed):
+    from builder import build_template
+    from conftest import make_source
+    from image import TemplateImage, find_local_image
+    from render_plan import load_render_plan
+    from renderer import render_template
+
+    files = {f"d{i % 5}/sub{i % 3}/f{i}.txt": f"{i} {{{{name}}}} {{{{project_name}}}}\n" * (i + 1) for i in range(40)}
+    files.update({f"bin/b{i}.bin": bytes(range(256)) * i for i in range(10)})
+    files["empty/.keep"] = ""
+    source = make_source(tmp_path / "src", files, {"placeholders": ["name"]})
+    os.chmod(source / "d0/sub0/f0.txt", 0o750)
+    image = TemplateImage.parse("t/par:1.0")
+    build_template(image, source, packed=packed)
+    path = find_local_image(image)
+
+    trees = []
+    for jobs in (1, 4):
+        out = tmp_path / f"out{jobs}"
+        render_template(path, out, {"name": "N", "project_name": "p"}, load_render_plan(path), jobs)
+        trees.append(_tree(out))
+    assert trees[0] == trees[1]
+    assert trees[0][os.path.join("d1", "sub1", "f1.txt")][0] == b"1 N p\n" * 2
+
+def test_plan_offsets_are_spliced_only_while_they_still_hold(cache, tmp_path, monkeypatch):
+    from builder import build_template
+    from conftest import make_source
+    from image import TemplateImage, find_local_image
+    from render_plan import load_render_plan
+    from renderer import Replacer, render_template
+
+    files = {"covered.txt": "a {{name}} b", "resized.txt": "c {{name}} d", "edited.txt": "e {{name}} f"}
+    source = make_source(tmp_path / "src", files, {"placeholders": ["name"]})
+    image = TemplateImage.parse("t/plan:1.0")
+    build_template(image, source)
+    path = find_local_image(image)
+    plan = load_render_plan(path)
+    # new files rather than writes through the links, so the shared blobs stay intact
+    for rel_file, content in {"resized.txt": "c {{name}} dd", "edited.txt": "{{name}} e f", "added.txt": "{{name}}"}.items():
+        (path / rel_file).unlink(missing_ok=True)
+        (path / rel_file).write_text(content)
+
+    calls = []
+    for method in ("stream", "splice_stream"):
+        original = getattr(Replacer, method)
+        def spy(self, src, dst, *args, original=original, method=method):
+            calls.append((method, os.path.basename(src.name)))
+            return original(self, src, dst, *args)
+        monkeypatch.setattr(Replacer, method, spy)
+
+    render_template(path, tmp_path / "out", {"name": "N"}, plan)
+    assert sorted(calls) == [
+        ("splice_stream", "covered.txt"), ("splice_stream", "edited.txt"),
+        ("stream", "added.txt"), ("stream", "edited.txt"), ("stream", "resized.txt"),
+    ]
+    out = tmp_path / "out"
+    assert [(out / f).read_text() for f in ("covered.txt", "resized.txt", "edited.txt", "added.txt")] == ["a N b", "c N dd", "N e f", "N"]
+
+    # a plan scanned for other placeholders is not used at all
+    calls.clear()
+    render_template(path, tmp_path / "out2", {"name": "N", "other": "O"}, plan)
+    assert {method for method, _ in calls} == {"stream"}
@@ -0,0 +1,56 @@
+import threading
+import uuid
+import pytest
+import remote
+import server
+from builder import build_template
+from image import TemplateImage, find_local_image, remove_local_image
+from conftest import make_source
+
+def multipart(fields: dict, file_data: bytes, boundary: str) -> bytes:
+    return b"".join(remote.stream_multipart(fields, "file", "template.zip", "application/zip", [file_data], boundary))
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_read_multipart_streams_the_file_part(tmp_path, chunk_size):
+    boundary = uuid.uuid4().hex
+    data = b"PK\r\n--not-the-boundary\r\n" * 50
+    body = multipart({"category": "t", "name": "a"}, data, boundary)
+    chunks = iter([body[i:i + chunk_size] for i in range(0, len(body), chunk_size)])
+    fields = server.read_multipart(f"multipart/form-data; boundary={boundary}", chunks, "file", tmp_path / "upload.zip")
+    assert fields == {"category": b"t", "name": b"a"}
+    assert (tmp_path / "upload.zip").read_bytes() == data
+
+def test_read_multipart_rejects_a_truncated_body(tmp_path):
+    body = multipart({"category": "t"}, b"data", "b0undary")
+    with pytest.raises(ValueError):
+        server.read_multipart("multipart/form-data; boundary=b0undary", iter([body[:-10]]), "file", tmp_path / "upload.zip")
+
+def test_read_multipart_rejects_oversized_fields(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "MULTIPART_FIELD_LIMIT", 16)
+    body = multipart({"category": "x" * 100}, b"data", "b0undary")
+    with pytest.raises(ValueError):
+        server.read_multipart("multipart/form-data; boundary=b0undary", iter([body]), "file", tmp_path / "upload.zip")
+
+@pytest.fixture
+def registry_server(cache):
+    httpd = server.serve("127.0.0.1", 0, workers=2, token="secret")
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_upload_round_trip(registry_server, tmp_path):
+    image = TemplateImage.parse("t/up:1.0")
+    build_template(image, make_source(tmp_path / "src", {"a.txt": "hello", "sub/b.bin": "bytes"}))
+    remote.upload_template(registry_server, image, token="secret")
+    # the registry and the client share the cache here, so it's the reinstalled copy that is checked
+    assert (find_local_image(image) / "a.txt").read_text() == "hello"
+    assert list(server.UPLOADS_ROOT.iterdir()) == []
+
+def test_upload_with_a_wrong_token_is_refused(registry_server, tmp_path):
+    image = TemplateImage.parse("t/up:1.0")
+    build_template(image, make_source(tmp_path / "src", {"a.txt": "hello"}))
+    with pytest.raises(Exception):
+        remote.upload_template(registry_server, image, token="wrong")
+    remove_local_image(image)
@@ -0,0 +1,99 @@
+import os
+import store
+
+def test_store_file_copies_the_source(cache, tmp_path):
+    src = tmp_path / "logo.bin"
+    src.write_bytes(b"BIN\0data")
+    entry = store.store_file(src)
+    blob = store.blob_path(entry["hash"])
+    assert not os.path.samestat(os.stat(blob), os.stat(src))
+
+    # an in-place edit of the source must not reach the blob
+    with open(src, "r+b") as f:
+        f.write(b"XXX")
+    assert blob.read_bytes() == b"BIN\0data"
+    assert store.hash_file(blob) == entry["hash"]
+
+def test_store_file_replaces_a_blob_that_is_the_source(cache, tmp_path):
+    src = tmp_path / "legacy.txt"
+    src.write_bytes(b"legacy")
+    entry = store.store_file(src)
+    blob = store.blob_path(entry["hash"])
+    os.unlink(blob)
+    os.link(src, blob)
+
+    store.store_file(src)
+    assert not os.path.samestat(os.stat(blob), os.stat(src))
+    assert os.stat(src).st_nlink == 1
+
+def test_executable_files_get_their_own_blob(cache, tmp_path):
+    src = tmp_path / "run.sh"
+    src.write_bytes(b"#!/bin/sh\n")
+    plain = store.store_file(src)
+    os.chmod(src, 0o755)
+    executable = store.store_file(src)
+    assert plain["hash"] == executable["hash"]
+    assert store.blob_path(plain["hash"]) != store.blob_path(executable["hash"], True)
+    assert os.stat(store.blob_path(executable["hash"], True)).st_mode & 0o111
+
+def test_release_blobs_keeps_blobs_still_linked(cache, tmp_path):
+    src = tmp_path / "a.txt"
+    src.write_bytes(b"shared")
+    entry = store.store_file(src)
+    version = tmp_path / "version"
+    version.mkdir()
+    store.link_blob(entry, version / "a.txt")
+
+    store.release_blobs({"a.txt": entry})
+    assert store.has_blob(entry)
+    os.unlink(version / "a.txt")
+    store.release_blobs({"a.txt": entry})
+    assert not store.has_blob(entry)
+
+def test_rendered_files_keep_their_own_mode_and_mtime(cache, tmp_path):
+    import remote
+    from builder import build_template
+    from image import TemplateImage, find_local_image, get_local_image_path, remove_local_image
+    from render_plan import load_render_plan
+    from renderer import render_template
+    from conftest import make_source
+
+    files = {"sub/s.txt": "secret", "logo.bin": b"\x00\x01same", "run.sh": "#!/bin/sh\n"}
+    images = []
+    for i, ref in enumerate(["t/a:1.0", "t/b:1.0"]):
+        source = make_source(tmp_path / f"src{i}", files)
+        os.chmod(source / "sub/s.txt", 0o600)
+        os.chmod(source / "run.sh", 0o750)
+        os.utime(source / "logo.bin", ns=(10 ** 18 + i, 10 ** 18 + i))  # the same blob, a different mtime each
+        image = TemplateImage.parse(ref)
+        build_template(image, source)
+        images.append(image)
+    # a pull goes through the archive, which carries the manifest
+    archive = remote.zip_template_folder(find_local_image(images[1]))
+    remove_local_image(images[1])
+    (tmp_path / "b.zip").write_bytes(archive.getvalue())
+    remote.install_archive(tmp_path / "b.zip", images[1], get_local_image_path(images[1]))
+
+    for i, image in enumerate(images):
+        path = find_local_image(image)
+        out = tmp_path / f"out{i}"
+        render_template(path, out, {}, load_render_plan(path))
+        assert os.stat(out / "sub/s.txt").st_mode & 0o777 == 0o600
+        assert os.stat(out / "run.sh").st_mode & 0o777 == 0o750
+        assert os.stat(out / "logo.bin").st_mtime_ns == 10 ** 18 + i
+
+def test_cache_stats_count_packed_versions(cache, tmp_path):
+    from builder import build_template
+    from image import TemplateImage
+    from conftest import make_source
+
+    files = {"a.txt": "a" * 100, "sub/b.bin": b"\x00" * 50}
+    build_template(TemplateImage.parse("t/loose:1.0"), make_source(tmp_path / "loose", files))
+    build_template(TemplateImage.parse("t/packed:1.0"), make_source(tmp_path / "packed", files), packed=True)
+    stats = store.cache_stats()
+    assert stats["versions"] == 2 and stats["packed_versions"] == 1
+    assert stats["files"] == 4
+    assert stats["logical_bytes"] == 300
+    assert stats["packed_logical_bytes"] == 150
+    # only the loose version's files are deduplicated against blobs
+    assert stats["saved_bytes"] == 150 - stats["blob_bytes"]
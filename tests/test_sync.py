@@ -0,0 +1,49 @@
+import os
+import pytest
+from builder import build_template
+from image import TemplateImage, find_local_image
+from render_plan import load_render_plan
+from renderer import sync_content, sync_template
+from conftest import make_source
+
+def test_sync_content_statuses(tmp_path):
+    path = tmp_path / "a.txt"
+    assert sync_content(path, b"one", 0o644) == "created"
+    os.utime(path, (1, 1))
+    assert sync_content(path, b"one", 0o644) == "unchanged"
+    assert os.stat(path).st_mtime == 1
+    assert sync_content(path, b"one", 0o755) == "updated"
+    assert os.stat(path).st_mode & 0o777 == 0o755
+    assert sync_content(path, b"two", 0o755) == "updated"
+    assert path.read_bytes() == b"two"
+    assert [p.name for p in tmp_path.iterdir()] == ["a.txt"]
+
+@pytest.mark.parametrize("packed", [False, True], ids=["loose", "packed"])
+def test_sync_template_statuses(cache, tmp_path, packed):
+    image = TemplateImage.parse("t/sync:1.0")
+    files = {"hello.txt": "hi {{who}}", "static.txt": "no placeholders", "logo.bin": b"\x00\x01" * 5000}
+    build_template(image, make_source(tmp_path / "src", files, {"placeholders": ["who"]}), packed=packed)
+    path = find_local_image(image)
+    out = tmp_path / "out"
+
+    def sync():
+        summary = sync_template(path, out, {"who": "you"}, load_render_plan(path))
+        return {status: sorted(p.name for p in paths) for status, paths in summary.items() if paths}
+
+    assert sync() == {"created": ["hello.txt", "logo.bin", "static.txt"]}
+    assert (out / "hello.txt").read_text() == "hi you"
+    assert (out / "logo.bin").read_bytes() == files["logo.bin"]
+    os.utime(out / "logo.bin", (1, 1))
+    assert sync() == {"unchanged": ["hello.txt", "logo.bin", "static.txt"]}
+    assert os.stat(out / "logo.bin").st_mtime == 1
+
+    (out / "logo.bin").write_bytes(b"\x00\x02" * 5000)  # same size, other bytes
+    (out / "static.txt").write_text("edited")
+    (out / "hello.txt").chmod(0o600)
+    os.utime(out / "logo.bin", (1, 1))
+    assert sync() == {"updated": ["hello.txt", "logo.bin", "static.txt"]}
+    assert (out / "logo.bin").read_bytes() == files["logo.bin"]
+    assert os.stat(out / "logo.bin").st_mtime > 1  # a replaced file is new to the project
+    assert (out / "static.txt").read_text() == "no placeholders"
+    assert os.stat(out / "hello.txt").st_mode & 0o777 == 0o644
+    assert sync() == {"unchanged": ["hello.txt", "logo.bin", "static.txt"]}
@@ -0,0 +1,185 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Set, Tuple
+from ignore import IGNORE_FILE, IgnoreRules
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+POLL_INTERVAL = 1.0
+
+def _ignored(rules: Optional[IgnoreRules], root: Path, path: Path, is_dir: bool) -> bool:
+    # .newignore'd folders aren't watched at all, so node_modules churn never wakes us up
+    if not rules or path == root or path == root / IGNORE_FILE:
+        return False  # a changed .newignore is how watch mode learns about new rules
+    return rules.ignored(path.relative_to(root).as_posix(), is_dir)
+
+class InotifyWatcher:
+    # recursive inotify through libc; the process sleeps in select() while nothing changes
+    method = "inotify"
+
+    def __init__(self, root: Path, rules: Optional[IgnoreRules] = None) -> None:
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.root = root
+        self.rules = rules
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        self._watches: Dict[int, Path] = {}
+        try:
+            self._add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_tree(self, path: Path):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [name for name in dirs if not _ignored(self.rules, self.root, Path(root) / name, True)]
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if errno == 2:  # ENOENT: removed again before we got to it
+                    continue
+                # ENOSPC means fs.inotify.max_user_watches is used up
+                raise OSError(errno, f"inotify_add_watch failed for {root}: {os.strerror(errno)}")
+            self._watches[wd] = Path(root)
+
+    def reload(self, rules: Optional[IgnoreRules]):
+        # new rules can hide some directories and reveal others, so every watch is set up again
+        self.rules = rules
+        for wd in list(self._watches):
+            self._libc.inotify_rm_watch(self.fd, wd)
+        self._watches.clear()
+        self._add_tree(self.root)
+
+    def wait(self, timeout: Optional[float] = None) -> Set[Path]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changed.add(self.root)  # events were dropped, only a full pass is safe
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+            path = directory / os.fsdecode(name) if name else directory
+            if _ignored(self.rules, self.root, path, bool(mask & IN_ISDIR)):
+                continue
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)  # new directories need their own watches
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class PollingWatcher:
+    # fallback for platforms or filesystems without inotify: compares stat snapshots
+    method = "polling"
+
+    def __init__(self, root: Path, interval: float = POLL_INTERVAL, rules: Optional[IgnoreRules] = None) -> None:
+        self.root = root
+        self.rules = rules
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Dict[Path, Tuple[int, int, int]]:
+        snapshot = {}
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = [name for name in dirs if not _ignored(self.rules, self.root, Path(root) / name, True)]
+            for name in files:
+                path = Path(root) / name
+                if _ignored(self.rules, self.root, path, False):
+                    continue
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (st.st_size, st.st_mtime_ns, st.st_mode)
+            for name in dirs:
+                snapshot[Path(root) / name] = (0, 0, 0)
+        return snapshot
+
+    def _changes(self) -> Set[Path]:
+        snapshot = self._scan()
+        changed = {path for path in snapshot.keys() | self._snapshot.keys() if snapshot.get(path) != self._snapshot.get(path)}
+        self._snapshot = snapshot
+        return changed
+
+    def reload(self, rules: Optional[IgnoreRules]):
+        self.rules = rules
+        self._snapshot = self._scan()
+
+    def wait(self, timeout: Optional[float] = None) -> Set[Path]:
+        while True:
+            time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+            changed = self._changes()
+            if changed or timeout is not None:
+                return changed
+
+    def close(self):
+        pass
+
+def open_watcher(root: Path, polling: bool = False, rules: Optional[IgnoreRules] = None):
+    if not polling:
+        try:
+            return InotifyWatcher(root, rules)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(root, rules=rules)
+
+def watch_changes(watcher, debounce: float = 0.2) -> Iterator[Set[Path]]:
+    # an editor save or a git checkout is a burst of events; yield once the burst has gone quiet
+    while True:
+        changed = watcher.wait()
+        if not changed:
+            continue
+        while True:
+            more = watcher.wait(debounce)
+            if not more:
+                break
+            changed |= more
+        yield changed